@@ -1,4 +1,6 @@
-from flask_chat_server import app
+from flask_chat_server import create_app, socketio
+
+app = create_app()
 
 if __name__ == ("__main__"):
-    app.run(debug=True)
+    socketio.run(app, debug=True)
@@ -1,19 +1,43 @@
 import os
+import weakref
+import click
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
-from flask_cors import CORS
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
+from flask_socketio import SocketIO
 from dotenv import load_dotenv, find_dotenv
+from flask_chat_server.main.governor import Governor
+from flask_chat_server.main.answer_cache import AnswerCache
+from flask_chat_server.main.chat_client import ChatClient
+from flask_chat_server.main.resumable import StreamRegistry
+from flask_chat_server.main.known_sessions import KnownSessions
+from flask_chat_server.main.summary import ConversationSummarizer
+from flask_chat_server.main.vector_index import VectorIndex
+from flask_chat_server.main.template_cache import FragmentCache
+from flask_chat_server.main.suggest import SuggestIndex
+from flask_chat_server.main.related_posts import RelatedPosts
+from flask_chat_server.main.feeds import FeedCache
+from flask_chat_server.main.question_classifier import QuestionClassifier
+from flask_chat_server.main.profiling import Profiler
+from flask_chat_server.main.event_log import EventLog
+from flask_chat_server.main.compressed_text import TextCodec
 
 load_dotenv(find_dotenv(), override=True)
 
-app = Flask(__name__)
+"""
+    アプリケーションはcreate_app(config)で作成する（設定はflask_chat_server/config参照）。
+    拡張機能はここでアプリケーションなしで作成し、create_appでinit_appする。
 
-# csrf対策
-app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY")
+    複数ワーカーで動かす場合、親プロセスでcreate_appしてからforkすると
+    （gunicornの--preloadなど）、import済みのモジュールやテンプレートをワーカー間で共有できる。
+    fork後の子プロセスでは、親プロセスから引き継いだDBの接続とOpenAIへの接続を使わないよう
+    after_forkで作り直す（os.register_at_forkで自動的に呼ばれる）。
+"""
+
+db = SQLAlchemy()
+login_manager = LoginManager()
+login_manager.login_view = "users.login"
+socketio = SocketIO()
 
 # IPアドレスごとのリクエスト制限
 # limiter = Limiter(
@@ -22,49 +46,50 @@ app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY")
 #     storage_uri="redis://localhost:6379",
 # )
 
-CORS(
-    app,
-    resources={
-        r"/chat_session": {
-            "origins": [
-                "http://localhost:8080",
-            ],
-            "methods": ["GET"],
-        },
-        r"/save_chat": {
-            "origins": [
-                "http://localhost:8080",
-            ],
-            "methods": ["POST"],
-        },
-        r"/chat_sse": {
-            "origins": [
-                "http://localhost:8080",
-            ],
-            "methods": ["GET"],
-        },
-    },
-    supports_credentials=True,
-)
+# テンプレートのバイトコードキャッシュと、記事のカード・本文のフラグメントキャッシュ（main/template_cache.py参照）
+fragment_cache = FragmentCache()
 
-# git push時は下記をコメントアウトする
-basedir = os.path.abspath(os.path.dirname(__file__))
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(
-    basedir, "data.sqlite"
-)
+# チャット用エンドポイントのリクエスト数・同時ストリーム数の制限（main/governor.py参照）
+governor = Governor()
 
-# git push時は下記をコメントインする
-# app.config[
-#     "SQLALCHEMY_DATABASE_URI"
-# ] = os.environ.get("MYSQL_CONFIG")
+# 最初の質問に対する回答のキャッシュ（main/answer_cache.py参照）
+answer_cache = AnswerCache()
 
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-db = SQLAlchemy(app)
-Migrate(app, db)
+# Last-Event-IDで再接続できるSSEストリームの保持（main/resumable.py参照）
+resumable_streams = StreamRegistry()
 
-login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = "users.login"
+# DBに保存済みのチャットセッションIDのキャッシュ（main/known_sessions.py参照）
+known_sessions = KnownSessions()
+
+# 長い会話の要約（main/summary.py参照）
+summarizer = ConversationSummarizer()
+
+# OpenAI・langchainのクライアント。起動時にウォームアップする（main/chat_client.py参照）
+chat_client = ChatClient()
+
+# 関連する質問に参考情報として含めるブログ記事のベクトル検索（main/vector_index.py参照）
+vector_index = VectorIndex()
+
+# 検索欄の入力候補（/search/suggest）の索引（main/suggest.py参照）
+search_suggestions = SuggestIndex()
+
+# 記事ページに表示する関連記事（main/related_posts.py参照）
+related_posts = RelatedPosts()
+
+# RSSフィードとサイトマップ（main/feeds.py参照）
+feed_cache = FeedCache()
+
+# 質問の種別のローカル分類器（main/question_classifier.py参照）
+question_classifier = QuestionClassifier()
+
+# 動いているワーカーのCPU・メモリのプロファイリング（main/profiling.py参照）
+profiler = Profiler()
+
+# チャットの処理の構造化ログ（main/event_log.py参照）
+event_log = EventLog()
+
+# メッセージ・記事の本文の圧縮保存（main/compressed_text.py参照）
+text_codec = TextCodec()
 
 
 def localize_callback(*argds, **kwargs):
@@ -73,24 +98,142 @@ def localize_callback(*argds, **kwargs):
 
 login_manager.localize_callback = localize_callback
 
+
+def create_app(config=None):
+    # configは設定の名前・設定クラス・dictのいずれか。dictの場合はFLASK_CONFIGの設定を上書きする。
+    from flask_chat_server.config import config as profiles, engine_options
+
+    overrides = {}
+    if isinstance(config, dict):
+        overrides, config = config, None
+    if config is None or isinstance(config, str):
+        config = profiles[config or os.environ.get("FLASK_CONFIG", "development")]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.config.update(overrides)
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config))
+
+    db.init_app(app)
+    login_manager.init_app(app)
+
+    from flask_migrate import Migrate
+    from flask_cors import CORS
+    from flask_chat_server.main.socket_queue import make_client_manager
+
+    # Socket.IOのイベントを登録する。socketio.init_appより前にimportしておくと、
+    # create_appを複数回呼んだ場合（テストなど）も、作り直したサーバーにイベントが登録される
+    from flask_chat_server.main import socket_events  # noqa: F401
+
+    Migrate(app, db)
+
+    origins = app.config["CHAT_ALLOWED_ORIGINS"]
+    CORS(
+        app,
+        resources={
+            r"/chat_session": {"origins": origins, "methods": ["GET"]},
+            r"/save_chat": {"origins": origins, "methods": ["POST"]},
+            r"/chat_sse": {"origins": origins, "methods": ["GET"]},
+        },
+        supports_credentials=True,
+    )
+    socketio.init_app(
+        app,
+        cors_allowed_origins=origins,
+        async_mode=app.config["SOCKETIO_ASYNC_MODE"],
+        client_manager=make_client_manager(
+            app.config["SOCKETIO_MESSAGE_QUEUE"],
+            channel=app.config["SOCKETIO_CHANNEL"],
+        ),
+    )
+
+    event_log.init_app(app)
+    fragment_cache.init_app(app)
+    governor.init_app(app)
+    answer_cache.init_app(app)
+    resumable_streams.init_app(app)
+    known_sessions.init_app(app)
+    summarizer.init_app(app)
+    chat_client.init_app(app)
+    vector_index.init_app(app, chat_client)
+    search_suggestions.init_app(app)
+    related_posts.init_app(app)
+    feed_cache.init_app(app)
+    question_classifier.init_app(app)
+    profiler.init_app(app)
+    text_codec.init_app(app)
+
+    from flask_chat_server.error_pages.handlers import error_pages
+    from flask_chat_server.main.views import main
+    from flask_chat_server.users.views import users
+
+    app.register_blueprint(error_pages)
+    app.register_blueprint(main)
+    app.register_blueprint(users)
+
+    # 使われていないチャットセッションの整理（flask compact-sessions）と、
+    # お問い合わせ・チャット履歴のエクスポート（flask export）
+    from flask_chat_server.main import compaction, exports
+
+    compaction.init_app(app)
+    exports.init_app(app)
+
+    @app.cli.command("create-tables")
+    def create_tables_command():
+        """まだないテーブルを作成する（既存のテーブル・データは変更しない）。"""
+        missing = missing_tables()
+        db.create_all()
+        click.echo(f"作成したテーブル: {', '.join(missing) or 'なし'}")
+
+    created_apps.add(app)
+    return app
+
+
+def missing_tables():
+    # モデルにあってDBにないテーブル。機能を追加した後はflask create-tablesで作成する
+    existing = set(inspect(db.engine).get_table_names())
+    return [name for name in db.metadata.tables if name not in existing]
+
+
+def require_tables(*tables):
+    # 実行中にテーブルを作成せず、ない場合は作成方法を示して止める
+    missing = [table.name for table in tables if table.name in missing_tables()]
+    if missing:
+        raise click.ClickException(
+            f"テーブル（{', '.join(missing)}）がありません。flask create-tables を実行してください。"
+        )
+
+
+def after_fork(app):
+    # 親プロセスの接続は子プロセスで閉じずに捨てる（閉じると親プロセス側の接続も使えなくなる）
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+# create_appで作ったアプリケーション。fork後の処理はモジュールで1つだけ登録し、
+# 残っているアプリケーションごとに行う（テストなどで使い終わったアプリケーションは消える）
+created_apps = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for app in list(created_apps):
+        after_fork(app)
+    chat_client.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy import event, inspect
 
 
-# git push時は下記をコメントアウトする。
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
+    import sqlite3
+
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
     cursor = dbapi_connection.cursor()
     cursor.execute("PRAGMA foreign_keys=ON")
     cursor.close()
-
-
-# from flask_chat_server.users.views import users
-from flask_chat_server.error_pages.handlers import error_pages
-from flask_chat_server.main.views import main
-from flask_chat_server.users.views import users
-
-# app.register_blueprint(users)
-app.register_blueprint(error_pages)
-app.register_blueprint(main)
-app.register_blueprint(users)
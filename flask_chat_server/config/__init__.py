@@ -0,0 +1,120 @@
+import os
+
+"""
+    アプリケーションの設定。create_app(config)のconfigに名前（または設定クラス、dict）を渡す。
+    名前を省略した場合は環境変数FLASK_CONFIGの値（未設定の場合はdevelopment）を使う。
+        development  開発用。flask_chat_server/data.sqliteを使う
+        testing      テスト用。メモリ上のSQLite、OpenAIへの接続やファイルへの保存をしない
+        benchmark    性能測定用。本番と同じ設定で、DBと埋め込みだけを切り替えられる
+        production   本番用。DATABASE_URL（またはMYSQL_CONFIG）のDBを使う
+"""
+
+basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+
+def env_flag(name, default):
+    return os.environ.get(name, "1" if default else "0") == "1"
+
+
+class Config:
+    # csrf対策
+    SECRET_KEY = os.environ.get("SECRET_KEY")
+
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(basedir, "data.sqlite")
+    # コネクションプール（SQLite以外）。DB側のタイムアウトより前に接続を作り直す。
+    DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", "10"))
+    DATABASE_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW", "20"))
+    DATABASE_POOL_RECYCLE = int(os.environ.get("DATABASE_POOL_RECYCLE", "1800"))
+
+    # CORSとSocket.IOで許可するオリジン
+    CHAT_ALLOWED_ORIGINS = os.environ.get(
+        "CHAT_ALLOWED_ORIGINS", "http://localhost:8080"
+    ).split(",")
+
+    # チャット回答をSocket.IOでストリーミングする（/chat_sseと併用可能）
+    # async_modeは環境変数で切り替える（例: eventlet）。未設定の場合は開発サーバーで動くthreading。
+    # 複数ワーカーで動かす場合はSOCKETIO_MESSAGE_QUEUEを設定する（main/socket_queue.py参照）。
+    SOCKETIO_ASYNC_MODE = os.environ.get("SOCKETIO_ASYNC_MODE", "threading")
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE")
+    SOCKETIO_CHANNEL = os.environ.get("SOCKETIO_CHANNEL", "flask-socketio")
+
+    # テンプレートのバイトコードキャッシュと、記事のカード・本文のフラグメントキャッシュ（main/template_cache.py参照）
+    FRAGMENT_CACHE_URI = os.environ.get("FRAGMENT_CACHE_URI", "memory://")
+
+    # チャット用エンドポイントのリクエスト数・同時ストリーム数の制限（main/governor.py参照）
+    CHAT_GOVERNOR_STORAGE_URI = os.environ.get("CHAT_GOVERNOR_STORAGE_URI", "memory://")
+
+    # /chat_sseのフレームをまとめる文字数・最大の待ち時間（秒）と、gzip圧縮の有無（main/streaming.py参照）
+    CHAT_SSE_COALESCE_CHARS = 24
+    CHAT_SSE_COALESCE_DELAY = 0.05
+    CHAT_SSE_GZIP = env_flag("CHAT_SSE_GZIP", False)
+
+    # OpenAI・langchainのクライアント。起動時にウォームアップする（main/chat_client.py参照）
+    CHAT_CLIENT_WARMUP = env_flag("CHAT_CLIENT_WARMUP", True)
+
+    # 関連する質問に参考情報として含めるブログ記事のベクトル検索（main/vector_index.py参照）
+    CHAT_VECTOR_EMBEDDER = os.environ.get("CHAT_VECTOR_EMBEDDER", "openai")
+
+    # RSSフィード・サイトマップのリンクのURLの基点（例: https://example.com。main/feeds.py参照）
+    FEED_BASE_URL = os.environ.get("FEED_BASE_URL")
+
+    # 質問の種別の分類器の学習用に、OpenAIの判断を質問とともに記録するファイル。未設定の場合は記録しない
+    # （main/question_classifier.py参照）
+    QUESTION_CLASSIFIER_LOG = os.environ.get("QUESTION_CLASSIFIER_LOG")
+
+    # 使われていないチャットセッションの整理（flask compact-sessions。main/compaction.py参照）
+    SESSION_COMPACTION_INTERVAL = int(os.environ.get("SESSION_COMPACTION_INTERVAL", "0"))
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SECRET_KEY = "testing"
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    WTF_CSRF_ENABLED = False
+    CHAT_CLIENT_WARMUP = False
+    CHAT_VECTOR_EMBEDDER = "hashing"
+    TEMPLATE_BYTECODE_CACHE_DIR = None
+    SESSION_COMPACTION_INTERVAL = 0
+    SEARCH_SUGGEST_PRELOAD = False
+    QUESTION_CLASSIFIER_LOG = None
+    EVENT_LOG_LEVEL = "WARNING"
+    FEED_BASE_URL = "http://localhost"
+
+
+class BenchmarkConfig(Config):
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        "BENCH_DATABASE_URL", "sqlite:///" + os.path.join(basedir, "bench.sqlite")
+    )
+    CHAT_VECTOR_EMBEDDER = os.environ.get("CHAT_VECTOR_EMBEDDER", "hashing")
+
+
+class ProductionConfig(Config):
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        "DATABASE_URL", os.environ.get("MYSQL_CONFIG", Config.SQLALCHEMY_DATABASE_URI)
+    )
+
+
+config = {
+    "development": DevelopmentConfig,
+    "testing": TestingConfig,
+    "benchmark": BenchmarkConfig,
+    "production": ProductionConfig,
+}
+
+
+def engine_options(app_config):
+    # SQLiteはプールの設定を受け付けないため、SQLite以外の場合だけ設定する
+    uri = app_config["SQLALCHEMY_DATABASE_URI"]
+    if uri.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": app_config["DATABASE_POOL_SIZE"],
+        "max_overflow": app_config["DATABASE_MAX_OVERFLOW"],
+        "pool_recycle": app_config["DATABASE_POOL_RECYCLE"],
+        "pool_pre_ping": True,
+    }
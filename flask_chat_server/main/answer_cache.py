@@ -0,0 +1,130 @@
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from flask_chat_server.main.streaming import STOP
+
+"""
+    最初の質問（会話履歴のない質問）に対する回答のキャッシュ。
+    正規化した質問文と質問の種別（kind）をキーに、回答のChunkを保存しておき、
+    同じ質問が来た場合はOpenAIを呼ばずに保存済みのChunkをストリームとして再生する。
+
+    設定（app.config）
+        ANSWER_CACHE_ENABLED        Falseの場合はキャッシュしない
+        ANSWER_CACHE_TTL            有効期限（秒）
+        ANSWER_CACHE_MAX_ENTRIES    保存する回答の最大数
+        ANSWER_CACHE_MAX_CHARS      保存する回答の合計文字数の上限
+    上限を超えた場合は最も使われていない回答から削除する。
+"""
+
+
+def normalize_question(text):
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    # 文末の記号の違いは同じ質問として扱う
+    return text.rstrip("?!。.、, ")
+
+
+class AnswerCache:
+    def __init__(self, app=None):
+        self.enabled = True
+        self.ttl = 3600
+        self.max_entries = 1000
+        self.max_chars = 2000000
+        self._entries = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("ANSWER_CACHE_ENABLED", True)
+        app.config.setdefault("ANSWER_CACHE_TTL", 3600)
+        app.config.setdefault("ANSWER_CACHE_MAX_ENTRIES", 1000)
+        app.config.setdefault("ANSWER_CACHE_MAX_CHARS", 2000000)
+        self.enabled = app.config["ANSWER_CACHE_ENABLED"]
+        self.ttl = app.config["ANSWER_CACHE_TTL"]
+        self.max_entries = app.config["ANSWER_CACHE_MAX_ENTRIES"]
+        self.max_chars = app.config["ANSWER_CACHE_MAX_CHARS"]
+
+    def make_key(self, kind, question):
+        normalized = normalize_question(question)
+        return hashlib.sha256(f"{kind}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < now:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, chunks):
+        if not self.enabled:
+            return
+        chunks = tuple(chunks)
+        size = sum(len(chunk.data) for chunk in chunks)
+        if size > self.max_chars:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, chunks, size)
+            self._chars += size
+            while len(self._entries) > self.max_entries or self._chars > self.max_chars:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._chars -= size
+
+    def record(self, key, chunks):
+        # ストリームを流しながら回答を記録し、最後まで正常に生成された場合だけ保存する。
+        # 途中で切断された場合（GeneratorExit）やエラーメッセージ、文字数超過は保存しない。
+        recorded = []
+        for chunk in chunks:
+            recorded.append(chunk)
+            yield chunk
+        if recorded and all(
+            chunk.action is None and not chunk.data.startswith(f"{STOP}_")
+            for chunk in recorded
+        ):
+            self.set(key, recorded)
+
+    def replay(self, chunks):
+        yield from chunks
+
+    def purge(self):
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            self._chars = 0
+        return count
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "chars": self._chars,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0,
+            }
@@ -0,0 +1,285 @@
+import os
+import threading
+
+from flask_chat_server.main.resilience import (
+    CircuitBreaker,
+    LatencyTracker,
+    hedged_stream,
+    retry_call,
+)
+
+"""
+    OpenAI・langchainのクライアント。プロセスごとに1度だけ作成して使い回す。
+    ・openai / langchain のimportとAPIキーの設定は最初の1回だけ行う
+    ・OpenAIへの接続はkeep-aliveのコネクションプールを共有し、毎回のTLSハンドシェイクを省く
+    ・ask_langchainのプロンプトとチェーンはリクエストごとに作り直さない
+    起動時（init_app）にウォームアップしておくと、デプロイ直後の最初のリクエストが遅くならない。
+
+    設定（app.config）
+        CHAT_MODEL                  使用するモデル
+        CHAT_CLIENT_WARMUP          起動時にimportとクライアントの作成を済ませる
+        CHAT_CLIENT_WARMUP_CONNECT  起動時にOpenAIへの接続（TLS）も確立しておく
+        CHAT_CLIENT_POOL_SIZE       コネクションプールの最大接続数
+        CHAT_CLIENT_TIMEOUT         OpenAIへのリクエストのタイムアウト（秒）
+        CHAT_RETRIES                リトライ回数（main/resilience.py）
+        CHAT_RETRY_BASE_DELAY       リトライの待ち時間の基準（秒）。2倍ずつ増える
+        CHAT_RETRY_MAX_DELAY        リトライの待ち時間の上限（秒）
+        CHAT_HEDGE_DELAY            最初のトークンをこの秒数待っても届かない場合に2本目を送る。Noneでヘッジしない
+        CHAT_HEDGE_ADAPTIVE         Trueの場合、実測した最初のトークンまでの時間のp95をCHAT_HEDGE_DELAYの代わりに使う
+        CHAT_BREAKER_THRESHOLD      連続してこの回数失敗したらサーキットブレーカーを開く
+        CHAT_BREAKER_RESET          サーキットブレーカーを開いてから再び試すまでの秒数
+"""
+
+LANGCHAIN_TEMPLATE = """
+    以下は、人間とAIのフレンドリーな会話です。
+    AIはその文脈から具体的な内容をたくさん教えてくれます。
+    AIは質問の答えを知らない場合、正直に「知らない」と答えます。
+    """
+
+
+class ChatClient:
+    def __init__(self, app=None):
+        self.model = "gpt-3.5-turbo"
+        self.pool_size = 20
+        self.timeout = 60
+        self.api_key = None
+        self.http_session = None
+        self._openai = None
+        self._prompt = None
+        self._chain = None
+        self._lock = threading.Lock()
+        self.retries = 2
+        self.retry_base_delay = 0.5
+        self.retry_max_delay = 4.0
+        self.hedge_delay = 3.0
+        self.hedge_adaptive = False
+        self.breaker = CircuitBreaker()
+        self.first_token_latency = LatencyTracker()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("CHAT_MODEL", "gpt-3.5-turbo")
+        app.config.setdefault("CHAT_CLIENT_WARMUP", True)
+        app.config.setdefault("CHAT_CLIENT_WARMUP_CONNECT", False)
+        app.config.setdefault("CHAT_CLIENT_POOL_SIZE", 20)
+        app.config.setdefault("CHAT_CLIENT_TIMEOUT", 60)
+        self.model = app.config["CHAT_MODEL"]
+        self.pool_size = app.config["CHAT_CLIENT_POOL_SIZE"]
+        self.timeout = app.config["CHAT_CLIENT_TIMEOUT"]
+        self.api_key = os.environ.get("OPENAI_API_KEY")
+
+        app.config.setdefault("CHAT_RETRIES", 2)
+        app.config.setdefault("CHAT_RETRY_BASE_DELAY", 0.5)
+        app.config.setdefault("CHAT_RETRY_MAX_DELAY", 4.0)
+        app.config.setdefault("CHAT_HEDGE_DELAY", 3.0)
+        app.config.setdefault("CHAT_HEDGE_ADAPTIVE", False)
+        app.config.setdefault("CHAT_BREAKER_THRESHOLD", 5)
+        app.config.setdefault("CHAT_BREAKER_RESET", 30)
+        self.retries = app.config["CHAT_RETRIES"]
+        self.retry_base_delay = app.config["CHAT_RETRY_BASE_DELAY"]
+        self.retry_max_delay = app.config["CHAT_RETRY_MAX_DELAY"]
+        self.hedge_delay = app.config["CHAT_HEDGE_DELAY"]
+        self.hedge_adaptive = app.config["CHAT_HEDGE_ADAPTIVE"]
+        self.breaker = CircuitBreaker(
+            app.config["CHAT_BREAKER_THRESHOLD"], app.config["CHAT_BREAKER_RESET"]
+        )
+
+        if app.config["CHAT_CLIENT_WARMUP"]:
+            self.warm_up(connect=app.config["CHAT_CLIENT_WARMUP_CONNECT"])
+
+    @property
+    def openai(self):
+        if self._openai is None:
+            with self._lock:
+                if self._openai is None:
+                    self._openai = self._build_openai()
+        return self._openai
+
+    def _build_openai(self):
+        import openai
+
+        openai.api_key = self.api_key
+        self._mount_session(openai)
+        return openai
+
+    def _mount_session(self, openai):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        # openaiライブラリはこのセッション（コネクションプール）を全リクエストで使う
+        openai.requestssession = session
+        self.http_session = session
+
+    def after_fork(self):
+        # fork後の子プロセスでは、親プロセスと共有しているOpenAIへの接続を使わない。
+        # 接続を閉じると親プロセス側も使えなくなるため、閉じずに新しいプールに差し替える。
+        if self._openai is not None:
+            self._mount_session(self._openai)
+
+    @property
+    def prompt(self):
+        if self._prompt is None:
+            from langchain.prompts.chat import (
+                ChatPromptTemplate,
+                SystemMessagePromptTemplate,
+                MessagesPlaceholder,
+                HumanMessagePromptTemplate,
+            )
+
+            self._prompt = ChatPromptTemplate.from_messages(
+                [
+                    SystemMessagePromptTemplate.from_template(LANGCHAIN_TEMPLATE),
+                    MessagesPlaceholder(variable_name="history"),
+                    HumanMessagePromptTemplate.from_template("{input}"),
+                ]
+            )
+        return self._prompt
+
+    @property
+    def chain(self):
+        # 会話履歴はプロンプトに含めて渡すため、メモリを持たないチェーンを共有する
+        if self._chain is None:
+            self.openai
+            from langchain.chat_models import ChatOpenAI
+            from langchain.chains import LLMChain
+
+            chat = ChatOpenAI(
+                temperature="0.5",
+                streaming=True,
+                model=self.model,
+                request_timeout=self.timeout,
+                openai_api_key=self.api_key,
+            )
+            self._chain = LLMChain(llm=chat, prompt=self.prompt)
+        return self._chain
+
+    def chat_completion(self, **kwargs):
+        kwargs.setdefault("model", self.model)
+        kwargs.setdefault("request_timeout", self.timeout)
+        return self.openai.ChatCompletion.create(**kwargs)
+
+    @property
+    def retryable_errors(self):
+        error = self.openai.error
+        return (
+            error.RateLimitError,
+            error.ServiceUnavailableError,
+            error.APIConnectionError,
+            error.Timeout,
+            error.TryAgain,
+        )
+
+    def is_upstream_failure(self, e):
+        # サーキットブレーカーで数えるのは上流の障害（リトライ対象のエラーと5xx）だけ。
+        # InvalidRequestErrorやAuthenticationErrorはリクエスト側の問題のため数えない
+        if isinstance(e, self.retryable_errors):
+            return True
+        status = getattr(e, "http_status", None)
+        return status is not None and status >= 500
+
+    def _record_error(self, e):
+        if self.is_upstream_failure(e):
+            self.breaker.record_failure()
+        else:
+            self.breaker.release()
+
+    def _retry(self, func):
+        return retry_call(
+            func,
+            retries=self.retries,
+            base_delay=self.retry_base_delay,
+            max_delay=self.retry_max_delay,
+            retry_on=self.retryable_errors,
+        )
+
+    def create_completion(self, **kwargs):
+        # サーキットブレーカーとリトライ付きのChatCompletion（ストリームなし）
+        self.breaker.check()
+        try:
+            response = self._retry(lambda: self.chat_completion(**kwargs))
+        except Exception as e:
+            self._record_error(e)
+            raise
+        self.breaker.record_success()
+        return response
+
+    def current_hedge_delay(self):
+        if self.hedge_delay is None:
+            return None
+        if self.hedge_adaptive:
+            p95 = self.first_token_latency.percentile(95)
+            if p95 is not None:
+                return p95
+        return self.hedge_delay
+
+    def stream_completion(self, **kwargs):
+        # サーキットブレーカー・リトライ・ヘッジ付きのストリーミングChatCompletion。
+        # ブレーカーが開いている場合は最初に読み出したときにCircuitOpenErrorを送出する。
+        # （読み出さずに閉じた場合に、半開状態の試行枠を取ったままにならないよう、
+        # check()もジェネレーターの中で行う）
+        kwargs["stream"] = True
+        return self._stream(kwargs)
+
+    def _stream(self, kwargs):
+        self.breaker.check()
+        recorded = False
+
+        def on_first_item(seconds):
+            nonlocal recorded
+            recorded = True
+            self.first_token_latency.add(seconds)
+            self.breaker.record_success()
+
+        try:
+            yield from hedged_stream(
+                lambda: self._retry(lambda: self.chat_completion(**kwargs)),
+                self.current_hedge_delay(),
+                on_first_item=on_first_item,
+            )
+            if not recorded:
+                # 空のストリームも上流は応答している
+                recorded = True
+                self.breaker.record_success()
+        except GeneratorExit:
+            raise
+        except Exception as e:
+            if not recorded:
+                recorded = True
+                self._record_error(e)
+            raise
+        finally:
+            # 最初のトークンの前に閉じられた場合は、check()で取った試行枠を返す
+            if not recorded:
+                self.breaker.release()
+
+    def predict(self, message):
+        # langchain側でもリトライするため、ここではサーキットブレーカーだけ使う
+        self.breaker.check()
+        try:
+            response = self.chain.predict(input=str(message), history=[])
+        except Exception as e:
+            self._record_error(e)
+            raise
+        self.breaker.record_success()
+        return response
+
+    def warm_up(self, connect=False):
+        self.openai
+        self.prompt
+        if self.api_key:
+            self.chain
+        if connect:
+            # TLS接続を確立してプールに入れておく。起動を遅らせないよう別スレッドで行う。
+            threading.Thread(target=self._connect, daemon=True).start()
+
+    def _connect(self):
+        try:
+            self.http_session.head(self.openai.api_base, timeout=self.timeout)
+        except Exception as e:
+            from flask_chat_server import event_log
+
+            event_log.warning("chat_client.warmup_failed", error=str(e))
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import threading
+
+"""
+    同じプロンプトに対する同時の回答生成を1本にまとめる（single-flight）。
+    最初のリクエストがOpenAIへのストリームを開始し、生成中に同じプロンプトで来たリクエストは
+    そのストリームの出力（Chunk）を受け取る。途中から参加した場合は先頭から再生される。
+    DBへの保存はリクエストごとに行う（save_answer）ため、各セッションにMessageが保存される。
+    受信者が全員切断した場合は生成を中止してOpenAIへのストリームを閉じ、
+    中止した回数と、生成せずに済んだトークン数（max_tokensからの推定）を記録する。
+"""
+
+
+def make_key(kind, history):
+    payload = json.dumps([kind, history], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Flight:
+    def __init__(self, key, chunks, budget=None):
+        self.key = key
+        self.upstream = chunks
+        self.budget = budget  # 生成するトークン数の上限（max_tokens）
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.cancelled = False
+        self.aborted = False  # 生成の途中で中止した
+        self.condition = threading.Condition()
+
+    def run(self, on_finish):
+        try:
+            for chunk in self.upstream:
+                with self.condition:
+                    if self.cancelled:
+                        self.aborted = True
+                        break
+                    self.chunks.append(chunk)
+                    self.condition.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            close = getattr(self.upstream, "close", None)
+            if close is not None:
+                close()
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+            on_finish(self)
+
+    def subscribe(self):
+        index = 0
+        try:
+            while True:
+                with self.condition:
+                    while index >= len(self.chunks) and not self.done:
+                        self.condition.wait()
+                    pending = self.chunks[index:]
+                    finished = self.done
+                index += len(pending)
+                for chunk in pending:
+                    yield chunk
+                if finished and index >= len(self.chunks):
+                    break
+            if self.error is not None:
+                raise self.error
+        finally:
+            self._leave()
+
+    def _leave(self):
+        with self.condition:
+            self.subscribers -= 1
+            # 受信者がいなくなった場合は生成を止める
+            if self.subscribers == 0 and not self.done:
+                self.cancelled = True
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.cancelled = 0
+        self.tokens_before_cancel = 0
+        self.tokens_saved = 0
+
+    def stream(self, key, factory, budget=None):
+        # factoryは回答のジェネレーターを作る関数。同じkeyの生成中がなければ呼ばれる。
+        # budgetはfactoryのリクエストのmax_tokens。中止した場合に節約したトークン数の推定に使う。
+        # 参加（受信者数の加算とfactoryの呼び出し）は最初に読み出したときに行う。
+        # 読み出す前に閉じられた場合は何もしていないため、受信者数が残らない。
+        flight, leader = self._join(key, factory, budget)
+        if leader:
+            threading.Thread(target=flight.run, args=(self._finish,), daemon=True).start()
+        yield from flight.subscribe()
+
+    def _join(self, key, factory, budget):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None or flight.cancelled:
+                flight = Flight(key, factory(), budget)
+                self._flights[key] = flight
+                leader = True
+            else:
+                leader = False
+            with flight.condition:
+                flight.subscribers += 1
+        return flight, leader
+
+    def _finish(self, flight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            if flight.aborted:
+                # OpenAIの1回の差分をおおよそ1トークンとして数える
+                generated = sum(1 for chunk in flight.chunks if chunk.text)
+                self.cancelled += 1
+                self.tokens_before_cancel += generated
+                if flight.budget is not None:
+                    self.tokens_saved += max(0, flight.budget - generated)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "cancelled": self.cancelled,
+                "tokens_before_cancel": self.tokens_before_cancel,
+                "tokens_saved": self.tokens_saved,
+            }
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,216 @@
+import json
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import click
+from pytz import timezone
+from sqlalchemy import func
+
+from flask_chat_server import db, event_log, known_sessions, require_tables
+from flask_chat_server.models import ArchivedSession, Message, UserSession
+
+"""
+    一定期間（TTL）使われていないチャットセッションの整理。
+    最後のメッセージ（メッセージがない場合はセッションの作成日時）からTTL以上経ったセッションを、
+    メッセージと一緒にarchived_sessionsテーブルへ1行にまとめて保存（JSONをzlibで圧縮）し、
+    usersessions・messagesから削除する。
+    batch_size件ずつ短いトランザクションで処理し、バッチの間はpause秒待つため、
+    チャットの書き込みを長く止めることはない。
+
+    実行方法
+        archived_sessionsテーブルは、事前に flask create-tables で作成しておくこと。
+        flask compact-sessions [--ttl-days N] [--batch-size N] [--dry-run]
+        SESSION_COMPACTION_INTERVALを設定すると、その間隔（秒）でバックグラウンドのスレッドでも実行する。
+        複数のプロセスで動かす場合、スレッドは1つのプロセスだけで有効にすること。
+
+    設定（app.config）
+        SESSION_IDLE_TTL_DAYS           この日数使われていないセッションを整理する
+        SESSION_COMPACTION_BATCH        1つのトランザクションで処理するセッション数
+        SESSION_COMPACTION_PAUSE        バッチの間に待つ秒数
+        SESSION_COMPACTION_INTERVAL     バックグラウンドで実行する間隔（秒）。0の場合は実行しない
+        SESSION_COMPACTION_AUTOSTART    Falseの場合、create_appではスレッドを開始しない
+                                        （start_compaction_threadを呼び出したプロセスで実行する）
+"""
+
+
+def now():
+    return datetime.now(timezone("Asia/Tokyo"))
+
+
+def idle_sessions(cutoff, limit):
+    # cutoff以降のメッセージがなく、cutoffより前に作成されたセッション
+    recent = (
+        db.session.query(Message.message_id)
+        .filter(Message.session_id == UserSession.session_id)
+        .filter(Message.create_at >= cutoff)
+        .exists()
+    )
+    return (
+        UserSession.query.filter(UserSession.created_at < cutoff)
+        .filter(~recent)
+        .order_by(UserSession.created_at)
+        .limit(limit)
+        .all()
+    )
+
+
+def pack_messages(messages):
+    rows = [
+        {
+            "chat_history_id": m.chat_history_id,
+            "user_id": m.user_id,
+            "chat_id": m.chat_id,
+            "content": m.content,
+            "role": m.role,
+            "create_at": m.create_at.isoformat() if m.create_at else None,
+            "action": m.action,
+        }
+        for m in messages
+    ]
+    return zlib.compress(json.dumps(rows, ensure_ascii=False).encode("utf-8"))
+
+
+def unpack_messages(data):
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+def archive_batch(cutoff, batch_size):
+    # 1バッチ分を保存・削除してコミットし、処理したセッション数とメッセージ数を返す
+    sessions = idle_sessions(cutoff, batch_size)
+    if not sessions:
+        return 0, 0
+    ids = [s.session_id for s in sessions]
+    messages = (
+        Message.query.filter(Message.session_id.in_(ids))
+        .filter(Message.create_at < cutoff)
+        .order_by(Message.session_id, Message.chat_history_id, Message.message_id)
+        .all()
+    )
+    by_session = {}
+    for m in messages:
+        by_session.setdefault(m.session_id, []).append(m)
+
+    for s in sessions:
+        rows = by_session.get(s.session_id, [])
+        db.session.add(
+            ArchivedSession(
+                session_id=s.session_id,
+                user_id=s.user_id,
+                title=s.title,
+                important_info=s.important_info,
+                created_at=s.created_at,
+                last_active_at=rows[-1].create_at if rows else s.created_at,
+                message_count=len(rows),
+                messages=pack_messages(rows),
+            )
+        )
+
+    # 選択した後に届いたメッセージは削除しない。そのセッションも残す（以前の分だけ保存される）。
+    db.session.query(Message).filter(
+        Message.message_id.in_([m.message_id for m in messages])
+    ).delete(synchronize_session=False)
+    remaining = (
+        db.session.query(Message.message_id)
+        .filter(Message.session_id == UserSession.session_id)
+        .exists()
+    )
+    db.session.query(UserSession).filter(UserSession.session_id.in_(ids)).filter(
+        ~remaining
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    db.session.expunge_all()
+    known_sessions.discard(ids)
+    return len(sessions), len(messages)
+
+
+def compact_sessions(ttl_days, batch_size=200, pause=0.1, max_batches=None):
+    require_tables(ArchivedSession.__table__)
+    cutoff = now() - timedelta(days=ttl_days)
+    total_sessions = total_messages = batches = 0
+    while max_batches is None or batches < max_batches:
+        try:
+            sessions, messages = archive_batch(cutoff, batch_size)
+        except Exception:
+            db.session.rollback()
+            raise
+        if not sessions:
+            break
+        total_sessions += sessions
+        total_messages += messages
+        batches += 1
+        if pause:
+            time.sleep(pause)
+    return {"sessions": total_sessions, "messages": total_messages, "batches": batches}
+
+
+def count_idle_sessions(ttl_days):
+    cutoff = now() - timedelta(days=ttl_days)
+    recent = (
+        db.session.query(Message.message_id)
+        .filter(Message.session_id == UserSession.session_id)
+        .filter(Message.create_at >= cutoff)
+        .exists()
+    )
+    return (
+        db.session.query(func.count(UserSession.session_id))
+        .filter(UserSession.created_at < cutoff)
+        .filter(~recent)
+        .scalar()
+    )
+
+
+def init_app(app):
+    app.config.setdefault("SESSION_IDLE_TTL_DAYS", 30)
+    app.config.setdefault("SESSION_COMPACTION_BATCH", 200)
+    app.config.setdefault("SESSION_COMPACTION_PAUSE", 0.1)
+    app.config.setdefault("SESSION_COMPACTION_INTERVAL", 0)
+    app.config.setdefault("SESSION_COMPACTION_AUTOSTART", True)
+
+    @app.cli.command("compact-sessions")
+    @click.option("--ttl-days", type=float, default=None, help="使われていない日数")
+    @click.option("--batch-size", type=int, default=None, help="1回のトランザクションで処理するセッション数")
+    @click.option("--dry-run", is_flag=True, help="対象のセッション数だけ表示する")
+    def compact_sessions_command(ttl_days, batch_size, dry_run):
+        """使われていないチャットセッションを保存用のテーブルへ移動する。"""
+        ttl_days = ttl_days if ttl_days is not None else app.config["SESSION_IDLE_TTL_DAYS"]
+        if dry_run:
+            click.echo(f"対象のセッション: {count_idle_sessions(ttl_days)}件")
+            return
+        result = compact_sessions(
+            ttl_days,
+            batch_size or app.config["SESSION_COMPACTION_BATCH"],
+            app.config["SESSION_COMPACTION_PAUSE"],
+        )
+        click.echo(
+            f"{result['sessions']}件のセッション（メッセージ{result['messages']}件）を保存しました。"
+        )
+
+    # fork前に作成する場合（serve.py）、スレッドは子プロセスに引き継がれないため、
+    # SESSION_COMPACTION_AUTOSTARTをFalseにしてfork後のワーカーで開始する
+    if app.config["SESSION_COMPACTION_INTERVAL"] and app.config["SESSION_COMPACTION_AUTOSTART"]:
+        start_compaction_thread(app)
+
+
+def start_compaction_thread(app):
+    interval = app.config["SESSION_COMPACTION_INTERVAL"]
+
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    compact_sessions(
+                        app.config["SESSION_IDLE_TTL_DAYS"],
+                        app.config["SESSION_COMPACTION_BATCH"],
+                        app.config["SESSION_COMPACTION_PAUSE"],
+                    )
+                except Exception as e:
+                    event_log.error("compaction.failed", error=str(e))
+                finally:
+                    db.session.remove()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,588 @@
+import base64
+import binascii
+import os
+import random
+import re
+import statistics
+import threading
+import time
+import zlib
+from collections import Counter
+
+import click
+from sqlalchemy import Text, bindparam, select, type_coerce
+from sqlalchemy.types import TypeDecorator
+
+from flask_chat_server.main.vector_index import strip_tags
+
+"""
+    チャットのメッセージ（messages.content）とブログ記事の本文（blog_post.text）の圧縮保存。
+    列の型をCompressedTextにしておき、COMPRESSED_TEXT_COLUMNSに含めた列だけ、書き込み時に
+    zlib（raw deflate）で圧縮する。読み込み時は圧縮されている行だけ展開するため、
+    圧縮前の行・設定を外した後の行もそのまま読める（有効にしても既存の行は書き換えない）。
+    ブログ記事の本文は一覧のページでは使わないため、読み込みを遅延（deferred）して
+    表示するときだけ読み込み・展開する（models.BlogPost）。
+
+    ・辞書
+        短いメッセージはzlibだけではほとんど縮まないため、よく出てくる文（定型の回答・挨拶など）と
+        文字列を集めた辞書（zdict）を学習して使う（flask train-text-dictionary）。
+        辞書はtext_dictionariesテーブル（事前に flask create-tables で作成する）に保存し、
+        圧縮したデータの先頭に辞書のIDを入れる。
+        古い辞書も消さないため、辞書を学習し直しても以前の行は読める。
+        動いているプロセスはCOMPRESSED_TEXT_RELOAD秒ごとに、バックグラウンドのスレッドで新しい辞書を
+        読み込む（スレッドはプロセスごとに、最初に圧縮する値を書き込むときに始める）。
+    ・保存形式
+        先頭の2バイト（0xFF・辞書のID）の後にdeflateのデータを続ける。0xFFはUTF-8の文字列の
+        先頭には現れないため、圧縮していない行と区別できる。
+        SQLiteはTEXTの列にもバイト列をそのまま保存できるため、バイト列で保存する。
+        他のDB（MySQL・PostgreSQL）はTEXTにバイト列を保存できないため、"\\ue000"の後に
+        Base85で文字にして保存する（その分、縮む量は減る）。圧縮していない値が"\\ue000"で
+        始まる場合は、"\\ue000"をもう1つ前に付けて保存する（Base85の文字に"\\ue000"はないため区別できる）。
+        SQLiteでは文字列をそのまま返し、"\\ue000"は見ない。
+        圧縮しても小さくならない場合は、圧縮せずに保存する。
+        展開できない値（壊れたデータ・読み込めない辞書）は、圧縮したデータがテンプレート・
+        エクスポートなどにそのまま出ないよう、UNDECODABLEの文字列を返す。
+    ・既存の行の書き換え
+        flask compress-text で、主キーの順にCOMPRESSED_TEXT_MIGRATE_BATCH行ずつ
+        現在の設定・辞書で書き換える（--decompressで元に戻す）。バッチごとにコミットし、
+        バッチの間はCOMPRESSED_TEXT_MIGRATE_PAUSE秒待つ。読み込んだ後に変更された行・
+        展開できない行は書き換えない。
+        COMPRESSED_TEXT_MIGRATE_IN_BACKGROUNDを有効にすると、起動時にバックグラウンドのスレッドでも行う。
+    ・計測
+        flask benchmark-compressed-text で、行を抜き出して保存サイズと圧縮・展開の時間を比べる
+        （辞書なし・辞書あり。辞書は半分の行で学習し、残りの半分で計測する）。
+
+    ・検索用の本文
+        圧縮した行はDBのLIKEで検索できないため、blog_post.textを圧縮する場合は、タグを除いた本文を
+        圧縮せずにblog_post_search_textテーブルにも保存し、/searchはこのテーブルをLIKEで探す
+        （views.search）。記事の作成・更新・削除時に書き換え（views.refresh_post_indexes）、
+        既存の記事は flask build-search-text で作る（flask compress-text でblog_post.textを
+        圧縮した後にも作り直す）。
+
+    設定（app.config）
+        COMPRESSED_TEXT_COLUMNS                 圧縮する列（"messages.content"・"blog_post.text"）
+        COMPRESSED_TEXT_LEVEL                   zlibの圧縮レベル
+        COMPRESSED_TEXT_MIN_BYTES               これより短い値は圧縮しない
+        COMPRESSED_TEXT_DICT_SIZE               学習する辞書のバイト数（最大32KB）
+        COMPRESSED_TEXT_RELOAD                  新しい辞書を確認する間隔（秒）
+        COMPRESSED_TEXT_MIGRATE_BATCH           書き換えの1バッチの行数
+        COMPRESSED_TEXT_MIGRATE_PAUSE           書き換えのバッチの間に待つ秒数
+        COMPRESSED_TEXT_MIGRATE_IN_BACKGROUND   Trueの場合、起動時にバックグラウンドで書き換える
+"""
+
+MARKER = 0xFF
+TEXT_PREFIX = "\ue000"
+MAX_DICTIONARY_ID = 254
+# 展開できない値の代わりに返す文字列
+UNDECODABLE = "［この内容は読み込めませんでした］"
+DECODE_ERRORS = (ValueError, IndexError, KeyError, binascii.Error, zlib.error)
+# 文の区切り。区切りの文字は前の文に含める
+SENTENCE = re.compile(r"(?<=[。！？!?\n])")
+
+
+class CompressedText(TypeDecorator):
+    # column: "テーブル名.列名"。圧縮するかはTextCodecの設定で決める
+    impl = Text
+    cache_ok = True
+
+    def __init__(self, column, codec, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.column = column
+        self.codec = codec
+
+    def coerce_compared_value(self, op, value):
+        # LIKEなどで比べる値は圧縮しない
+        return Text()
+
+    def process_bind_param(self, value, dialect):
+        return self.codec.encode(self.column, value, dialect.name)
+
+    def process_result_value(self, value, dialect):
+        return self.codec.decode(value, dialect.name)
+
+
+def train_dictionary(texts, size):
+    # よく出てくる文と4文字の文字列を、縮む量（出現回数×バイト数）の大きい順に集める。
+    # zlibは近い位置（辞書の末尾）を参照するほど短く表せるため、縮む量の大きいものを末尾に置く
+    sentences, grams = Counter(), Counter()
+    for text in texts:
+        for sentence in SENTENCE.split(text):
+            sentence = sentence.strip()
+            if 2 <= len(sentence) <= 200:
+                sentences[sentence] += 1
+        grams.update(text[i : i + 4] for i in range(len(text) - 3))
+    candidates = [(count - 1, s) for s, count in sentences.items() if count >= 2]
+    candidates += [(count - 2, g) for g, count in grams.items() if count >= 3]
+    candidates.sort(key=lambda item: item[0] * len(item[1].encode("utf-8")), reverse=True)
+
+    chosen, chosen_text, total = [], "", 0
+    for _, text in candidates:
+        if text in chosen_text:
+            continue
+        data = text.encode("utf-8")
+        if total + len(data) > size:
+            if total >= size * 0.95:
+                break
+            continue
+        chosen.append(data)
+        chosen_text += "\n" + text
+        total += len(data)
+    return b"".join(reversed(chosen))
+
+
+def stored_length(payload, dialect_name):
+    # SQLite以外は、接頭辞（UTF-8で3バイト）とBase85（4バイトごとに5文字）で保存する
+    if dialect_name == "sqlite":
+        return len(payload)
+    return 3 + (len(payload) + 3) // 4 * 5
+
+
+class TextCodec:
+    def __init__(self, app=None):
+        self.app = None
+        self.columns = set()
+        self.level = 6
+        self.min_bytes = 32
+        self.dictionary_size = 16 * 1024
+        self.reload_interval = 300
+        self.dictionaries = {}
+        self.current = {}
+        self._loaded_at = None
+        self._reloader_pid = None
+        self._reloader_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("COMPRESSED_TEXT_COLUMNS", [])
+        app.config.setdefault("COMPRESSED_TEXT_LEVEL", 6)
+        app.config.setdefault("COMPRESSED_TEXT_MIN_BYTES", 32)
+        app.config.setdefault("COMPRESSED_TEXT_DICT_SIZE", 16 * 1024)
+        app.config.setdefault("COMPRESSED_TEXT_RELOAD", 300)
+        app.config.setdefault("COMPRESSED_TEXT_MIGRATE_BATCH", 500)
+        app.config.setdefault("COMPRESSED_TEXT_MIGRATE_PAUSE", 0.1)
+        app.config.setdefault("COMPRESSED_TEXT_MIGRATE_IN_BACKGROUND", False)
+        self.columns = set(app.config["COMPRESSED_TEXT_COLUMNS"])
+        self.level = app.config["COMPRESSED_TEXT_LEVEL"]
+        self.min_bytes = app.config["COMPRESSED_TEXT_MIN_BYTES"]
+        self.dictionary_size = min(app.config["COMPRESSED_TEXT_DICT_SIZE"], 32 * 1024)
+        self.reload_interval = app.config["COMPRESSED_TEXT_RELOAD"]
+        self._loaded_at = None
+        self._reloader_pid = None
+        self.app = app
+
+        @app.cli.command("train-text-dictionary")
+        @click.option("--column", default="messages.content", help="学習に使う列")
+        @click.option("--samples", default=5000, help="学習に使う行数")
+        def train_text_dictionary_command(column, samples):
+            """保存済みの行から圧縮用の辞書を学習し、以後の書き込みで使う。"""
+            dictionary_id, size = self.train(column, samples)
+            click.echo(f"{column}の辞書（ID {dictionary_id}、{size}バイト）を保存しました。")
+
+        @app.cli.command("compress-text")
+        @click.option("--column", default="messages.content", help="書き換える列")
+        @click.option("--batch-size", type=int, default=None, help="1回のトランザクションで書き換える行数")
+        @click.option("--decompress", is_flag=True, help="圧縮していない形式に戻す")
+        @click.option("--dry-run", is_flag=True, help="書き換える行数だけ表示する")
+        def compress_text_command(column, batch_size, decompress, dry_run):
+            """既存の行を現在の設定・辞書で圧縮し直す。"""
+            if not decompress and column not in self.columns:
+                raise click.UsageError(f"{column}はCOMPRESSED_TEXT_COLUMNSに含まれていません。")
+            result = self.migrate(
+                column,
+                batch_size or app.config["COMPRESSED_TEXT_MIGRATE_BATCH"],
+                app.config["COMPRESSED_TEXT_MIGRATE_PAUSE"],
+                decompress=decompress,
+                dry_run=dry_run,
+            )
+            if column == "blog_post.text" and not dry_run:
+                self.rebuild_search_text()
+            verb = "書き換える" if dry_run else "書き換えた"
+            click.echo(
+                f"{result['rows']}行のうち{result['changed']}行を{verb}"
+                f"（{result['bytes_before']:,} → {result['bytes_after']:,}バイト）。"
+            )
+            if result["skipped"]:
+                click.echo(f"展開できない{result['skipped']}行は書き換えませんでした。")
+
+        @app.cli.command("build-search-text")
+        def build_search_text_command():
+            """検索用の本文（blog_post_search_text）を全ての記事について作り直す。"""
+            click.echo(f"{self.rebuild_search_text()}件の記事の検索用の本文を作りました。")
+
+        @app.cli.command("benchmark-compressed-text")
+        @click.option("--column", default="messages.content", help="計測する列")
+        @click.option("--samples", default=2000, help="計測に使う行数")
+        def benchmark_compressed_text_command(column, samples):
+            """保存サイズと圧縮・展開の時間を、辞書なし・辞書ありで比べる。"""
+            for line in self.benchmark(column, samples):
+                click.echo(line)
+
+        if app.config["COMPRESSED_TEXT_MIGRATE_IN_BACKGROUND"] and self.columns:
+            self.start_migration_thread(app)
+
+    # ---- 辞書 ----
+
+    def start_reloader(self):
+        # このプロセスでまだ始めていない場合、辞書を読み込み直すスレッドを始める（fork後の子プロセスでも始める）
+        if self.app is None or self._reloader_pid == os.getpid():
+            return
+        with self._reloader_lock:
+            if self._reloader_pid == os.getpid():
+                return
+            self._reloader_pid = os.getpid()
+        threading.Thread(target=self._reload_loop, args=(self.app,), daemon=True).start()
+
+    def _reload_loop(self, app):
+        from flask_chat_server import event_log
+
+        while True:
+            with app.app_context():
+                try:
+                    self.load_dictionaries()
+                except Exception as e:
+                    # テーブルの作成前など。辞書なしで圧縮する
+                    event_log.warning("compressed_text.dictionary_load_failed", error=str(e))
+            time.sleep(self.reload_interval)
+
+    def load_dictionaries(self):
+        # 読み込み済みでない辞書だけDBから読み込む。列ごとに最新の辞書を以後の圧縮に使う
+        from flask_chat_server import db
+        from flask_chat_server.models import TextDictionary
+
+        table = TextDictionary.__table__
+        with db.engine.connect() as conn:
+            rows = conn.execute(select(table.c.id, table.c.column)).all()
+            missing = [i for i, _ in rows if i not in self.dictionaries]
+            if missing:
+                query = select(table.c.id, table.c.data).where(table.c.id.in_(missing))
+                for dictionary_id, data in conn.execute(query):
+                    self.dictionaries[dictionary_id] = bytes(data)
+        current = {}
+        for dictionary_id, column in rows:
+            current[column] = max(current.get(column, 0), dictionary_id)
+        self.current = current
+        self._loaded_at = time.monotonic()
+
+    def train(self, column, samples):
+        from flask_chat_server import db, require_tables
+        from flask_chat_server.models import TextDictionary
+
+        require_tables(TextDictionary.__table__)
+        self.load_dictionaries()
+        if self.dictionaries and max(self.dictionaries) >= MAX_DICTIONARY_ID:
+            raise click.ClickException("辞書の数が上限に達しています。")
+        texts = self.sample(column, samples)
+        data = train_dictionary(texts, self.dictionary_size)
+        entry = TextDictionary(column=column, data=data, sample_count=len(texts))
+        db.session.add(entry)
+        db.session.commit()
+        self.dictionaries[entry.id] = data
+        self.current[column] = entry.id
+        return entry.id, len(data)
+
+    # ---- 圧縮・展開 ----
+
+    def compress(self, data, dictionary_id=0):
+        dictionary = self.dictionaries.get(dictionary_id) if dictionary_id else None
+        if dictionary:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=dictionary)
+        else:
+            dictionary_id = 0
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        return bytes((MARKER, dictionary_id)) + compressor.compress(data) + compressor.flush()
+
+    def decompress(self, payload):
+        dictionary_id = payload[1]
+        if dictionary_id:
+            dictionary = self.dictionaries.get(dictionary_id)
+            if dictionary is None:
+                # 他のプロセスで学習した辞書。1回だけ読み込み直す
+                try:
+                    self.load_dictionaries()
+                except Exception as e:
+                    from flask_chat_server import event_log
+
+                    event_log.warning("compressed_text.dictionary_load_failed", error=str(e))
+                dictionary = self.dictionaries.get(dictionary_id)
+                if dictionary is None:
+                    raise KeyError(f"辞書（ID {dictionary_id}）がありません")
+            decompressor = zlib.decompressobj(-15, zdict=dictionary)
+        else:
+            decompressor = zlib.decompressobj(-15)
+        return decompressor.decompress(payload[2:]) + decompressor.flush()
+
+    def encode(self, column, value, dialect_name):
+        if value is None or not isinstance(value, str):
+            return value
+        data = value.encode("utf-8")
+        if column not in self.columns or len(data) < self.min_bytes:
+            return self._plain(value, dialect_name)
+        self.start_reloader()
+        payload = self.compress(data, self.current.get(column, 0))
+        if stored_length(payload, dialect_name) >= len(data):
+            return self._plain(value, dialect_name)
+        if dialect_name != "sqlite":
+            return TEXT_PREFIX + base64.b85encode(payload).decode("ascii")
+        return payload
+
+    def _plain(self, value, dialect_name):
+        # 圧縮しない値。SQLite以外で接頭辞から始まる値は、接頭辞をもう1つ付けて区別する
+        if dialect_name != "sqlite" and value.startswith(TEXT_PREFIX):
+            return TEXT_PREFIX + value
+        return value
+
+    def decode(self, value, dialect_name=None):
+        # dialect_nameがNoneの場合はSQLite以外として扱う。展開できない値はUNDECODABLEを返す
+        try:
+            return self._decode(value, dialect_name)
+        except DECODE_ERRORS as e:
+            from flask_chat_server import event_log
+
+            event_log.warning("compressed_text.decode_failed", error=str(e))
+            return UNDECODABLE
+
+    def _decode(self, value, dialect_name):
+        # 展開できない場合は例外を投げる（書き換え・学習では、展開できない行を飛ばす）
+        if isinstance(value, memoryview):
+            value = value.tobytes()
+        if isinstance(value, bytes):
+            if value[:1] == bytes((MARKER,)):
+                return self.decompress(value).decode("utf-8")
+            return value.decode("utf-8")
+        if dialect_name != "sqlite" and isinstance(value, str) and value.startswith(TEXT_PREFIX):
+            rest = value[len(TEXT_PREFIX) :]
+            if rest.startswith(TEXT_PREFIX):
+                return rest
+            return self.decompress(base64.b85decode(rest)).decode("utf-8")
+        return value
+
+    def stored_size(self, value):
+        if value is None:
+            return 0
+        return len(value) if isinstance(value, (bytes, memoryview)) else len(value.encode("utf-8"))
+
+    # ---- 既存の行 ----
+
+    def _column(self, column):
+        from flask_chat_server import db
+
+        table_name, column_name = column.split(".", 1)
+        table = db.Model.metadata.tables[table_name]
+        return table, table.primary_key.columns.values()[0], table.c[column_name]
+
+    def sample(self, column, limit):
+        # 列の値（展開したもの）を主キーの新しい順にlimit件
+        from flask_chat_server import db
+
+        table, pk, col = self._column(column)
+        query = select(type_coerce(col, Text())).where(col.isnot(None)).order_by(pk.desc()).limit(limit)
+        texts = []
+        with db.engine.connect() as conn:
+            for value, in conn.execute(query):
+                try:
+                    texts.append(self._decode(value, db.engine.dialect.name))
+                except DECODE_ERRORS:
+                    continue
+        return texts
+
+    def migrate(self, column, batch_size=500, pause=0.1, decompress=False, dry_run=False):
+        # 主キーの順にbatch_size行ずつ読み、現在の設定での保存形式と違う行だけ書き換える
+        from flask_chat_server import db
+
+        self.load_dictionaries()
+        table, pk, col = self._column(column)
+        raw = type_coerce(col, Text())
+        dialect_name = db.engine.dialect.name
+        update = (
+            table.update()
+            .where(pk == bindparam("_pk"))
+            .where(raw == bindparam("_old", type_=Text()))
+            .values({col.name: bindparam("_new", type_=Text())})
+        )
+        result = {
+            "rows": 0,
+            "changed": 0,
+            "skipped": 0,
+            "bytes_before": 0,
+            "bytes_after": 0,
+            "batches": 0,
+        }
+        last = None
+        while True:
+            query = select(pk, raw).where(col.isnot(None)).order_by(pk).limit(batch_size)
+            if last is not None:
+                query = query.where(pk > last)
+            with db.engine.connect() as conn:
+                rows = conn.execute(query).all()
+            if not rows:
+                break
+            last = rows[-1][0]
+            changes = []
+            for key, value in rows:
+                try:
+                    text = self._decode(value, dialect_name)
+                except DECODE_ERRORS as e:
+                    # 書き換えると元のデータを失うため、そのまま残す
+                    from flask_chat_server import event_log
+
+                    event_log.warning(
+                        "compressed_text.migrate_skipped", column=column, key=key, error=str(e)
+                    )
+                    result["skipped"] += 1
+                    continue
+                new = text if decompress else self.encode(column, text, dialect_name)
+                before, after = self.stored_size(value), self.stored_size(new)
+                result["rows"] += 1
+                result["bytes_before"] += before
+                result["bytes_after"] += after
+                if new != value:
+                    changes.append({"_pk": key, "_old": value, "_new": new})
+            result["changed"] += len(changes)
+            result["batches"] += 1
+            if changes and not dry_run:
+                with db.engine.begin() as conn:
+                    conn.execute(update, changes)
+            if pause and not dry_run:
+                time.sleep(pause)
+        return result
+
+    def start_migration_thread(self, app):
+        # 起動時に1回だけ、圧縮する列の既存の行を書き換える
+        def run():
+            from flask_chat_server import event_log
+
+            with app.app_context():
+                for column in sorted(self.columns):
+                    try:
+                        self.migrate(
+                            column,
+                            app.config["COMPRESSED_TEXT_MIGRATE_BATCH"],
+                            app.config["COMPRESSED_TEXT_MIGRATE_PAUSE"],
+                        )
+                    except Exception as e:
+                        event_log.error(
+                            "compressed_text.migrate_failed", column=column, error=str(e)
+                        )
+                if "blog_post.text" in self.columns:
+                    try:
+                        self.rebuild_search_text()
+                    except Exception as e:
+                        event_log.error("compressed_text.search_text_failed", error=str(e))
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    # ---- 検索用の本文 ----
+
+    @property
+    def search_text_enabled(self):
+        return "blog_post.text" in self.columns
+
+    def search_condition(self, searchtext):
+        # /searchで本文を探す条件。圧縮する場合は検索用の本文のテーブルを探す
+        from flask_chat_server.models import BlogPost, BlogPostSearchText
+
+        if not self.search_text_enabled:
+            return BlogPost.text.contains(searchtext)
+        return BlogPost.id.in_(
+            select(BlogPostSearchText.post_id).where(
+                BlogPostSearchText.text.contains(searchtext)
+            )
+        )
+
+    def update_search_text(self, post):
+        from flask_chat_server import db
+        from flask_chat_server.models import BlogPostSearchText
+
+        if not self.search_text_enabled:
+            return
+        db.session.merge(BlogPostSearchText(post_id=post.id, text=strip_tags(post.text or "")))
+        db.session.commit()
+
+    def remove_search_text(self, post_id):
+        from flask_chat_server import db
+        from flask_chat_server.models import BlogPostSearchText
+
+        if not self.search_text_enabled:
+            return
+        BlogPostSearchText.query.filter_by(post_id=post_id).delete()
+        db.session.commit()
+
+    def rebuild_search_text(self, batch_size=200):
+        # 全ての記事の検索用の本文を、主キーの順にbatch_size件ずつ作り直す
+        from sqlalchemy.orm import undefer
+
+        from flask_chat_server import db, require_tables
+        from flask_chat_server.models import BlogPost, BlogPostSearchText
+
+        require_tables(BlogPostSearchText.__table__)
+        BlogPostSearchText.query.filter(
+            ~BlogPostSearchText.post_id.in_(select(BlogPost.id))
+        ).delete(synchronize_session=False)
+        count, last = 0, None
+        while True:
+            query = BlogPost.query.options(undefer(BlogPost.text)).order_by(BlogPost.id)
+            if last is not None:
+                query = query.filter(BlogPost.id > last)
+            posts = query.limit(batch_size).all()
+            if not posts:
+                break
+            for post in posts:
+                db.session.merge(
+                    BlogPostSearchText(post_id=post.id, text=strip_tags(post.text or ""))
+                )
+            db.session.commit()
+            count += len(posts)
+            last = posts[-1].id
+        return count
+
+    # ---- 計測 ----
+
+    def benchmark(self, column, samples):
+        from flask_chat_server import db
+
+        dialect_name = db.engine.dialect.name
+        texts = self.sample(column, samples)
+        if len(texts) < 2:
+            return [f"{column}の行が足りません。"]
+        random.Random(0).shuffle(texts)
+        half = len(texts) // 2
+        train, test = texts[:half], texts[half:]
+        raw = [text.encode("utf-8") for text in test]
+        raw_bytes = sum(len(data) for data in raw)
+
+        saved = dict(self.dictionaries)
+        self.dictionaries[MAX_DICTIONARY_ID + 1] = train_dictionary(train, self.dictionary_size)
+        lines = [
+            f"{column}: 計測 {len(test)}行（辞書の学習 {len(train)}行、{dialect_name}の保存形式）",
+            f"{'':12}{'保存サイズ':>16}{'比率':>8}{'圧縮 µs/行':>14}{'展開 µs/行 (p50/p99)':>24}",
+            f"{'圧縮なし':12}{raw_bytes:>16,}{1.0:>8.2f}{'-':>14}{'-':>24}",
+        ]
+        try:
+            for name, dictionary_id in (("辞書なし", 0), ("辞書あり", MAX_DICTIONARY_ID + 1)):
+                stored, decode_times = 0, []
+                start = time.perf_counter()
+                payloads = [self.compress(data, dictionary_id) for data in raw]
+                encode_time = (time.perf_counter() - start) / len(raw)
+                for data, payload in zip(raw, payloads):
+                    size = stored_length(payload, dialect_name)
+                    if len(data) < self.min_bytes or size >= len(data):
+                        # 圧縮しない行はそのまま保存する
+                        stored += len(data)
+                        continue
+                    stored += size
+                    start = time.perf_counter()
+                    self.decompress(payload)
+                    decode_times.append(time.perf_counter() - start)
+                decode_times = decode_times or [0.0]
+                p99 = sorted(decode_times)[int(len(decode_times) * 0.99)]
+                lines.append(
+                    f"{name:12}{stored:>16,}{raw_bytes / max(stored, 1):>8.2f}"
+                    f"{encode_time * 1e6:>14.1f}"
+                    f"{statistics.median(decode_times) * 1e6:>12.1f} / {p99 * 1e6:<9.1f}"
+                )
+        finally:
+            self.dictionaries = saved
+        return lines
@@ -0,0 +1,228 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from flask import g, has_request_context, request, session
+
+"""
+    チャットの処理のログ（構造化ログ）。print()の代わりに使う。
+    呼び出し側は記録をキューに入れるだけで、JSONへの変換と出力（標準出力・ファイル）は
+    バックグラウンドのスレッド（logging.handlers.QueueListener）で行う。
+    出力先が詰まってもリクエストやストリームは止まらず、キューが一杯の場合は記録を捨てて数える。
+    eventletで動いている場合も、出力はパッチされていない本来のスレッドで行う
+    （グリーンスレッドで書き込むと、パイプが詰まったときにワーカー全体が止まるため）。
+
+        event_log.info("save_chat", session_id=session_id, chars=len(message))
+
+    1行に1つのJSON（ts・level・event・request_id・session_id と指定した項目）を出力する。
+    request_idはリクエストのX-Request-IDヘッダー（ない場合は作成する）で、レスポンスのヘッダーにも返す。
+    バックグラウンドで生成する回答のストリームではリクエストがないため、
+    ids()で取り出した値を渡して同じリクエストのログとしてまとめる。
+
+    INFOの記録はイベントごとに間引ける（EVENT_LOG_SAMPLING）。
+    また、イベントごとに1秒あたりの件数の上限（EVENT_LOG_RATE_LIMIT）を超えた分は捨て、
+    次に出力する記録のsuppressedに捨てた件数を入れる。WARNING以上は間引かない。
+
+    設定（app.config）
+        EVENT_LOG_LEVEL       出力する最低のレベル（"INFO"など）
+        EVENT_LOG_FILE        出力するファイル。Noneの場合は標準出力
+        EVENT_LOG_QUEUE_SIZE  出力待ちの記録の最大数。超えた分は捨てる
+        EVENT_LOG_SAMPLING    イベントごとのINFOの記録を残す割合（{"chat_session": 0.1}など）
+        EVENT_LOG_RATE_LIMIT  イベントごとの1秒あたりの最大件数。0の場合は制限しない
+"""
+
+
+def original_modules():
+    # eventletでパッチされている場合は、本来のthreading・queueを使う
+    if "eventlet" in sys.modules:
+        from eventlet import patcher
+
+        if patcher.is_monkey_patched("thread"):
+            return patcher.original("threading"), patcher.original("queue")
+    import queue
+
+    return threading, queue
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "event": record.getMessage(),
+        }
+        data.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # キューが一杯でも待たずに捨てる。変換は出力側のスレッドで行うため、ここでは何もしない
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Exception:
+            self.dropped += 1
+
+
+class BackgroundListener(logging.handlers.QueueListener):
+    def __init__(self, queue, threading_module, *handlers):
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self._threading = threading_module
+
+    def start(self):
+        self._thread = self._threading.Thread(
+            target=self._monitor, name="event-log", daemon=True
+        )
+        self._thread.start()
+
+
+class EventLog:
+    def __init__(self, app=None):
+        self.logger = logging.getLogger("flask_chat_server.events")
+        self.logger.propagate = False
+        self.sampling = {}
+        self.rate_limit = 0
+        self.queue_size = 10000
+        self.stream = None
+        self._handler = None
+        self._listener = None
+        self._windows = {}
+        self._lock = threading.Lock()
+        # 終了時に残っている記録を出力する
+        atexit.register(self.stop)
+        # preloadしてからforkした場合（serve.py）、子プロセスには出力のスレッドがないため作り直す
+        os.register_at_fork(after_in_child=self._after_fork)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("EVENT_LOG_LEVEL", "INFO")
+        app.config.setdefault("EVENT_LOG_FILE", None)
+        app.config.setdefault("EVENT_LOG_QUEUE_SIZE", 10000)
+        app.config.setdefault("EVENT_LOG_SAMPLING", {"chat_session": 0.1, "save_chat": 0.1})
+        app.config.setdefault("EVENT_LOG_RATE_LIMIT", 50)
+        self.logger.setLevel(app.config["EVENT_LOG_LEVEL"])
+        self.sampling = dict(app.config["EVENT_LOG_SAMPLING"])
+        self.rate_limit = app.config["EVENT_LOG_RATE_LIMIT"]
+        self.queue_size = app.config["EVENT_LOG_QUEUE_SIZE"]
+        self.stream = app.config["EVENT_LOG_FILE"]
+        self.start()
+
+        app.before_request(self._begin_request)
+        app.after_request(self._end_request)
+
+    def start(self):
+        if self._listener is not None:
+            self.stop()
+        threading_module, queue_module = original_modules()
+        if self.stream:
+            output = logging.FileHandler(self.stream, encoding="utf-8")
+        else:
+            output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonFormatter())
+        queue = queue_module.Queue(self.queue_size)
+        self._handler = DroppingQueueHandler(queue)
+        self._listener = BackgroundListener(queue, threading_module, output)
+        self.logger.handlers = [self._handler]
+        self._listener.start()
+
+    def stop(self):
+        # 残っている記録を出力してから止める
+        listener, self._listener = self._listener, None
+        if listener is not None and listener._thread is not None:
+            if listener._thread.is_alive():
+                listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+
+    def _after_fork(self):
+        # 親プロセスのスレッドは子プロセスにないため、止めずに捨てる
+        if self._listener is not None:
+            self._listener = None
+            self.start()
+
+    def _begin_request(self):
+        g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+
+    def _end_request(self, response):
+        if "request_id" in g:
+            response.headers.setdefault("X-Request-ID", g.request_id)
+        return response
+
+    def ids(self, session_id=None, create=True):
+        # 現在のリクエストのrequest_idとsession_id。バックグラウンドのストリームへ渡して使う
+        request_id = None
+        if has_request_context():
+            request_id = g.get("request_id")
+            session_id = session_id or session.get("session_id")
+        if request_id is None and create:
+            request_id = uuid.uuid4().hex[:16]
+        return {"request_id": request_id, "session_id": session_id}
+
+    def _allow(self, event, level):
+        if level >= logging.WARNING:
+            return True, 0
+        rate = self.sampling.get(event, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            return False, 0
+        if not self.rate_limit:
+            return True, 0
+        now = int(time.monotonic())
+        with self._lock:
+            window, count, suppressed = self._windows.get(event, (now, 0, 0))
+            if window != now:
+                window, count = now, 0
+            if count >= self.rate_limit:
+                self._windows[event] = (window, count, suppressed + 1)
+                return False, 0
+            self._windows[event] = (window, count + 1, 0)
+            return True, suppressed
+
+    def log(self, level, event, ids=None, exc_info=None, **fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        allowed, suppressed = self._allow(event, level)
+        if not allowed:
+            return
+        session_id = fields.pop("session_id", None)
+        ids = dict(ids) if ids is not None else self.ids(session_id, create=False)
+        if session_id:
+            ids["session_id"] = session_id
+        fields = {**ids, **fields}
+        if suppressed:
+            fields["suppressed"] = suppressed
+        self.logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, **fields)
+
+    def stats(self):
+        return {
+            "queued": self._handler.queue.qsize() if self._handler else 0,
+            "dropped": self._handler.dropped if self._handler else 0,
+            "sampling": self.sampling,
+            "rate_limit": self.rate_limit,
+        }
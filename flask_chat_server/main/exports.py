@@ -0,0 +1,129 @@
+import csv
+import io
+import json
+import sys
+from datetime import datetime, timedelta
+
+import click
+
+from flask_chat_server import db
+from flask_chat_server.models import Inquiry, Message, UserSession
+
+"""
+    お問い合わせ・チャット履歴のエクスポート（CSV / JSONL）。
+    .all()で全件を読み込まず、サーバーサイドカーソル（stream_results）とyield_perで
+    batch_size行ずつ読みながら書き出すため、件数が多くてもメモリ使用量は一定で、
+    ダウンロードもすぐに始まる。
+    管理画面（/export/<kind>.<fmt>）と、CLI（flask export <kind>）から使用する。
+"""
+
+INQUIRY_FIELDS = ["id", "date", "name", "email", "title", "text"]
+MESSAGE_FIELDS = [
+    "message_id",
+    "session_id",
+    "chat_history_id",
+    "role",
+    "action",
+    "create_at",
+    "user_id",
+    "content",
+]
+SESSION_FIELDS = ["session_id", "user_id", "created_at", "title"]
+
+EXPORTS = {
+    "inquiries": (Inquiry, INQUIRY_FIELDS, Inquiry.date, Inquiry.id),
+    "messages": (Message, MESSAGE_FIELDS, Message.create_at, Message.message_id),
+    "sessions": (UserSession, SESSION_FIELDS, UserSession.created_at, UserSession.session_id),
+}
+FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+
+def parse_date(value):
+    # YYYY-MM-DD。空の場合はNone、形式が違う場合はValueError
+    if not value:
+        return None
+    return datetime.strptime(value, "%Y-%m-%d")
+
+
+def iter_rows(kind, start=None, end=None, session_id=None, batch_size=1000):
+    # startの日から、endの日の終わりまで
+    model, fields, date_column, order_column = EXPORTS[kind]
+    query = db.session.query(*(getattr(model, field) for field in fields))
+    if start is not None:
+        query = query.filter(date_column >= start)
+    if end is not None:
+        query = query.filter(date_column < end + timedelta(days=1))
+    if session_id and hasattr(model, "session_id"):
+        query = query.filter(model.session_id == session_id)
+    query = (
+        query.order_by(order_column)
+        .execution_options(stream_results=True)
+        .yield_per(batch_size)
+    )
+    for row in query:
+        yield row
+
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def to_csv(rows, fields, flush_rows=500):
+    # Excelで文字化けしないようBOMを付ける
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    writer.writerow(fields)
+    count = 0
+    for row in rows:
+        writer.writerow([_value(value) for value in row])
+        count += 1
+        if count % flush_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def to_jsonl(rows, fields, flush_rows=500):
+    lines = []
+    for row in rows:
+        record = {field: _value(value) for field, value in zip(fields, row)}
+        lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+        if len(lines) >= flush_rows:
+            yield "".join(lines)
+            lines = []
+    yield "".join(lines)
+
+
+def export(kind, fmt, start=None, end=None, session_id=None):
+    fields = EXPORTS[kind][1]
+    rows = iter_rows(kind, start, end, session_id)
+    if fmt == "csv":
+        return to_csv(rows, fields)
+    return to_jsonl(rows, fields)
+
+
+def init_app(app):
+    @app.cli.command("export")
+    @click.argument("kind", type=click.Choice(sorted(EXPORTS)))
+    @click.option("--format", "fmt", type=click.Choice(sorted(FORMATS)), default="csv")
+    @click.option("--start", default=None, help="開始日（YYYY-MM-DD）")
+    @click.option("--end", default=None, help="終了日（YYYY-MM-DD）")
+    @click.option("--session-id", default=None, help="チャットのセッションID")
+    @click.option("--output", "-o", type=click.Path(dir_okay=False), default=None)
+    def export_command(kind, fmt, start, end, session_id, output):
+        """お問い合わせ・チャット履歴をCSVまたはJSONLで書き出す。"""
+        try:
+            start, end = parse_date(start), parse_date(end)
+        except ValueError:
+            raise click.BadParameter("日付はYYYY-MM-DDの形式で指定してください。")
+        out = open(output, "w", encoding="utf-8", newline="") if output else sys.stdout
+        try:
+            for part in export(kind, fmt, start, end, session_id):
+                out.write(part)
+        finally:
+            if output:
+                out.close()
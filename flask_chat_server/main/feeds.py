@@ -0,0 +1,313 @@
+import hashlib
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from email.utils import format_datetime
+from urllib.parse import urlsplit
+from xml.sax.saxutils import escape
+
+from pytz import timezone, utc
+
+"""
+    RSSフィード（/feed.xml、カテゴリごとの/<id>/feed.xml）とサイトマップ（/sitemap.xml）。
+    記事・カテゴリごとのXMLの断片（RSSのitem、サイトマップのurl）をプロセス内に持ち、
+    記事・カテゴリの作成・更新・削除時にその断片だけを作り直す（views.refresh_post_indexes など）。
+    フィード・サイトマップの本文は、変更後の最初のリクエストで断片をつなげて作り、
+    FEED_CHUNK_SIZEバイトずつのチャンクとETag（本文のMD5）・Last-Modified（本文が変わった日時）を
+    保存しておく。
+    リクエストごとにDBを検索せず、記事が多くてもチャンクに分けて送り出す。
+    If-None-Match・If-Modified-Sinceが一致する場合は304を返す。
+
+    URLはリクエストのHostヘッダーではなく設定したFEED_BASE_URL（ない場合はSERVER_NAME）で作る
+    （保存した本文は全てのリクエストで共有するため、偽のHostヘッダーのURLが混ざらないようにする）。
+    断片は最初のリクエストで作る。他のワーカーでの変更は、FEED_TTL秒ごとにDBから作り直して反映する。
+    作り直しはバックグラウンドのスレッドで行い、終わるまでのリクエストには作り直す前の本文を返す。
+
+    設定（app.config）
+        FEED_BASE_URL     リンクのURLの基点（例: https://example.com）。ない場合はSERVER_NAMEを使う
+        FEED_TITLE        フィードのタイトル
+        FEED_DESCRIPTION  フィードの説明
+        FEED_ITEMS        フィードに含める最新記事の数
+        FEED_TTL          DBから断片を作り直す間隔（秒）
+        FEED_CHUNK_SIZE   本文を送り出すチャンクのバイト数
+"""
+
+TOKYO = timezone("Asia/Tokyo")
+
+PostEntry = namedtuple("PostEntry", ["category_id", "date", "item", "url"])
+Body = namedtuple("Body", ["chunks", "etag", "last_modified", "length"])
+
+
+def localize(date):
+    # DBの日時はタイムゾーンなし（日本時間）で保存されている
+    if date is None:
+        return None
+    return TOKYO.localize(date) if date.tzinfo is None else date
+
+
+def rss_item(post, category_name, link):
+    parts = [
+        "<item>",
+        f"<title>{escape(post.title or '')}</title>",
+        f"<link>{escape(link)}</link>",
+        f'<guid isPermaLink="true">{escape(link)}</guid>',
+    ]
+    date = localize(post.date)
+    if date is not None:
+        parts.append(f"<pubDate>{format_datetime(date)}</pubDate>")
+    if category_name:
+        parts.append(f"<category>{escape(category_name)}</category>")
+    parts.append(f"<description>{escape(post.summary or '')}</description>")
+    parts.append("</item>\n")
+    return "".join(parts)
+
+
+def sitemap_url(loc, date=None):
+    lastmod = f"<lastmod>{date.strftime('%Y-%m-%d')}</lastmod>" if date else ""
+    return f"<url><loc>{escape(loc)}</loc>{lastmod}</url>\n"
+
+
+class FeedCache:
+    def __init__(self, app=None):
+        self.title = "ブログ"
+        self.description = ""
+        self.items = 20
+        self.ttl = 600
+        self.chunk_size = 64 * 1024
+        self._urls = None
+        self._posts = None
+        self._categories = {}
+        self._bodies = {}
+        self._validators = {}
+        self._loaded_at = 0
+        self._changes = 0
+        self._reloading = False
+        self._app = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("FEED_BASE_URL", None)
+        app.config.setdefault("FEED_TITLE", "ブログ")
+        app.config.setdefault("FEED_DESCRIPTION", "")
+        app.config.setdefault("FEED_ITEMS", 20)
+        app.config.setdefault("FEED_TTL", 600)
+        app.config.setdefault("FEED_CHUNK_SIZE", 64 * 1024)
+        self.title = app.config["FEED_TITLE"]
+        self.description = app.config["FEED_DESCRIPTION"]
+        self.items = app.config["FEED_ITEMS"]
+        self.ttl = app.config["FEED_TTL"]
+        self.chunk_size = app.config["FEED_CHUNK_SIZE"]
+        self._app = app
+        self._posts = None
+        self._bodies = {}
+
+        base_url = app.config["FEED_BASE_URL"]
+        if not base_url and app.config.get("SERVER_NAME"):
+            base_url = f"{app.config['PREFERRED_URL_SCHEME']}://{app.config['SERVER_NAME']}"
+        if not base_url:
+            from flask_chat_server import event_log
+
+            event_log.warning("feeds.base_url_missing")
+            base_url = "http://localhost"
+        base = urlsplit(base_url)
+        self._urls = app.url_map.bind(
+            base.netloc, script_name=base.path or "/", url_scheme=base.scheme or "http"
+        )
+
+    def _url(self, endpoint, **values):
+        return self._urls.build(endpoint, values, force_external=True)
+
+    def _read(self):
+        # 全ての記事・カテゴリの断片をDBから作る（アプリケーションのコンテキストで呼び出す）
+        from flask_chat_server.models import BlogCategory, BlogPost
+
+        categories = {
+            category.id: self._category_entry(category)
+            for category in BlogCategory.query.order_by(BlogCategory.id)
+        }
+        posts = {
+            post.id: self._post_entry(post, categories)
+            for post in BlogPost.query.order_by(BlogPost.id).yield_per(500)
+        }
+        return categories, posts
+
+    def _install(self, categories, posts):
+        self._categories, self._posts = categories, posts
+        self._bodies = {}
+        self._loaded_at = time.monotonic()
+
+    def _ensure_loaded(self):
+        # 初回だけリクエストの中で作る。以降はFEED_TTL秒ごとにバックグラウンドで作り直す
+        if self._posts is None:
+            self._install(*self._read())
+        elif time.monotonic() - self._loaded_at > self.ttl and not self._reloading:
+            self._reloading = True
+            threading.Thread(target=self._reload, args=(self._changes,), daemon=True).start()
+
+    def _reload(self, changes):
+        from flask_chat_server import event_log
+
+        try:
+            with self._app.app_context():
+                categories, posts = self._read()
+            with self._lock:
+                self._install(categories, posts)
+                if self._changes != changes:
+                    # 読み込んでいる間にこのプロセスで変更した場合は、次のリクエストでもう一度作り直す
+                    self._loaded_at = 0
+        except Exception as e:
+            event_log.error("feeds.reload_failed", error=str(e))
+        finally:
+            with self._lock:
+                self._reloading = False
+
+    def _post_entry(self, post, categories):
+        category = categories.get(post.category_id)
+        url = self._url("main.blog_post", blog_post_id=post.id)
+        return PostEntry(
+            post.category_id,
+            localize(post.date),
+            rss_item(post, category[0] if category else None, url),
+            sitemap_url(url, localize(post.date)),
+        )
+
+    def _category_entry(self, category):
+        return (
+            category.category,
+            sitemap_url(self._url("main.category_posts", blog_category_id=category.id)),
+        )
+
+    def _set_post(self, post):
+        self._posts[post.id] = self._post_entry(post, self._categories)
+
+    def _set_category(self, category):
+        self._categories[category.id] = self._category_entry(category)
+
+    def _invalidate(self, *category_ids):
+        self._changes += 1
+        keys = ["feed", "sitemap", *(f"category:{category_id}" for category_id in category_ids)]
+        for key in keys:
+            self._bodies.pop(key, None)
+
+    def update_post(self, post):
+        with self._lock:
+            if self._posts is None:
+                return
+            old = self._posts.get(post.id)
+            self._set_post(post)
+            self._invalidate(post.category_id, old.category_id if old else None)
+
+    def remove_post(self, post_id):
+        with self._lock:
+            if self._posts is None:
+                return
+            old = self._posts.pop(post_id, None)
+            if old is not None:
+                self._invalidate(old.category_id)
+
+    def update_category(self, category):
+        # カテゴリ名は各記事のitemに含まれるため、そのカテゴリの記事のitemも作り直す
+        from flask_chat_server.models import BlogPost
+
+        with self._lock:
+            if self._posts is None:
+                return
+            self._set_category(category)
+            for post in BlogPost.query.filter_by(category_id=category.id):
+                self._set_post(post)
+            self._invalidate(category.id)
+
+    def remove_category(self, category_id):
+        with self._lock:
+            if self._posts is None:
+                return
+            self._categories.pop(category_id, None)
+            self._invalidate(category_id)
+
+    def body(self, key):
+        # key: "feed"、"category:<id>"、"sitemap"。カテゴリが存在しない場合はNone
+        with self._lock:
+            self._ensure_loaded()
+            body = self._bodies.get(key)
+            if body is None:
+                fragments = self._compose(key)
+                if fragments is None:
+                    return None
+                body = self._bodies[key] = self._to_body(key, fragments)
+            return body
+
+    def _compose(self, key):
+        if key == "sitemap":
+            latest = max((entry.date for entry in self._posts.values() if entry.date), default=None)
+            fragments = [
+                '<?xml version="1.0" encoding="UTF-8"?>\n',
+                '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n',
+                sitemap_url(self._url("main.index"), latest),
+            ]
+            fragments.extend(url for _, url in self._categories.values())
+            fragments.extend(entry.url for entry in self._posts.values())
+            fragments.append("</urlset>\n")
+            return fragments
+
+        title, link, self_link = self.title, self._url("main.index"), None
+        entries = self._posts.items()
+        if key.startswith("category:"):
+            category_id = int(key.split(":", 1)[1])
+            category = self._categories.get(category_id)
+            if category is None:
+                return None
+            title = f"{self.title} - {category[0]}"
+            link = self._url("main.category_posts", blog_category_id=category_id)
+            self_link = self._url("main.category_feed", blog_category_id=category_id)
+            entries = [(i, e) for i, e in entries if e.category_id == category_id]
+        else:
+            self_link = self._url("main.feed")
+        # 新しい記事から（日時がない・同じ場合はIDの大きい順）
+        latest = sorted(
+            entries,
+            key=lambda item: (item[1].date.timestamp() if item[1].date else 0, item[0]),
+            reverse=True,
+        )[: self.items]
+        last_build = latest[0][1].date if latest else None
+        fragments = [
+            '<?xml version="1.0" encoding="UTF-8"?>\n',
+            '<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom"><channel>\n',
+            f"<title>{escape(title)}</title>",
+            f"<link>{escape(link)}</link>",
+            f"<description>{escape(self.description)}</description>",
+            f'<atom:link href="{escape(self_link)}" rel="self" type="application/rss+xml"/>\n',
+        ]
+        if last_build is not None:
+            fragments.append(f"<lastBuildDate>{format_datetime(last_build)}</lastBuildDate>\n")
+        fragments.extend(entry.item for _, entry in latest)
+        fragments.append("</channel></rss>\n")
+        return fragments
+
+    def _to_body(self, key, fragments):
+        # 断片をchunk_sizeバイト程度のチャンクにまとめ、ETagを計算する
+        chunks, buffer, size = [], [], 0
+        digest = hashlib.md5()
+        for fragment in fragments:
+            data = fragment.encode("utf-8")
+            buffer.append(data)
+            size += len(data)
+            if size >= self.chunk_size:
+                chunks.append(b"".join(buffer))
+                buffer, size = [], 0
+        if buffer:
+            chunks.append(b"".join(buffer))
+        for chunk in chunks:
+            digest.update(chunk)
+        etag = digest.hexdigest()
+        # 記事の編集では記事の日時が変わらないため、Last-Modifiedは本文が変わった日時にする。
+        # 作り直しても内容が同じ場合は前回の日時のままにする。
+        previous = self._validators.get(key)
+        if previous is not None and previous[0] == etag:
+            last_modified = previous[1]
+        else:
+            last_modified = datetime.now(utc).replace(microsecond=0)
+            self._validators[key] = (etag, last_modified)
+        return Body(chunks, etag, last_modified, sum(len(chunk) for chunk in chunks))
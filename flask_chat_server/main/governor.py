@@ -0,0 +1,230 @@
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import jsonify, make_response
+from flask_limiter.util import get_remote_address
+from limits import parse
+
+"""
+    チャット用エンドポイントのリクエスト制限（Flask-Limiterの代わり）。
+    ・トークンバケットによるリクエスト数の制限（IPアドレスごと・セッションごと）
+    ・同時に開いているストリーム（/chat_sse, Socket.IO）の数の上限（IPアドレスごと・セッションごと）
+    制限に掛かったリクエストはDBやOpenAIへのアクセスの前に429を返す。
+
+    設定（app.config）
+        CHAT_GOVERNOR_STORAGE_URI       memory://（プロセス内）または redis://...（ワーカー間で共有）
+        CHAT_RATE_LIMIT                 "6 per minute" のような形式。回数がバケットの容量になる
+        CHAT_MAX_STREAMS_PER_SESSION    セッションごとの同時ストリーム数
+        CHAT_MAX_STREAMS_PER_IP         IPアドレスごとの同時ストリーム数
+    プロキシの後ろで動かす場合は、request.remote_addrが正しくなるようにProxyFixを設定すること。
+"""
+
+
+class MemoryBackend:
+    # プロセス内の辞書で管理する。ワーカーが1つの場合やテスト用。
+    MAX_KEYS = 100000
+
+    def __init__(self):
+        self._buckets = {}
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def take(self, keys, rate, burst):
+        # 全てのバケットにトークンがある場合だけ、それぞれから1つずつ取る
+        now = time.monotonic()
+        with self._lock:
+            buckets = {}
+            for key in keys:
+                tokens, updated_at = self._buckets.get(key, (burst, now))
+                buckets[key] = min(burst, tokens + (now - updated_at) * rate)
+            allowed = all(tokens >= 1 for tokens in buckets.values())
+            for key, tokens in buckets.items():
+                self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if len(self._buckets) > self.MAX_KEYS:
+                self._prune(now, rate, burst)
+        return allowed
+
+    def _prune(self, now, rate, burst):
+        # 満タンまで回復したバケットは初期状態と同じなので削除してよい
+        full = [
+            key
+            for key, (tokens, updated_at) in self._buckets.items()
+            if tokens + (now - updated_at) * rate >= burst
+        ]
+        for key in full:
+            del self._buckets[key]
+
+    def acquire(self, key, limit):
+        with self._lock:
+            count = self._streams.get(key, 0)
+            if count >= limit:
+                return False
+            self._streams[key] = count + 1
+        return True
+
+    def release(self, key):
+        with self._lock:
+            count = self._streams.get(key, 0) - 1
+            if count > 0:
+                self._streams[key] = count
+            else:
+                self._streams.pop(key, None)
+
+
+class RedisBackend:
+    # 複数のワーカー・サーバーで制限を共有する。
+    TOKEN_BUCKET_SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local buckets = {}
+        local allowed = 1
+        for i, key in ipairs(KEYS) do
+            local state = redis.call("HMGET", key, "tokens", "ts")
+            local tokens = tonumber(state[1]) or burst
+            local ts = tonumber(state[2]) or now
+            tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+            if tokens < 1 then
+                allowed = 0
+            end
+            buckets[i] = tokens
+        end
+        for i, key in ipairs(KEYS) do
+            redis.call("HSET", key, "tokens", buckets[i] - allowed, "ts", now)
+            redis.call("EXPIRE", key, math.ceil(burst / rate) + 1)
+        end
+        return allowed
+    """
+
+    # ワーカーが異常終了して解放されなかったカウンターもこの時間で消える
+    STREAM_TTL = 3600
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self._take = self.client.register_script(self.TOKEN_BUCKET_SCRIPT)
+
+    def take(self, keys, rate, burst):
+        keys = [f"governor:bucket:{key}" for key in keys]
+        return bool(self._take(keys=keys, args=[rate, burst, time.time()]))
+
+    def acquire(self, key, limit):
+        name = f"governor:streams:{key}"
+        pipe = self.client.pipeline()
+        pipe.incr(name)
+        pipe.expire(name, self.STREAM_TTL)
+        count = pipe.execute()[0]
+        if count > limit:
+            self.client.decr(name)
+            return False
+        return True
+
+    def release(self, key):
+        self.client.decr(f"governor:streams:{key}")
+
+
+def make_backend(uri):
+    if uri and uri.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(uri)
+    return MemoryBackend()
+
+
+class Governor:
+    def __init__(self, app=None):
+        self.backend = MemoryBackend()
+        self.rate = 0.1
+        self.burst = 6
+        self.max_streams_per_session = 1
+        self.max_streams_per_ip = 4
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("CHAT_GOVERNOR_STORAGE_URI", "memory://")
+        app.config.setdefault("CHAT_RATE_LIMIT", "6 per minute")
+        app.config.setdefault("CHAT_MAX_STREAMS_PER_SESSION", 1)
+        app.config.setdefault("CHAT_MAX_STREAMS_PER_IP", 4)
+
+        self.backend = make_backend(app.config["CHAT_GOVERNOR_STORAGE_URI"])
+        limit = parse(app.config["CHAT_RATE_LIMIT"])
+        self.burst = limit.amount
+        self.rate = limit.amount / limit.get_expiry()
+        self.max_streams_per_session = app.config["CHAT_MAX_STREAMS_PER_SESSION"]
+        self.max_streams_per_ip = app.config["CHAT_MAX_STREAMS_PER_IP"]
+
+    def _keys(self, ip, session_id, scope="streams"):
+        keys = [f"{scope}:ip:{ip}"]
+        if session_id:
+            keys.append(f"{scope}:session:{session_id}")
+        return keys
+
+    def check(self, scope, ip, session_id=None):
+        # IPアドレスとセッションの両方のバケットからトークンを取る。
+        # どちらかが空の場合はどちらからも取らない（制限されたセッションがIPアドレスの枠を減らさない）。
+        # scope（エンドポイント名）ごとに別のバケットを使う。
+        return self.backend.take(self._keys(ip, session_id, scope), self.rate, self.burst)
+
+    def acquire_stream(self, ip, session_id=None):
+        # 取得できた場合は解放用の関数を返す。上限に達している場合はNone。
+        acquired = []
+        limits = [self.max_streams_per_ip, self.max_streams_per_session]
+        for key, limit in zip(self._keys(ip, session_id), limits):
+            if not self.backend.acquire(key, limit):
+                for k in acquired:
+                    self.backend.release(k)
+                return None
+            acquired.append(key)
+
+        released = threading.Event()
+
+        def release():
+            if released.is_set():
+                return
+            released.set()
+            for k in acquired:
+                self.backend.release(k)
+
+        return release
+
+    def too_many_requests(self):
+        response = jsonify({"error": "リクエストが多すぎます。しばらく時間をおいてからお試しください。"})
+        response.status_code = 429
+        response.headers["Retry-After"] = str(math.ceil(1 / self.rate))
+        return response
+
+    def limit(self, session_key=lambda: None, scope=None):
+        # session_keyはリクエストからsession_idを取り出す関数。
+        # scopeはバケットの名前で、省略した場合はビュー関数の名前を使う
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self.check(scope or view.__name__, get_remote_address(), session_key()):
+                    return self.too_many_requests()
+                return view(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def stream(self, session_key=lambda: None):
+        # レスポンスが閉じられる（ストリーム完了・切断）まで同時ストリーム数の枠を確保する
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                release = self.acquire_stream(get_remote_address(), session_key())
+                if release is None:
+                    return self.too_many_requests()
+                try:
+                    response = make_response(view(*args, **kwargs))
+                except Exception:
+                    release()
+                    raise
+                response.call_on_close(release)
+                return response
+
+            return wrapper
+
+        return decorator
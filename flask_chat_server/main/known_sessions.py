@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
+
+"""
+    DBに保存済みのチャットセッション（UserSession）のsession_idをプロセス内で覚えておく。
+    /save_chat・/chat_sseのたびにUserSessionを検索しないよう、まずここで確認し、
+    見つからない場合だけDBを検索する（views.session_exists）。
+    誤って「存在する」と判定すると存在しないセッションにメッセージを保存してしまうため、
+    ブルームフィルターではなく、誤判定のない上限付きのLRUにしている。
+    使われていないセッションはmain/compaction.pyで削除されるが、
+    ここに残るのはDBで確認してからKNOWN_SESSIONS_TTL秒（削除されるまでの日数より十分短い）だけなので、
+    削除済みのセッションを「存在する」と判定することはない。
+
+    設定（app.config）
+        KNOWN_SESSIONS_MAX  覚えておくsession_idの最大数
+        KNOWN_SESSIONS_TTL  DBで確認してから覚えておく秒数（使われても延ばさない）
+"""
+
+
+class KnownSessions:
+    def __init__(self, app=None):
+        self.max_entries = 100000
+        self.ttl = 3600
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("KNOWN_SESSIONS_MAX", 100000)
+        app.config.setdefault("KNOWN_SESSIONS_TTL", 3600)
+        self.max_entries = app.config["KNOWN_SESSIONS_MAX"]
+        self.ttl = app.config["KNOWN_SESSIONS_TTL"]
+
+    def add(self, session_id):
+        with self._lock:
+            self._entries[session_id] = time.monotonic() + self.ttl
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._entries.get(session_id)
+            if expires_at is None or expires_at < now:
+                if expires_at is not None:
+                    del self._entries[session_id]
+                self.misses += 1
+                return False
+            # 期限はDBで確認したときから延ばさない（削除済みのセッションを覚え続けないため）。
+            # LRUの順番だけ更新する
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            return True
+
+    def discard(self, session_ids):
+        with self._lock:
+            for session_id in session_ids:
+                self._entries.pop(session_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,238 @@
+import linecache
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+"""
+    動いているワーカーのCPU・メモリのプロファイリング（管理画面の/profiling）。
+    止めている間は何もしない（スレッドもtracemallocも動かさない）ため、負荷はかからない。
+
+    ・CPU
+        開始すると別スレッドでPROFILER_INTERVAL秒ごとに全スレッドのスタック（sys._current_frames）を取り、
+        同じスタックの回数を数える。結果はflamegraph.pl・speedscopeなどで読める
+        collapsed形式（「スレッド名;関数;関数 回数」の行）でダウンロードできる。
+        eventletで動いている場合、グリーンスレッドはすべて1つのOSのスレッドで動くため、
+        サンプリングにはパッチされていない本来のスレッドを使い、その時点で動いているグリーンスレッドの
+        スタックを記録する。止め忘れてもPROFILER_MAX_SECONDS秒で止まる。
+    ・メモリ
+        開始するとtracemallocで割り当てを記録し始める（記録中は割り当てごとに負荷がかかる）。
+        スナップショットを取り、割り当ての多い行の一覧と、2つのスナップショットの差分（増えた行）を
+        テキストでダウンロードできる。スナップショットは最新のPROFILER_MAX_SNAPSHOTS個だけ残す。
+    ワーカーが複数ある場合、結果はリクエストを受けたワーカーのもの（pidを表示する）。
+
+    設定（app.config）
+        PROFILER_INTERVAL           CPUのサンプリング間隔（秒）
+        PROFILER_MAX_SECONDS        CPUのサンプリングを自動で止めるまでの秒数
+        PROFILER_MAX_SNAPSHOTS      残すスナップショットの数
+        PROFILER_TRACEMALLOC_FRAMES tracemallocが記録するスタックの深さ
+"""
+
+
+def real_threading():
+    # eventletでパッチされている場合は、本来のthreading・timeを使う
+    if "eventlet" in sys.modules:
+        from eventlet import patcher
+
+        if patcher.is_monkey_patched("thread"):
+            return patcher.original("threading"), patcher.original("time")
+    return threading, time
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class CpuSampler:
+    def __init__(self):
+        self.counts = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.stopped_at = None
+        self.interval = 0.01
+        self._stop = None
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval, max_seconds):
+        if self.running:
+            return False
+        threading_module, time_module = real_threading()
+        self.counts = Counter()
+        self.samples = 0
+        self.interval = interval
+        self.started_at = time.time()
+        self.stopped_at = None
+        self._stop = threading_module.Event()
+        self._thread = threading_module.Thread(
+            target=self._run,
+            args=(self._stop, threading_module, time_module, max_seconds),
+            name="cpu-sampler",
+            daemon=True,
+        )
+        self._thread.start()
+        return True
+
+    def stop(self):
+        if not self.running:
+            return False
+        self._stop.set()
+        self._thread.join()
+        return True
+
+    def _run(self, stop, threading_module, time_module, max_seconds):
+        me = threading_module.get_ident()
+        names = {}
+        deadline = time_module.monotonic() + max_seconds
+        while not stop.wait(self.interval) and time_module.monotonic() < deadline:
+            frames = sys._current_frames()
+            if len(names) != len(frames):
+                names = {t.ident: t.name for t in threading_module.enumerate()}
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = collapse(frame)
+                self.counts[f"{names.get(ident, ident)};{stack}"] += 1
+            self.samples += 1
+        self.stopped_at = time.time()
+
+    def collapsed(self):
+        # flamegraph.plなどで読めるcollapsed形式。サンプリング中でも読めるよう複製してから並べる
+        counts = sorted(dict(self.counts).items(), key=lambda item: -item[1])
+        return "".join(f"{stack} {count}\n" for stack, count in counts)
+
+
+class MemoryTracer:
+    def __init__(self):
+        self.snapshots = []
+        self.max_snapshots = 10
+
+    @property
+    def running(self):
+        return tracemalloc.is_tracing()
+
+    def start(self, frames):
+        if self.running:
+            return False
+        self.snapshots = []
+        tracemalloc.start(frames)
+        return True
+
+    def stop(self):
+        if not self.running:
+            return False
+        tracemalloc.stop()
+        return True
+
+    def snapshot(self):
+        if not self.running:
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, linecache.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ]
+        )
+        self.snapshots.append((time.time(), snapshot))
+        del self.snapshots[: -self.max_snapshots]
+        return len(self.snapshots) - 1
+
+    def top(self, index=-1, limit=30, group="lineno"):
+        taken_at, snapshot = self.snapshots[index]
+        stats = snapshot.statistics(group)
+        total = sum(stat.size for stat in stats)
+        lines = [
+            f"# pid {os.getpid()} snapshot {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(taken_at))}",
+            f"# total {total / 1024:.1f} KiB in {len(stats)} {group}s",
+        ]
+        for stat in stats[:limit]:
+            lines.append(format_stat(stat, group))
+        return "\n".join(lines) + "\n"
+
+    def diff(self, base=0, index=-1, limit=30, group="lineno"):
+        base_at, base_snapshot = self.snapshots[base]
+        taken_at, snapshot = self.snapshots[index]
+        stats = snapshot.compare_to(base_snapshot, group)
+        growth = sum(stat.size_diff for stat in stats)
+        lines = [
+            f"# pid {os.getpid()} diff over {taken_at - base_at:.0f}s",
+            f"# growth {growth / 1024:+.1f} KiB",
+        ]
+        for stat in stats[:limit]:
+            lines.append(format_stat(stat, group, diff=True))
+        return "\n".join(lines) + "\n"
+
+    def status(self):
+        current, peak = tracemalloc.get_traced_memory() if self.running else (0, 0)
+        return {
+            "tracing": self.running,
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "snapshots": [
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(taken_at))
+                for taken_at, _ in self.snapshots
+            ],
+        }
+
+
+def format_stat(stat, group, diff=False):
+    if diff:
+        head = f"{stat.size_diff / 1024:+10.1f} KiB {stat.count_diff:+8d} blocks (now {stat.size / 1024:.1f} KiB)"
+    else:
+        head = f"{stat.size / 1024:10.1f} KiB {stat.count:8d} blocks"
+    frames = stat.traceback.format() if group == "traceback" else [str(stat.traceback[0])]
+    return f"{head}  " + "\n    ".join(frame.strip() for frame in frames)
+
+
+class Profiler:
+    def __init__(self, app=None):
+        self.cpu = CpuSampler()
+        self.memory = MemoryTracer()
+        self.interval = 0.01
+        self.max_seconds = 300
+        self.frames = 25
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("PROFILER_INTERVAL", 0.01)
+        app.config.setdefault("PROFILER_MAX_SECONDS", 300)
+        app.config.setdefault("PROFILER_MAX_SNAPSHOTS", 10)
+        app.config.setdefault("PROFILER_TRACEMALLOC_FRAMES", 25)
+        self.interval = app.config["PROFILER_INTERVAL"]
+        self.max_seconds = app.config["PROFILER_MAX_SECONDS"]
+        self.memory.max_snapshots = app.config["PROFILER_MAX_SNAPSHOTS"]
+        self.frames = app.config["PROFILER_TRACEMALLOC_FRAMES"]
+
+    def start_cpu(self, interval=None, seconds=None):
+        interval = max(interval or self.interval, 0.001)
+        seconds = min(seconds or self.max_seconds, self.max_seconds)
+        return self.cpu.start(interval, seconds)
+
+    def start_memory(self, frames=None):
+        return self.memory.start(frames or self.frames)
+
+    def status(self):
+        return {
+            "pid": os.getpid(),
+            "cpu": {
+                "running": self.cpu.running,
+                "interval": self.cpu.interval,
+                "samples": self.cpu.samples,
+                "stacks": len(self.cpu.counts),
+                "started_at": self.cpu.started_at,
+                "stopped_at": self.cpu.stopped_at,
+            },
+            "memory": self.memory.status(),
+        }
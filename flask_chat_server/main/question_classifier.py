@@ -0,0 +1,374 @@
+import json
+import os
+import random
+import threading
+import time
+import unicodedata
+import zlib
+from collections import namedtuple
+
+import click
+
+"""
+    質問の種別（general / related / other）のローカル分類器。
+    judge_user_question（views.py）は質問ごとにOpenAIのファンクションコーリングで種別を判断しているが、
+    分類器の確信度がQUESTION_CLASSIFIER_THRESHOLD以上の場合はその結果を使い、OpenAIを呼び出さない。
+
+    ・学習データ
+        OpenAIが判断した種別を、質問の文章とともにQUESTION_CLASSIFIER_LOG（JSONL）に追記していく。
+        利用者の質問をそのまま保存するため、記録はQUESTION_CLASSIFIER_LOGを設定した場合だけ行い、
+        文章はQUESTION_CLASSIFIER_LOG_MAX_CHARS文字までに切り詰める。
+        QUESTION_CLASSIFIER_LOG_DAYS日より古い記録は、flask prune-question-log（と学習の前）に削除する。
+    ・モデル
+        文字n-gram（1〜3文字）をハッシュでQUESTION_CLASSIFIER_DIM次元に割り当てた特徴量の
+        多クラスロジスティック回帰（ソフトマックス）。重みは次元数×種別数の行列で、
+        予測は特徴量の行だけを足し合わせるため、1件あたり数十マイクロ秒で終わる。
+    ・学習
+        flask train-question-classifier で、ログから学習し直してQUESTION_CLASSIFIER_MODEL（npz）に保存する。
+        一部を評価用に分けて、しきい値ごとの「ローカルで答えた割合」と「OpenAIの判断との一致率」を表示する。
+        動いているプロセスは、モデルのファイルの更新日時を見て読み込み直す。
+    ・一致率の計測
+        確信度が高い場合でもQUESTION_CLASSIFIER_AUDIT_RATEの割合でOpenAIにも判断させ、一致率を数える
+        （管理画面の/question_classifier）。
+
+    設定（app.config）
+        QUESTION_CLASSIFIER_ENABLED     Falseの場合は常にOpenAIで判断する
+        QUESTION_CLASSIFIER_MODEL       モデルのファイル
+        QUESTION_CLASSIFIER_LOG         OpenAIの判断を記録するファイル。None（既定）の場合は記録しない
+        QUESTION_CLASSIFIER_LOG_MAX_CHARS  記録する質問の最大の文字数
+        QUESTION_CLASSIFIER_LOG_DAYS    記録を残す日数
+        QUESTION_CLASSIFIER_THRESHOLD   ローカルの判断を使う確信度（ソフトマックスの確率）
+        QUESTION_CLASSIFIER_AUDIT_RATE  確信度が高い場合にもOpenAIに判断させる割合
+        QUESTION_CLASSIFIER_DIM         特徴量の次元数（学習時に使う）
+"""
+
+NGRAM = (1, 3)
+
+Prediction = namedtuple("Prediction", ["kind", "confidence", "confident"])
+
+
+def features(text, dim):
+    # 文字n-gramのハッシュ値と重み（1 + log(出現回数)、L2正規化）
+    import numpy as np
+
+    text = unicodedata.normalize("NFKC", text or "").lower().strip()
+    text = f"^{text}$"
+    counts = {}
+    for n in range(NGRAM[0], NGRAM[1] + 1):
+        for i in range(len(text) - n + 1):
+            h = zlib.crc32(text[i : i + n].encode("utf-8")) % dim
+            counts[h] = counts.get(h, 0) + 1
+    indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = 1.0 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+    values /= np.sqrt(np.dot(values, values))
+    return indices, values.astype(np.float32)
+
+
+def softmax(logits):
+    import numpy as np
+
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+def to_csr(texts, dim):
+    import numpy as np
+
+    rows = [features(text, dim) for text in texts]
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(indices) for indices, _ in rows], out=indptr[1:])
+    indices = np.concatenate([indices for indices, _ in rows])
+    values = np.concatenate([values for _, values in rows])
+    return indptr, indices, values
+
+
+def train(texts, labels, classes, dim, epochs=200, learning_rate=0.5, l2=1e-4):
+    # 全件の勾配によるAdaGrad。疎な特徴量の行列とW（dim×種別数）の積は、
+    # 非ゼロの要素ごとにWの行を取り出し、np.add.reduceatで行ごとに足し合わせる。
+    import numpy as np
+
+    indptr, indices, values = to_csr(texts, dim)
+    n, k = len(texts), len(classes)
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    y = np.zeros((n, k), dtype=np.float32)
+    y[np.arange(n), [classes.index(label) for label in labels]] = 1.0
+    weights = np.zeros((dim, k), dtype=np.float32)
+    bias = np.zeros(k, dtype=np.float32)
+    g_weights = np.full((dim, k), 1e-8, dtype=np.float32)
+    g_bias = np.full(k, 1e-8, dtype=np.float32)
+    for _ in range(epochs):
+        logits = np.add.reduceat(weights[indices] * values[:, None], indptr[:-1], axis=0) + bias
+        error = (softmax(logits) - y) / n
+        grad = np.stack(
+            [
+                np.bincount(indices, weights=values * error[rows, c], minlength=dim)
+                for c in range(k)
+            ],
+            axis=1,
+        ).astype(np.float32)
+        grad += l2 * weights
+        grad_bias = error.sum(axis=0)
+        g_weights += grad * grad
+        g_bias += grad_bias * grad_bias
+        weights -= learning_rate * grad / np.sqrt(g_weights)
+        bias -= learning_rate * grad_bias / np.sqrt(g_bias)
+    return weights, bias
+
+
+def predict_proba(weights, bias, texts, dim):
+    import numpy as np
+
+    indptr, indices, values = to_csr(texts, dim)
+    logits = np.add.reduceat(weights[indices] * values[:, None], indptr[:-1], axis=0) + bias
+    return softmax(logits)
+
+
+def prune_log(path, max_age):
+    # max_age秒より古い記録を削除する。書き込み中のプロセスがあるため、別名で書いてから置き換える
+    cutoff = time.time() - max_age
+    kept = removed = 0
+    tmp = path + ".tmp"
+    with open(path, encoding="utf-8") as f, open(tmp, "w", encoding="utf-8") as out:
+        for line in f:
+            try:
+                at = json.loads(line).get("at") or 0
+            except ValueError:
+                at = 0
+            if at < cutoff:
+                removed += 1
+                continue
+            out.write(line)
+            kept += 1
+    os.replace(tmp, path)
+    return kept, removed
+
+
+def read_log(path):
+    # 同じ質問が複数ある場合は最後の判断を使う
+    examples = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("text") and record.get("kind"):
+                examples[record["text"]] = record["kind"]
+    return list(examples.items())
+
+
+class QuestionClassifier:
+    def __init__(self, app=None):
+        self.enabled = True
+        self.model_path = None
+        self.log_path = None
+        self.log_max_chars = 200
+        self.log_days = 30
+        self.threshold = 0.9
+        self.audit_rate = 0.05
+        self.dim = 1 << 16
+        self.model = None
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._counts_lock = threading.Lock()
+        self.counts = {
+            "local": 0,
+            "upstream": 0,
+            "compared": 0,
+            "agreed": 0,
+            "audited": 0,
+            "audit_agreed": 0,
+        }
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("QUESTION_CLASSIFIER_ENABLED", True)
+        app.config.setdefault(
+            "QUESTION_CLASSIFIER_MODEL",
+            os.path.join(app.instance_path, "question_classifier.npz"),
+        )
+        app.config.setdefault("QUESTION_CLASSIFIER_LOG", None)
+        app.config.setdefault("QUESTION_CLASSIFIER_LOG_MAX_CHARS", 200)
+        app.config.setdefault("QUESTION_CLASSIFIER_LOG_DAYS", 30)
+        app.config.setdefault("QUESTION_CLASSIFIER_THRESHOLD", 0.9)
+        app.config.setdefault("QUESTION_CLASSIFIER_AUDIT_RATE", 0.05)
+        app.config.setdefault("QUESTION_CLASSIFIER_DIM", 1 << 16)
+        self.enabled = app.config["QUESTION_CLASSIFIER_ENABLED"]
+        self.model_path = app.config["QUESTION_CLASSIFIER_MODEL"]
+        self.log_path = app.config["QUESTION_CLASSIFIER_LOG"]
+        self.log_max_chars = app.config["QUESTION_CLASSIFIER_LOG_MAX_CHARS"]
+        self.log_days = app.config["QUESTION_CLASSIFIER_LOG_DAYS"]
+        self.threshold = app.config["QUESTION_CLASSIFIER_THRESHOLD"]
+        self.audit_rate = app.config["QUESTION_CLASSIFIER_AUDIT_RATE"]
+        self.dim = app.config["QUESTION_CLASSIFIER_DIM"]
+
+        @app.cli.command("train-question-classifier")
+        @click.option("--epochs", default=200, help="学習の繰り返し回数")
+        @click.option("--holdout", default=0.2, help="評価用に分ける割合")
+        def train_question_classifier_command(epochs, holdout):
+            """OpenAIの判断の記録から、質問の種別の分類器を学習する。"""
+            self.train_from_log(epochs, holdout)
+
+        @app.cli.command("prune-question-log")
+        def prune_question_log_command():
+            """QUESTION_CLASSIFIER_LOG_DAYS日より古い質問の種別の記録を削除する。"""
+            self.prune_log()
+
+    def _load(self):
+        # モデルのファイルがない場合はNone（常にOpenAIで判断する）
+        import numpy as np
+
+        try:
+            mtime = os.path.getmtime(self.model_path)
+        except OSError:
+            self.model, self._mtime = None, None
+            return
+        if mtime == self._mtime:
+            return
+        with np.load(self.model_path) as f:
+            self.model = (
+                f["weights"],
+                f["bias"],
+                f["classes"].tolist(),
+                int(f["dim"]),
+            )
+        self._mtime = mtime
+
+    def predict(self, text):
+        if not self.enabled or not text:
+            return None
+        with self._lock:
+            self._load()
+            model = self.model
+        if model is None:
+            return None
+        weights, bias, classes, dim = model
+        indices, values = features(text, dim)
+        probabilities = softmax(values @ weights[indices] + bias)
+        best = int(probabilities.argmax())
+        confidence = float(probabilities[best])
+        return Prediction(classes[best], confidence, confidence >= self.threshold)
+
+    def use_local(self, prediction):
+        # 確信度が高い場合はローカルの判断を使う。一致率を測るため一部はOpenAIにも判断させる
+        if prediction is None or not prediction.confident:
+            return False
+        if random.random() < self.audit_rate:
+            return False
+        self._count(local=1)
+        return True
+
+    def _count(self, **increments):
+        # 複数のスレッドから同時に数えるため、ロックを取って足す
+        with self._counts_lock:
+            for name, value in increments.items():
+                self.counts[name] += value
+
+    def record(self, text, kind, prediction=None):
+        # OpenAIの判断を記録し、ローカルの予測との一致を数える
+        if prediction is None:
+            self._count(upstream=1)
+        else:
+            agreed = int(prediction.kind == kind)
+            confident = int(prediction.confident)
+            self._count(
+                upstream=1,
+                compared=1,
+                agreed=agreed,
+                audited=confident,
+                audit_agreed=agreed * confident,
+            )
+        if not self.log_path or not kind:
+            return
+        line = json.dumps(
+            {
+                "text": (text or "")[: self.log_max_chars],
+                "kind": kind,
+                "local": prediction.kind if prediction else None,
+                "confidence": round(prediction.confidence, 4) if prediction else None,
+                "at": int(time.time()),
+            },
+            ensure_ascii=False,
+        )
+        try:
+            with self._log_lock:
+                os.makedirs(os.path.dirname(os.path.abspath(self.log_path)), exist_ok=True)
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+        except OSError as e:
+            from flask_chat_server import event_log
+
+            event_log.error("question_classifier.log_failed", error=str(e))
+
+    def prune_log(self):
+        if not self.log_path or not os.path.exists(self.log_path):
+            click.echo("質問の種別の記録がありません。")
+            return
+        with self._log_lock:
+            kept, removed = prune_log(self.log_path, self.log_days * 86400)
+        click.echo(f"{removed}件の古い記録を削除しました（残り{kept}件）。")
+
+    def stats(self):
+        with self._counts_lock:
+            counts = dict(self.counts)
+        total = counts["local"] + counts["upstream"]
+        counts["local_rate"] = counts["local"] / total if total else None
+        counts["agreement"] = counts["agreed"] / counts["compared"] if counts["compared"] else None
+        counts["audit_agreement"] = (
+            counts["audit_agreed"] / counts["audited"] if counts["audited"] else None
+        )
+        counts["threshold"] = self.threshold
+        counts["model_loaded"] = self.model is not None
+        return counts
+
+    def train_from_log(self, epochs=200, holdout=0.2):
+        import numpy as np
+
+        if not self.log_path or not os.path.exists(self.log_path):
+            click.echo("学習に使う記録がありません。")
+            return
+        self.prune_log()
+        examples = read_log(self.log_path)
+        classes = sorted({kind for _, kind in examples})
+        if len(classes) < 2:
+            click.echo("種別が2つ以上になるまで記録してください。")
+            return
+        random.Random(0).shuffle(examples)
+        n_test = int(len(examples) * holdout)
+        test, training = examples[:n_test], examples[n_test:]
+        click.echo(f"{len(training)}件で学習し、{len(test)}件で評価します（種別: {', '.join(classes)}）。")
+
+        if test:
+            weights, bias = train(
+                [t for t, _ in training], [k for _, k in training], classes, self.dim, epochs
+            )
+            probabilities = predict_proba(weights, bias, [t for t, _ in test], self.dim)
+            predicted = np.asarray(classes)[probabilities.argmax(axis=1)]
+            confidence = probabilities.max(axis=1)
+            correct = predicted == np.asarray([k for _, k in test])
+            click.echo(f"全体の一致率: {correct.mean():.3f}")
+            for threshold in sorted({0.5, 0.7, 0.8, 0.9, 0.95, self.threshold}):
+                confident = confidence >= threshold
+                agreement = correct[confident].mean() if confident.any() else float("nan")
+                click.echo(
+                    f"しきい値 {threshold:.2f}: ローカルで判断 {confident.mean():.3f}、一致率 {agreement:.3f}"
+                )
+
+        # 保存するモデルは全件で学習し直す
+        weights, bias = train(
+            [t for t, _ in examples], [k for _, k in examples], classes, self.dim, epochs
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(self.model_path)), exist_ok=True)
+        tmp = self.model_path + ".tmp.npz"
+        np.savez(
+            tmp,
+            weights=weights,
+            bias=bias,
+            classes=np.asarray(classes),
+            dim=np.asarray(self.dim),
+        )
+        os.replace(tmp, self.model_path)
+        click.echo(f"モデルを保存しました（{self.model_path}）。")
@@ -0,0 +1,476 @@
+import fcntl
+import os
+import re
+import tempfile
+import threading
+import unicodedata
+from contextlib import contextmanager
+
+import click
+from sqlalchemy.orm import undefer
+
+from flask_chat_server.main.vector_index import strip_tags
+
+"""
+    ブログ記事の関連記事。記事ごとに似ている記事の上位k件を事前に計算しておき、
+    記事のページ（views.blog_post）では計算済みの結果を引くだけにする。
+    記事のタイトル・概要・本文を文字n-gram（日本語は単語に分かれていないため）に分け、
+    TF-IDFの疎行列（CSR形式のindptr・indices・dataをnumpyの配列で持つ）を作る。
+    類似度は正規化したベクトルの内積（コサイン類似度）で、1記事分の類似度は
+    転置索引（CSC形式）からその記事の語を含む記事をまとめて取り出し、np.bincountで足し合わせる。
+
+    記事の作成・更新時はその記事だけをベクトルにし直し（語彙とIDFは既存のものを使う）、
+    関連記事が変わりうる記事（その記事が上位k件に入っていた記事・新しく入る記事）だけを計算し直す。
+    削除時はその記事が上位k件に入っていた記事だけを計算し直す（views.refresh_post_indexes）。
+    IDFは記事が増えると少しずつずれるため、flask build-related-postsで定期的に作り直すとよい。
+    結果はファイル（related.npz）に保存し、他のプロセスが更新した場合は更新日時を見て読み込み直す。
+    記事のページ（related）では読み込み直しを待たず、バックグラウンドのスレッドで読み込んでから
+    丸ごと入れ替える（それまでは読み込み済みの結果を使う）。ファイルがない場合の計算も同じく
+    バックグラウンドで行う（flask build-related-postsでも作れる）。記事の作成・更新・削除の
+    リクエストでは全件の計算はせず、ファイルがなければ何もしない（関連記事は表示されない）。
+    複数のプロセスが同時に読み込み・変更・保存しないよう、保存先のディレクトリのファイルロックを掛ける。
+    numpyは起動を遅くしないよう、初めて使うときにimportする。
+
+    設定（app.config）
+        RELATED_POSTS_ENABLED    Falseの場合は関連記事を表示しない
+        RELATED_POSTS_DIR        計算結果を保存するディレクトリ
+        RELATED_POSTS_TOP_K      記事ごとに保存する関連記事の数
+        RELATED_POSTS_MIN_SCORE  これより類似度が低い記事は表示しない
+        RELATED_POSTS_MAX_DF     これより多くの割合の記事に含まれる語は使わない
+"""
+
+NGRAM = (2, 3)
+# 保存するファイルの配列（語彙以外）
+SNAPSHOT_ARRAYS = (
+    "post_ids",
+    "indptr",
+    "indices",
+    "data",
+    "idf",
+    "neighbour_ids",
+    "neighbour_scores",
+)
+
+
+def post_document(post):
+    # タイトルは本文より重視するため2回含める
+    title = post.title or ""
+    text = f"{title}\n{title}\n{post.summary or ''}\n{strip_tags(post.text)}"
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text).lower())
+
+
+def char_ngrams(text):
+    for n in range(NGRAM[0], NGRAM[1] + 1):
+        for i in range(len(text) - n + 1):
+            yield text[i : i + n]
+
+
+def transpose(indptr, indices, data, n_terms):
+    # CSR形式からCSC形式（語ごとの記事の一覧）を作る
+    import numpy as np
+
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    order = np.argsort(indices, kind="stable")
+    colptr = np.zeros(n_terms + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=n_terms), out=colptr[1:])
+    return rows[order], data[order], colptr
+
+
+class RelatedPosts:
+    def __init__(self, app=None):
+        self.enabled = True
+        self.directory = None
+        self.top_k = 5
+        self.min_score = 0.05
+        self.max_df = 0.5
+        self.vocab = None
+        self._mtime = None
+        self._app = None
+        self._reloading = False
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("RELATED_POSTS_ENABLED", True)
+        app.config.setdefault(
+            "RELATED_POSTS_DIR", os.path.join(app.instance_path, "related_posts")
+        )
+        app.config.setdefault("RELATED_POSTS_TOP_K", 5)
+        app.config.setdefault("RELATED_POSTS_MIN_SCORE", 0.05)
+        app.config.setdefault("RELATED_POSTS_MAX_DF", 0.5)
+        self.enabled = app.config["RELATED_POSTS_ENABLED"]
+        self.configure(
+            app.config["RELATED_POSTS_DIR"],
+            app.config["RELATED_POSTS_TOP_K"],
+            app.config["RELATED_POSTS_MIN_SCORE"],
+            app.config["RELATED_POSTS_MAX_DF"],
+        )
+        self._app = app
+
+        @app.cli.command("build-related-posts")
+        def build_related_posts_command():
+            """ブログ記事の関連記事を計算し直す。"""
+            from flask_chat_server.models import BlogPost
+
+            count = self.rebuild(BlogPost.query.options(undefer(BlogPost.text)).yield_per(100))
+            click.echo(f"{count}件の記事の関連記事を計算しました。")
+
+    def configure(self, directory, top_k, min_score, max_df):
+        self.directory = directory
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_df = max_df
+        self.vocab = None
+        self._mtime = None
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, "related.npz")
+
+    # 記事はpost_idsの昇順に並べ、i行目がpost_ids[i]の記事を表す。
+    # 関連記事はneighbour_ids・neighbour_scores（記事数×top_k）に類似度の高い順に持ち、
+    # 足りない分はIDを-1にする。
+
+    def _vectorize(self, post):
+        # 記事を (語のID, TF) の配列にする。新しい語は語彙に加える
+        import numpy as np
+
+        ids = []
+        for gram in char_ngrams(post_document(post)):
+            term_id = self.vocab.get(gram)
+            if term_id is None:
+                term_id = self.vocab[gram] = len(self.vocab)
+            ids.append(term_id)
+        cols, counts = np.unique(np.asarray(ids, dtype=np.int64), return_counts=True)
+        return cols, (1.0 + np.log(counts)).astype(np.float32)
+
+    def _apply_idf(self, cols, tf):
+        import numpy as np
+
+        weights = tf * self.idf[cols]
+        keep = weights > 0
+        cols, weights = cols[keep], weights[keep]
+        norm = np.sqrt(np.dot(weights, weights))
+        return cols, weights / norm if norm > 0 else weights
+
+    def _transpose(self):
+        self.csc_rows, self.csc_data, self.colptr = transpose(
+            self.indptr, self.indices, self.data, len(self.idf)
+        )
+
+    def _similarities(self, cols, weights):
+        # 1記事分のベクトルと全記事とのコサイン類似度
+        import numpy as np
+
+        starts = self.colptr[cols]
+        lengths = self.colptr[cols + 1] - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return np.zeros(len(self.post_ids), dtype=np.float32)
+        # 各語の記事の一覧（CSCの範囲）をつなげた位置の配列を、ループなしで作る
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        positions = offsets + np.arange(total)
+        return np.bincount(
+            self.csc_rows[positions],
+            weights=self.csc_data[positions] * np.repeat(weights, lengths),
+            minlength=len(self.post_ids),
+        ).astype(np.float32)
+
+    def _row(self, i):
+        return self.indices[self.indptr[i] : self.indptr[i + 1]], self.data[
+            self.indptr[i] : self.indptr[i + 1]
+        ]
+
+    def _compute_neighbours(self, rows):
+        import numpy as np
+
+        k = self.top_k
+        for i in rows:
+            scores = self._similarities(*self._row(i))
+            scores[i] = -1.0
+            n = min(k, len(scores))
+            top = np.argpartition(-scores, n - 1)[:n] if n else np.zeros(0, dtype=np.int64)
+            top = top[np.argsort(-scores[top], kind="stable")]
+            top = top[scores[top] > 0]
+            self.neighbour_ids[i] = -1
+            self.neighbour_scores[i] = 0.0
+            self.neighbour_ids[i, : len(top)] = self.post_ids[top]
+            self.neighbour_scores[i, : len(top)] = scores[top]
+
+    def _empty(self):
+        import numpy as np
+
+        self.vocab = {}
+        self.idf = np.zeros(0, dtype=np.float32)
+        self.post_ids = np.zeros(0, dtype=np.int64)
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int64)
+        self.data = np.zeros(0, dtype=np.float32)
+        self.neighbour_ids = np.zeros((0, self.top_k), dtype=np.int64)
+        self.neighbour_scores = np.zeros((0, self.top_k), dtype=np.float32)
+
+    def _rebuild(self, posts):
+        import numpy as np
+
+        self._empty()
+        post_ids, rows = [], []
+        for post in sorted(posts, key=lambda post: post.id):
+            post_ids.append(post.id)
+            rows.append(self._vectorize(post))
+        n = len(post_ids)
+        self.post_ids = np.asarray(post_ids, dtype=np.int64)
+        lengths = np.asarray([len(cols) for cols, _ in rows], dtype=np.int64)
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.indptr[1:])
+        if n:
+            self.indices = np.concatenate([cols for cols, _ in rows])
+            tf = np.concatenate([tf for _, tf in rows])
+        else:
+            tf = np.zeros(0, dtype=np.float32)
+
+        # IDF。多くの記事に含まれる語は0にして使わない（語彙には残し、追加時に新しい語と扱わない）
+        df = np.bincount(self.indices, minlength=len(self.vocab))
+        self.idf = (np.log((1 + n) / (1 + df)) + 1).astype(np.float32)
+        self.idf[df > max(self.max_df * n, 2)] = 0.0
+
+        # TF-IDFを行ごとに正規化する。行ごとの二乗和はnp.add.reduceatでまとめて求める
+        data = tf * self.idf[self.indices]
+        keep = data > 0
+        row_of = np.repeat(np.arange(n), lengths)[keep]
+        self.indices, data = self.indices[keep], data[keep]
+        lengths = np.bincount(row_of, minlength=n)
+        self.indptr[1:] = np.cumsum(lengths)
+        norms = np.zeros(n, dtype=np.float32)
+        nonempty = lengths > 0
+        norms[nonempty] = np.sqrt(np.add.reduceat(data * data, self.indptr[:-1][nonempty]))
+        norms[norms == 0] = 1.0
+        self.data = (data / np.repeat(norms, lengths)).astype(np.float32)
+
+        self._transpose()
+        self.neighbour_ids = np.full((n, self.top_k), -1, dtype=np.int64)
+        self.neighbour_scores = np.zeros((n, self.top_k), dtype=np.float32)
+        self._compute_neighbours(range(n))
+        self._save()
+        return n
+
+    def rebuild(self, posts):
+        with self._lock, self._file_lock():
+            return self._rebuild(posts)
+
+    @contextmanager
+    def _file_lock(self):
+        # 複数のプロセスが同時に読み込み・変更・保存しないよう、ファイルロックを掛ける
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load(self):
+        # 保存済みの結果を開く（記事の作成・更新・削除時）。ない場合・関連記事の数の設定が
+        # 変わっている場合は作り直さずFalseを返す（バックグラウンドかflask build-related-postsで作る）
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime is not None and self.vocab is not None and mtime == self._mtime:
+            return True
+        snapshot = self._read() if mtime is not None else None
+        if snapshot is None:
+            from flask_chat_server import event_log
+
+            event_log.warning("related_posts.missing", path=self.path)
+            return False
+        self._install(snapshot)
+        return True
+
+    def _read(self):
+        # 保存済みの結果を読み込み、CSC形式まで作った状態（スナップショット）を返す。
+        # 関連記事の数の設定が変わっていて使えない場合はNone
+        import numpy as np
+
+        mtime = os.path.getmtime(self.path)
+        with np.load(self.path) as f:
+            snapshot = {name: f[name] for name in SNAPSHOT_ARRAYS}
+            vocab = f["vocab"].tolist()
+        if snapshot["neighbour_ids"].shape[1] != self.top_k:
+            return None
+        snapshot["vocab"] = {term: i for i, term in enumerate(vocab)}
+        snapshot["csc_rows"], snapshot["csc_data"], snapshot["colptr"] = transpose(
+            snapshot["indptr"], snapshot["indices"], snapshot["data"], len(snapshot["idf"])
+        )
+        snapshot["_mtime"] = mtime
+        return snapshot
+
+    def _install(self, snapshot):
+        for name, value in snapshot.items():
+            setattr(self, name, value)
+
+    def _reload_if_stale(self):
+        # 他のプロセスが更新した場合（またはまだ読み込んでいない場合）は、バックグラウンドで
+        # 読み込んでから入れ替える。それまでのリクエストは読み込み済みの結果（ない場合は空）を使う
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if self.vocab is not None and mtime == self._mtime:
+            return
+        with self._lock:
+            if self._reloading or self._app is None:
+                return
+            self._reloading = True
+        threading.Thread(target=self._reload, daemon=True).start()
+
+    def _reload(self):
+        from flask_chat_server import event_log
+
+        try:
+            snapshot = self._read() if os.path.exists(self.path) else None
+            if snapshot is None:
+                # ない場合・設定が変わった場合は、別のインスタンスで計算して保存してから読み込む
+                from flask_chat_server.models import BlogPost
+
+                builder = RelatedPosts()
+                builder.configure(self.directory, self.top_k, self.min_score, self.max_df)
+                with self._app.app_context():
+                    builder.rebuild(
+                        BlogPost.query.options(undefer(BlogPost.text)).yield_per(100)
+                    )
+                snapshot = self._read()
+            with self._lock:
+                # 読み込んでいる間にこのプロセスで更新した場合は、そちらを残す
+                if self._mtime is None or snapshot["_mtime"] > self._mtime:
+                    self._install(snapshot)
+        except Exception as e:
+            event_log.error("related_posts.reload_failed", error=str(e))
+        finally:
+            with self._lock:
+                self._reloading = False
+
+    def _save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # 読み込み中のプロセスがあるため、プロセスごとに別の名前で書き込んでから置き換える
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".related-", suffix=".npz")
+        os.close(fd)
+        vocab = sorted(self.vocab, key=self.vocab.get)
+        try:
+            self._write(tmp, vocab)
+            os.replace(tmp, self.path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._mtime = os.path.getmtime(self.path)
+
+    def _write(self, tmp, vocab):
+        import numpy as np
+
+        np.savez(
+            tmp,
+            post_ids=self.post_ids,
+            indptr=self.indptr,
+            indices=self.indices,
+            data=self.data,
+            idf=self.idf,
+            vocab=np.asarray(vocab, dtype=str) if vocab else np.zeros(0, dtype="<U1"),
+            neighbour_ids=self.neighbour_ids,
+            neighbour_scores=self.neighbour_scores,
+        )
+
+    def _remove_row(self, i):
+        import numpy as np
+
+        start, end = self.indptr[i], self.indptr[i + 1]
+        self.indices = np.concatenate([self.indices[:start], self.indices[end:]])
+        self.data = np.concatenate([self.data[:start], self.data[end:]])
+        self.indptr = np.concatenate([self.indptr[: i + 1], self.indptr[i + 2 :] - (end - start)])
+        self.post_ids = np.delete(self.post_ids, i)
+        self.neighbour_ids = np.delete(self.neighbour_ids, i, axis=0)
+        self.neighbour_scores = np.delete(self.neighbour_scores, i, axis=0)
+
+    def _insert_row(self, i, post_id, cols, weights):
+        import numpy as np
+
+        start = self.indptr[i]
+        self.indices = np.concatenate([self.indices[:start], cols, self.indices[start:]])
+        self.data = np.concatenate([self.data[:start], weights, self.data[start:]])
+        self.indptr = np.concatenate([self.indptr[: i + 1], self.indptr[i:] + len(cols)])
+        self.post_ids = np.insert(self.post_ids, i, post_id)
+        self.neighbour_ids = np.insert(self.neighbour_ids, i, -1, axis=0)
+        self.neighbour_scores = np.insert(self.neighbour_scores, i, 0.0, axis=0)
+
+    def _row_index(self, post_id):
+        import numpy as np
+
+        i = int(np.searchsorted(self.post_ids, post_id))
+        found = i < len(self.post_ids) and self.post_ids[i] == post_id
+        return i, found
+
+    def update_post(self, post):
+        import numpy as np
+
+        if not self.enabled:
+            return
+        with self._lock, self._file_lock():
+            if not self._load():
+                return
+            cols, tf = self._vectorize(post)
+            if len(self.idf) < len(self.vocab):
+                # 新しい語は1記事にだけ含まれる語としてIDFを決める
+                new_idf = np.log((2 + len(self.post_ids)) / 2) + 1
+                self.idf = np.concatenate(
+                    [self.idf, np.full(len(self.vocab) - len(self.idf), new_idf, dtype=np.float32)]
+                )
+            cols, weights = self._apply_idf(cols, tf)
+
+            i, found = self._row_index(post.id)
+            if found:
+                self._remove_row(i)
+            self._insert_row(i, post.id, cols, weights)
+            self._transpose()
+
+            # 上位k件にこの記事が入っていた記事と、新しく入る記事だけを計算し直す
+            scores = self._similarities(cols, weights)
+            threshold = np.maximum(self.neighbour_scores[:, -1], self.min_score)
+            affected = (self.neighbour_ids == post.id).any(axis=1) | (scores > threshold)
+            affected[i] = True
+            self._compute_neighbours(np.flatnonzero(affected))
+            self._save()
+
+    def remove_post(self, post_id):
+        import numpy as np
+
+        if not self.enabled:
+            return
+        with self._lock, self._file_lock():
+            if not self._load():
+                return
+            i, found = self._row_index(post_id)
+            if not found:
+                return
+            self._remove_row(i)
+            self._transpose()
+            affected = (self.neighbour_ids == post_id).any(axis=1)
+            self._compute_neighbours(np.flatnonzero(affected))
+            self._save()
+
+    def related(self, post_id):
+        # 計算済みの関連記事のIDを類似度の高い順に返す
+        if not self.enabled:
+            return []
+        self._reload_if_stale()
+        with self._lock:
+            if self.vocab is None:
+                return []
+            i, found = self._row_index(post_id)
+            if not found:
+                return []
+            ids, scores = self.neighbour_ids[i], self.neighbour_scores[i]
+        return [
+            int(related_id)
+            for related_id, score in zip(ids, scores)
+            if related_id >= 0 and score >= self.min_score
+        ]
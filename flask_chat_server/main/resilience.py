@@ -0,0 +1,188 @@
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+"""
+    OpenAIへのリクエストを安定させるための部品。
+    ・retry_call       指数バックオフ（ジッター付き）による回数制限付きのリトライ
+    ・hedged_stream    最初のトークンが一定時間内に届かない場合、2本目のリクエストを並行して送り、
+                       先にトークンが届いた方を使う（ヘッジリクエスト）
+    ・CircuitBreaker   失敗が続いた場合は一定時間OpenAIを呼ばずに即座に失敗させる
+"""
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._trial_running = False
+            # 半開状態では1件だけ試しに通す
+            if self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        # 成功・失敗のどちらも記録せずに終わった場合（結果が出る前に閉じられた、
+        # 上流の障害ではないエラーだった）、半開状態の試行枠を空けて次のリクエストに試させる
+        with self._lock:
+            self._trial_running = False
+
+    def check(self):
+        if not self.allow():
+            raise CircuitOpenError("upstream circuit is open")
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    # full jitter: 0〜base_delay * 2^attempt の範囲でランダムに待つ
+    return random.uniform(0, min(max_delay, base_delay * (2**attempt)))
+
+
+def retry_call(func, retries=2, base_delay=0.5, max_delay=4.0, retry_on=(Exception,)):
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except retry_on:
+            if attempt >= retries:
+                raise
+            time.sleep(backoff_delay(attempt, base_delay, max_delay))
+            attempt += 1
+
+
+class LatencyTracker:
+    # 最初のトークンが届くまでの時間を記録し、p95を求める
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p=95, min_samples=20):
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+class _Attempt(threading.Thread):
+    def __init__(self, index, factory, results):
+        super().__init__(daemon=True)
+        self.index = index
+        self.factory = factory
+        self.results = results
+        self.cancelled = False
+
+    def run(self):
+        iterator = None
+        try:
+            iterator = iter(self.factory())
+            for item in iterator:
+                if self.cancelled:
+                    return
+                self.results.put((self.index, "item", item))
+            self.results.put((self.index, "end", None))
+        except Exception as e:
+            self.results.put((self.index, "error", e))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def hedged_stream(factory, hedge_delay, max_attempts=2, on_first_item=None):
+    # factory()はストリーム（イテレーター）を返す関数。リクエストの送信もfactoryの中で行うこと。
+    # hedge_delayがNoneの場合はヘッジしない。
+    results = queue.Queue()
+    attempts = []
+    started_at = time.monotonic()
+
+    def start():
+        attempt = _Attempt(len(attempts), factory, results)
+        attempts.append(attempt)
+        attempt.start()
+        return time.monotonic()
+
+    last_started_at = start()
+    winner = None
+    failed = set()
+    try:
+        while True:
+            timeout = None
+            can_hedge = winner is None and len(attempts) < max_attempts
+            if can_hedge and hedge_delay is not None:
+                timeout = max(0, last_started_at + hedge_delay - time.monotonic())
+            try:
+                index, kind, value = results.get(timeout=timeout)
+            except queue.Empty:
+                last_started_at = start()
+                continue
+
+            if winner is not None and index != winner:
+                continue
+            if kind == "item":
+                if winner is None:
+                    winner = index
+                    for attempt in attempts:
+                        if attempt.index != winner:
+                            attempt.cancel()
+                    if on_first_item is not None:
+                        on_first_item(time.monotonic() - started_at)
+                yield value
+            elif kind == "end":
+                return
+            else:
+                if winner is not None:
+                    raise value
+                # 各リクエストのリトライはfactoryの中で済んでいるため、全て失敗したら諦める
+                failed.add(index)
+                if len(failed) < len(attempts):
+                    continue
+                raise value
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
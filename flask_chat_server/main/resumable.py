@@ -0,0 +1,190 @@
+import threading
+import time
+from collections import deque
+
+from flask_chat_server.main.streaming import Chunk, STOP
+
+"""
+    再接続できるSSEストリーム。
+    回答の生成はリクエストとは別のスレッドで行い、生成したChunkは番号（seq）を付けて
+    ストリームごとのバッファ（上限付き）に保持する。SSEの各イベントには
+        id: {chat_history_id}-{seq}-{offset}
+    を付ける（offsetはそこまでに送った回答本文の文字数）。
+    ブラウザのEventSourceは再接続時にLast-Event-IDヘッダーを送るため、
+    ・生成中の場合は同じ生成に再び接続し、続きのイベントから受け取る
+    ・生成が終わっている場合はバッファ、またはDBに保存済みの回答（Message）から続きを再生する
+    どちらの場合もOpenAIへの新しいリクエストは行わない。
+    生成中のストリームはプロセス内にしかないため、複数ワーカーの場合は
+    スティッキーセッションで同じワーカーに再接続させること（main/socket_queue.py参照）。
+    DBに保存済みの回答はどのワーカーからでも再生できる。
+
+    クライアントが切断し、CHAT_SSE_RESUME_GRACE秒以内に再接続しなかった場合は生成を中止する。
+    切断はソケットへの書き込みが失敗するまで分からないため、イベントがない間も
+    CHAT_SSE_HEARTBEAT秒ごとにコメント行（": ping"）を送って早めに検知する。
+    中止するとOpenAIへのストリームも閉じられ、途中までの回答はsave_answerで保存される。
+
+    設定（app.config）
+        CHAT_SSE_REPLAY_EVENTS  ストリームごとに保持するイベント数
+        CHAT_SSE_REPLAY_TTL     生成が終わったストリームを保持する秒数
+        CHAT_SSE_RESUME_GRACE   切断後、生成を中止するまでに再接続を待つ秒数
+        CHAT_SSE_HEARTBEAT      イベントがない間にハートビートを送る間隔（秒）
+"""
+
+
+def format_event_id(chat_history_id, seq, offset):
+    return f"{chat_history_id}-{seq}-{offset}"
+
+
+def parse_event_id(event_id):
+    try:
+        chat_history_id, seq, offset = (int(v) for v in event_id.split("-"))
+    except (AttributeError, ValueError):
+        return None
+    return chat_history_id, seq, offset
+
+
+class ResumableStream:
+    def __init__(self, key, chunks, max_events, resume_grace=5):
+        self.key = key
+        self.chunks = chunks
+        self.events = deque(maxlen=max_events)  # (seq, offset, chunk)
+        self.seq = 0
+        self.offset = 0
+        self.done = False
+        self.cancelled = False
+        self.finished_at = None
+        self.error = None
+        self.subscribers = 0
+        self.resume_grace = resume_grace
+        self.condition = threading.Condition()
+
+    def run(self, app):
+        iterator = iter(self.chunks)
+        with app.app_context():
+            try:
+                for chunk in iterator:
+                    with self.condition:
+                        if self.cancelled:
+                            break
+                        self.seq += 1
+                        self.offset += len(chunk.text)
+                        self.events.append((self.seq, self.offset, chunk))
+                        self.condition.notify_all()
+            except Exception as e:
+                self.error = e
+            finally:
+                # 中止した場合もここで閉じることで、OpenAIへのストリームまで順に閉じられる
+                iterator.close()
+                with self.condition:
+                    self.done = True
+                    self.finished_at = time.monotonic()
+                    self.condition.notify_all()
+
+    def subscribe(self, after_seq=0, heartbeat=None):
+        # after_seqより後のイベントを (seq, offset, chunk) で返す。
+        # バッファから溢れたイベントは再生できないため、残っている最も古いイベントから返す。
+        # heartbeat秒の間イベントがない場合はNoneを返す（呼び出し側でハートビートを送る）。
+        with self.condition:
+            self.subscribers += 1
+        last = after_seq
+        try:
+            while True:
+                with self.condition:
+                    if self.seq <= last and not self.done:
+                        self.condition.wait(heartbeat)
+                    pending = [event for event in self.events if event[0] > last]
+                    finished = self.done
+                if not pending and not finished:
+                    yield None
+                    continue
+                for event in pending:
+                    last = event[0]
+                    yield event
+                if finished and last >= self.seq:
+                    break
+        finally:
+            self._detach()
+
+    def _detach(self):
+        with self.condition:
+            self.subscribers -= 1
+            abandoned = self.subscribers == 0 and not self.done
+        if not abandoned:
+            return
+        if self.resume_grace > 0:
+            timer = threading.Timer(self.resume_grace, self._cancel_if_abandoned)
+            timer.daemon = True
+            timer.start()
+        else:
+            self._cancel_if_abandoned()
+
+    def _cancel_if_abandoned(self):
+        with self.condition:
+            if self.subscribers == 0 and not self.done:
+                self.cancelled = True
+
+
+class StreamRegistry:
+    def __init__(self, app=None):
+        self.max_events = 2000
+        self.ttl = 120
+        self.resume_grace = 5
+        self.heartbeat = 2
+        self._streams = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("CHAT_SSE_REPLAY_EVENTS", 2000)
+        app.config.setdefault("CHAT_SSE_REPLAY_TTL", 120)
+        app.config.setdefault("CHAT_SSE_RESUME_GRACE", 5)
+        app.config.setdefault("CHAT_SSE_HEARTBEAT", 2)
+        self.max_events = app.config["CHAT_SSE_REPLAY_EVENTS"]
+        self.ttl = app.config["CHAT_SSE_REPLAY_TTL"]
+        self.resume_grace = app.config["CHAT_SSE_RESUME_GRACE"]
+        self.heartbeat = app.config["CHAT_SSE_HEARTBEAT"]
+
+    def start(self, key, chunks, app):
+        stream = ResumableStream(key, chunks, self.max_events, self.resume_grace)
+        with self._lock:
+            self._sweep()
+            self._streams[key] = stream
+        threading.Thread(target=stream.run, args=(app,), daemon=True).start()
+        return stream
+
+    def get(self, key):
+        with self._lock:
+            return self._streams.get(key)
+
+    def _sweep(self):
+        now = time.monotonic()
+        expired = [
+            key
+            for key, stream in self._streams.items()
+            if stream.done and now - stream.finished_at > self.ttl
+        ]
+        for key in expired:
+            del self._streams[key]
+
+
+def replay_saved_answer(content, chat_history_id, seq, offset):
+    # DBに保存済みの回答の続きを再生する
+    rest = content[offset:]
+    if rest:
+        seq += 1
+        offset += len(rest)
+        yield seq, offset, Chunk(rest, rest)
+    yield seq + 1, offset, Chunk(STOP)
+
+
+def to_sse_events(events, chat_history_id):
+    # サーバーは最初の書き込みまでレスポンスヘッダーを送らないため、すぐにコメント行を送る
+    yield ": open\n\n"
+    for event in events:
+        if event is None:
+            yield ": ping\n\n"
+            continue
+        seq, offset, chunk = event
+        event_id = format_event_id(chat_history_id, seq, offset)
+        yield f"id: {event_id}\ndata: {chunk.data}\n\n"
@@ -1,21 +1,97 @@
-from flask_chat_server import socketio
-from flask_socketio import send, emit
-from flask import request
+from flask_chat_server import socketio, governor, event_log
+from flask_socketio import emit, join_room
+from flask import request, current_app
+from flask_chat_server.main.views import (
+    build_answer_stream,
+    save_user_message,
+    session_exists,
+    is_own_session,
+    materialize_session,
+    parse_chat_history_id,
+)
+from flask_chat_server.main.streaming import coalesce
+
+"""
+    Socket.IOによるチャット回答のストリーミング。
+    クライアントはsession_idのルームに参加し、回答のトークンは"chat_token"イベントで
+    ルームに送信される。1本のWebSocketを使い回すため、質問ごとのHTTP/SSE接続が不要になる。
+    /chat_sseと同じ build_answer_stream を使うため、どちらの方法でも回答内容は同じ。
+"""
 
 
 @socketio.on("connect")
 def handle_connect():
-    print("Client connected!")
-    socketio.emit("connect_completed", request.sid)
+    event_log.info("socket.connect", sid=request.sid)
+    socketio.emit("connect_completed", request.sid, to=request.sid)
+
+
+@socketio.on("join_chat")
+def handle_join_chat(data):
+    session_id = (data or {}).get("session_id")
+    # 最初の質問の前はセッションがCookieにしかないため、Cookieのセッションも参加できる
+    if not (session_exists(session_id) or is_own_session(session_id)):
+        emit("chat_error", {"error": "セッションオブジェクトが見つかりません。"})
+        return
+    join_room(session_id)
+    emit("join_completed", {"session_id": session_id})
+
+
+# messageがある場合は保存してから回答を生成する。
+# /save_chatで保存済みの場合はmessageを省略して回答の生成だけを依頼できる。
+@socketio.on("chat_message")
+def handle_chat_message(data):
+    data = data or {}
+    session_id = data.get("session_id")
+    message = data.get("message")
+    chat_history_id = parse_chat_history_id(data.get("chat_history_id"))
+    if message and chat_history_id is None:
+        emit("chat_error", {"error": "chat_history_idには0以上の整数を指定してください。"})
+        return
+    found = materialize_session(session_id) if message else session_exists(session_id)
+    if not found:
+        emit("chat_error", {"error": "セッションオブジェクトが見つかりません。"})
+        return
+    join_room(session_id)
+
+    # /chat_sseと同じ制限を掛ける（main/governor.py）
+    if not governor.check("chat_message", request.remote_addr, session_id):
+        emit("chat_error", {"error": "リクエストが多すぎます。しばらく時間をおいてからお試しください。"})
+        return
+    release = governor.acquire_stream(request.remote_addr, session_id)
+    if release is None:
+        emit("chat_error", {"error": "リクエストが多すぎます。しばらく時間をおいてからお試しください。"})
+        return
+
+    if message:
+        save_user_message(message, session_id, chat_history_id)
+
+    socketio.start_background_task(
+        stream_answer, current_app._get_current_object(), session_id, release
+    )
 
 
-# @socketio.on("site_chat")
-# def handle_message(message):
-#     print(message)
-#     for reply in ask_gpt_simple_question(message):
-#         socketio.emit("site_chat_reply", reply)
+def stream_answer(app, session_id, release):
+    try:
+        with app.app_context():
+            chunks, _ = build_answer_stream(session_id)
+            if chunks is None:
+                socketio.emit(
+                    "chat_error", {"error": "チャット履歴が見つかりません。"}, to=session_id
+                )
+                return
+            chunks = coalesce(
+                chunks,
+                max_chars=app.config.get("CHAT_SSE_COALESCE_CHARS", 24),
+                max_delay=app.config.get("CHAT_SSE_COALESCE_DELAY", 0.05),
+                app=app,
+            )
+            for chunk in chunks:
+                socketio.emit("chat_token", {"data": chunk.data}, to=session_id)
+            socketio.emit("chat_done", {"session_id": session_id}, to=session_id)
+    finally:
+        release()
 
 
 @socketio.on("disconnect")
 def handle_disconnect():
-    print("Client disconnected")
+    event_log.info("socket.disconnect", sid=request.sid)
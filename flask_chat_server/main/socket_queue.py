@@ -0,0 +1,128 @@
+import os
+import pickle
+import queue
+import socket
+import threading
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import socketio
+from socketio.pubsub_manager import PubSubManager
+
+"""
+    Socket.IOのメッセージキュー（複数プロセス・複数サーバーでのスケールアウト用）。
+
+    環境変数 SOCKETIO_MESSAGE_QUEUE にURLを設定すると、どのワーカーからでも
+    任意のsession_idのルームに送信できるようになる。
+        redis://localhost:6379/0   本番用（Redisのpub/sub）
+        amqp://... / kafka://...   RabbitMQ・Kafka（kombu / kafka-pythonが必要）
+        local:///tmp/chat-socketio 同一マシン内の複数プロセス（UNIXドメインソケット。テスト用）
+        memory://                  同一プロセス内の複数サーバー（テスト用）
+    未設定の場合はキューを使わない（1プロセス構成）。
+
+    スティッキーセッションについて:
+        Socket.IOのlong-pollingは1つのsidへのリクエストが毎回同じワーカーに届く必要がある。
+        ロードバランサーでは送信元IPまたはCookieによるスティッキーセッションを有効にすること
+        （nginxなら ip_hash、gunicornなどの複数ワーカーでも同様）。
+        クライアントが io({ transports: ["websocket"] }) で接続する場合は
+        接続が1本で完結するため、スティッキーセッションは不要。
+        メッセージキューが担うのはルームへの送信の中継だけで、接続の振り分けは行わない。
+"""
+
+
+class InProcessManager(PubSubManager):
+    # 同一プロセス内の全サーバーにメッセージを配る。複数のSocketIOを作るテスト用。
+    name = "memory"
+
+    _subscribers = defaultdict(list)
+    _lock = threading.Lock()
+
+    def __init__(self, url="memory://", channel="socketio", write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.queue = queue.Queue()
+        if not write_only:
+            with self._lock:
+                self._subscribers[channel].append(self.queue)
+
+    def _publish(self, data):
+        # 他のバックエンドと同じくシリアライズして渡す
+        payload = pickle.dumps(data)
+        with self._lock:
+            subscribers = list(self._subscribers[self.channel])
+        for q in subscribers:
+            q.put(payload)
+
+    def _listen(self):
+        while True:
+            yield self.queue.get()
+
+
+class LocalSocketManager(PubSubManager):
+    # 同一マシン内の複数プロセスにUNIXドメインソケット（データグラム）で配る。
+    # 各サーバーはディレクトリ内に自分のソケットファイルを作り、送信側は全ファイルに送る。
+    name = "local"
+
+    MAX_MESSAGE_SIZE = 64 * 1024
+
+    def __init__(
+        self, url="local:///tmp/flask-socketio", channel="socketio", write_only=False, logger=None
+    ):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.directory = os.path.join(urlparse(url).path, channel)
+        os.makedirs(self.directory, exist_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.path = None
+        if not write_only:
+            self.path = os.path.join(self.directory, f"{self.host_id}.sock")
+            self.sock.bind(self.path)
+        self._peers = []
+        self._peers_mtime = None
+
+    def _refresh_peers(self, force=False):
+        # 送信先の一覧は、ディレクトリが変わった（ソケットファイルの作成・削除）ときと
+        # 送信に失敗したときだけ読み直す
+        mtime = os.stat(self.directory).st_mtime_ns
+        if force or mtime != self._peers_mtime:
+            self._peers = [
+                os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith(".sock")
+            ]
+            self._peers_mtime = mtime
+        return self._peers
+
+    def _publish(self, data):
+        payload = pickle.dumps(data)
+        if len(payload) > self.MAX_MESSAGE_SIZE:
+            raise ValueError("local message queue: message is too large")
+        failed = False
+        for path in self._refresh_peers():
+            try:
+                self.sock.sendto(payload, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 終了したプロセスのソケットファイルは削除する
+                failed = True
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        if failed:
+            self._refresh_peers(force=True)
+
+    def _listen(self):
+        while True:
+            yield self.sock.recv(self.MAX_MESSAGE_SIZE)
+
+
+def make_client_manager(url, channel="flask-socketio", write_only=False):
+    if not url:
+        return None
+    if url.startswith(("redis://", "rediss://")):
+        return socketio.RedisManager(url, channel=channel, write_only=write_only)
+    if url.startswith("kafka://"):
+        return socketio.KafkaManager(url, channel=channel, write_only=write_only)
+    if url.startswith("memory://"):
+        return InProcessManager(url, channel=channel, write_only=write_only)
+    if url.startswith("local://"):
+        return LocalSocketManager(url, channel=channel, write_only=write_only)
+    return socketio.KombuManager(url, channel=channel, write_only=write_only)
@@ -0,0 +1,123 @@
+import queue
+import threading
+import time
+import zlib
+from collections import namedtuple
+from contextlib import nullcontext
+
+"""
+    チャット回答のストリームを扱う共通部品。
+    回答を生成するジェネレーター（ask_gpt など）は Chunk を yield し、
+    SSE（/chat_sse）や Socket.IO など、送信方法ごとの形式への変換はここで行う。
+"""
+
+# data: クライアントへ送る内容
+# text: DBに保存する回答本文へ追加する内容（制御用のメッセージは空文字）
+# action: 設定された場合、保存するメッセージのactionを上書きする
+Chunk = namedtuple("Chunk", ["data", "text", "action"], defaults=["", None])
+
+# 回答の終了を知らせるメッセージ
+STOP = "stop"
+
+
+def to_sse(chunks):
+    for chunk in chunks:
+        yield f"data: {chunk.data}\n\n"
+
+
+def _mergeable(chunk):
+    # 回答本文だけのChunkはまとめてよい。stopなどの制御用・エラーメッセージは単独で送る。
+    return chunk.action is None and chunk.data == chunk.text and chunk.data != ""
+
+
+class _Error:
+    def __init__(self, error):
+        self.error = error
+
+
+_END = object()
+
+
+"""
+    OpenAIの1回の差分（1〜2文字）ごとに送るとフレーム数が多くなるため、
+    max_chars文字たまるか、最初の差分からmax_delay秒経つまでまとめて1つのChunkにする。
+    元のストリームは別スレッドで読むため、OpenAIからの差分が途切れても
+    まとめるために待つ時間はmax_delay秒を超えない。
+    appを渡した場合、別スレッドではそのアプリケーションコンテキストの中で読む（DBへの保存用）。
+"""
+
+
+def coalesce(chunks, max_chars=24, max_delay=0.05, app=None):
+    if max_delay <= 0 or max_chars <= 1:
+        yield from chunks
+        return
+
+    items = queue.Queue()
+    stopped = threading.Event()
+
+    def pump():
+        iterator = iter(chunks)
+        with app.app_context() if app is not None else nullcontext():
+            try:
+                for chunk in iterator:
+                    if stopped.is_set():
+                        break
+                    items.put(chunk)
+            except Exception as e:
+                items.put(_Error(e))
+            finally:
+                close = getattr(iterator, "close", None)
+                if close is not None:
+                    close()
+                items.put(_END)
+
+    threading.Thread(target=pump, daemon=True).start()
+
+    buffer = []
+    buffered_chars = 0
+    deadline = None
+
+    def merged():
+        text = "".join(chunk.data for chunk in buffer)
+        return Chunk(text, text)
+
+    try:
+        while True:
+            timeout = max(0, deadline - time.monotonic()) if buffer else None
+            try:
+                item = items.get(timeout=timeout)
+            except queue.Empty:
+                yield merged()
+                buffer, buffered_chars = [], 0
+                continue
+
+            if item is _END or isinstance(item, _Error) or not _mergeable(item):
+                if buffer:
+                    yield merged()
+                    buffer, buffered_chars = [], 0
+                if item is _END:
+                    break
+                if isinstance(item, _Error):
+                    raise item.error
+                yield item
+                continue
+
+            if not buffer:
+                deadline = time.monotonic() + max_delay
+            buffer.append(item)
+            buffered_chars += len(item.data)
+            if buffered_chars >= max_chars:
+                yield merged()
+                buffer, buffered_chars = [], 0
+    finally:
+        stopped.set()
+
+
+def gzip_stream(frames, level=6):
+    # フレームごとにZ_SYNC_FLUSHするため、クライアントは届いた分だけ展開して表示できる
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for frame in frames:
+        yield compressor.compress(frame.encode("utf-8")) + compressor.flush(
+            zlib.Z_SYNC_FLUSH
+        )
+    yield compressor.flush()
@@ -0,0 +1,284 @@
+import bisect
+import hashlib
+import heapq
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, namedtuple
+
+"""
+    検索欄の入力候補（/search/suggest）。記事のタイトル・カテゴリ名・よく検索される語句を
+    プロセス内の索引に持ち、入力のたびにDBを検索せずに候補を返す。
+        前方一致  正規化した文字列をソートしたリストをbisectで検索する
+        部分一致  文字のn-gram（1文字・2文字）ごとの転置索引の積集合を取り、含まれるかを確かめる
+    前方一致した候補を先に、同じ順位の中では重み（検索語句は検索した人の数）の大きい順に返す。
+    文字列はNFKCで正規化して小文字にするため、全角・半角や大文字・小文字は区別しない。
+
+    起動時（create_app）にDBから作り、記事・カテゴリの作成・更新・削除時にその行だけを入れ替える
+    （views.refresh_post_indexes・category_maintenanceなど）。
+    他のワーカーでの更新はSEARCH_SUGGEST_REFRESH秒ごとに、バックグラウンドで作り直して反映する。
+    検索語句は結果があった検索だけを、検索した人（IPアドレスのハッシュ）ごとに数え、
+    SEARCH_SUGGEST_MIN_QUERY_SEARCHERS人以上が検索したものを候補にする
+    （候補は他の訪問者にも表示されるため、1人が同じ語句を繰り返し検索しても候補にはならない）。
+    Cookieは送らなければ毎回別人になれるため、IPアドレスで数える。
+    プロセス内だけで数え、再起動すると数え直す。
+
+    設定（app.config）
+        SEARCH_SUGGEST_PRELOAD          Trueの場合、create_appで索引を作る。
+                                        Falseの場合は最初の候補の検索時に作る
+        SEARCH_SUGGEST_LIMIT            返す候補の最大数
+        SEARCH_SUGGEST_REFRESH          DBから作り直す間隔（秒）。0の場合は作り直さない
+        SEARCH_SUGGEST_MIN_QUERY_SEARCHERS  検索語句を候補にする、検索した人の数
+        SEARCH_SUGGEST_MAX_QUERIES      数えておく検索語句の最大数
+"""
+
+Suggestion = namedtuple("Suggestion", ["kind", "id", "text", "norm", "weight"])
+
+# 検索語句ごとに覚えておく検索した人の数（重みの上限にもなる）
+MAX_SEARCHERS_PER_QUERY = 100
+
+# 前方一致・部分一致それぞれで順位付けする候補の最大数（短い入力で全件を並べ替えないようにする）
+SCAN_LIMIT = 200
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def ngrams(norm):
+    grams = set(norm)
+    grams.update(norm[i : i + 2] for i in range(len(norm) - 1))
+    return grams
+
+
+class SuggestIndex:
+    def __init__(self, app=None):
+        self.limit = 8
+        self.refresh_interval = 300
+        self.min_query_searchers = 3
+        self.max_queries = 10000
+        self.built_at = None
+        self._app = None
+        self._entries = {}
+        self._sorted = []
+        self._grams = {}
+        self._query_searchers = OrderedDict()
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._rebuilding = False
+        # 作り直している間のupdate・removeを、作り直した索引にも反映するために記録する
+        self._pending = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SEARCH_SUGGEST_PRELOAD", True)
+        app.config.setdefault("SEARCH_SUGGEST_LIMIT", 8)
+        app.config.setdefault("SEARCH_SUGGEST_REFRESH", 300)
+        app.config.setdefault("SEARCH_SUGGEST_MIN_QUERY_SEARCHERS", 3)
+        app.config.setdefault("SEARCH_SUGGEST_MAX_QUERIES", 10000)
+        self.limit = app.config["SEARCH_SUGGEST_LIMIT"]
+        self.refresh_interval = app.config["SEARCH_SUGGEST_REFRESH"]
+        self.min_query_searchers = app.config["SEARCH_SUGGEST_MIN_QUERY_SEARCHERS"]
+        self.max_queries = app.config["SEARCH_SUGGEST_MAX_QUERIES"]
+        self._app = app
+
+        if app.config["SEARCH_SUGGEST_PRELOAD"]:
+            with app.app_context():
+                try:
+                    self.rebuild()
+                except Exception as e:
+                    # テーブルの作成前（flask db upgradeなど）は最初の検索時に作る
+                    from flask_chat_server import event_log
+
+                    event_log.warning("search_suggest.preload_failed", error=str(e))
+
+    def rebuild(self):
+        with self._rebuild_lock:
+            return self._rebuild()
+
+    def _rebuild(self):
+        with self._lock:
+            self._pending = {}
+        try:
+            entries = self._snapshot()
+        except BaseException:
+            with self._lock:
+                self._pending = None
+            raise
+
+        # DBを読んでいる間の追加・削除を失わないよう、記録したupdate・removeを適用し、
+        # 検索語句は現在の索引から引き継ぐ
+        with self._lock:
+            for key, entry in self._pending.items():
+                if entry is None:
+                    entries.pop(key, None)
+                else:
+                    entries[key] = entry
+            self._pending = None
+            for key, entry in self._entries.items():
+                if entry.kind == "query":
+                    entries[key] = entry
+            self._entries = entries
+            self._sorted = sorted((entry.norm, key) for key, entry in entries.items())
+            self._grams = {}
+            for key, entry in entries.items():
+                for gram in ngrams(entry.norm):
+                    self._grams.setdefault(gram, set()).add(key)
+            self.built_at = time.monotonic()
+        return len(entries)
+
+    def _snapshot(self):
+        from flask_chat_server.models import BlogCategory, BlogPost
+
+        entries = {}
+        for post_id, title in BlogPost.query.with_entities(BlogPost.id, BlogPost.title):
+            self._make_entry(entries, "post", post_id, title)
+        for category_id, name in BlogCategory.query.with_entities(
+            BlogCategory.id, BlogCategory.category
+        ):
+            self._make_entry(entries, "category", category_id, name)
+        return entries
+
+    def _make_entry(self, entries, kind, item_id, text, weight=1):
+        norm = normalize(text)
+        if norm:
+            entries[(kind, item_id)] = Suggestion(kind, item_id, text.strip(), norm, weight)
+
+    def _add(self, key, entry):
+        self._remove(key)
+        self._entries[key] = entry
+        bisect.insort(self._sorted, (entry.norm, key))
+        for gram in ngrams(entry.norm):
+            self._grams.setdefault(gram, set()).add(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        i = bisect.bisect_left(self._sorted, (entry.norm, key))
+        if i < len(self._sorted) and self._sorted[i] == (entry.norm, key):
+            del self._sorted[i]
+        for gram in ngrams(entry.norm):
+            keys = self._grams.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._grams[gram]
+
+    def update(self, kind, item_id, text):
+        # 記事・カテゴリを作成・更新したときに呼び出す
+        entries = {}
+        self._make_entry(entries, kind, item_id, text)
+        with self._lock:
+            self._remove((kind, item_id))
+            for key, entry in entries.items():
+                self._add(key, entry)
+            if self._pending is not None:
+                self._pending[(kind, item_id)] = entries.get((kind, item_id))
+
+    def remove(self, kind, item_id):
+        with self._lock:
+            self._remove((kind, item_id))
+            if self._pending is not None:
+                self._pending[(kind, item_id)] = None
+
+    def record_query(self, text, searcher):
+        # 結果があった検索の語句を検索した人ごとに数え、一定の人数以上のものを候補に加える。
+        # searcherは検索した人を区別する文字列（IPアドレスなど）。ハッシュにして保持する
+        norm = normalize(text)
+        if not norm or len(norm) > 100:
+            return
+        key = ("query", norm)
+        searcher = hashlib.blake2b(str(searcher).encode("utf-8"), digest_size=8).digest()
+        with self._lock:
+            searchers = self._query_searchers.pop(norm, set())
+            if len(searchers) < MAX_SEARCHERS_PER_QUERY:
+                searchers.add(searcher)
+            self._query_searchers[norm] = searchers
+            while len(self._query_searchers) > self.max_queries:
+                evicted, _ = self._query_searchers.popitem(last=False)
+                self._remove(("query", evicted))
+            if len(searchers) >= self.min_query_searchers:
+                self._add(key, Suggestion("query", None, text.strip(), norm, len(searchers)))
+
+    def suggest(self, text, limit=None):
+        # 入力中の文字列に一致する候補を、前方一致・重みの順に返す
+        limit = min(limit or self.limit, 50)
+        self._refresh_if_stale()
+        q = normalize(text)
+        if not q:
+            return []
+        with self._lock:
+            candidates = {}
+            start = bisect.bisect_left(self._sorted, (q,))
+            for norm, key in self._sorted[start : start + SCAN_LIMIT]:
+                if not norm.startswith(q):
+                    break
+                candidates[key] = 0
+            if len(candidates) < limit:
+                for key in self._infix_matches(q):
+                    candidates.setdefault(key, 1)
+            entries = self._entries
+            # 重複を除いてもlimit件残るよう多めに取り出す（全件はソートしない）
+            ranked = heapq.nsmallest(
+                limit * 2,
+                candidates.items(),
+                key=lambda item: (item[1], -entries[item[0]].weight, len(entries[item[0]].norm)),
+            )
+            results, seen = [], set()
+            for key, _ in ranked:
+                # 記事のタイトルと同じ検索語句などは1つだけ返す
+                entry = self._entries[key]
+                if entry.norm in seen:
+                    continue
+                seen.add(entry.norm)
+                results.append(entry)
+                if len(results) >= limit:
+                    break
+            return results
+
+    def _infix_matches(self, q):
+        # 入力のn-gramのうち、含む候補が最も少ないものから探す
+        grams = [q] if len(q) == 1 else [q[i : i + 2] for i in range(len(q) - 1)]
+        postings = [self._grams.get(gram) for gram in grams]
+        if not all(postings):
+            return []
+        matches = []
+        for key in min(postings, key=len):
+            if q in self._entries[key].norm:
+                matches.append(key)
+                if len(matches) >= SCAN_LIMIT:
+                    break
+        return matches
+
+    def _refresh_if_stale(self):
+        if self._app is None:
+            return
+        if self.built_at is None:
+            # 起動時に作れなかった場合は、このリクエストで作る
+            with self._app.app_context():
+                self.rebuild()
+            return
+        if not self.refresh_interval:
+            return
+        with self._lock:
+            if self._rebuilding or time.monotonic() - self.built_at < self.refresh_interval:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild_in_background, daemon=True).start()
+
+    def _rebuild_in_background(self):
+        try:
+            with self._app.app_context():
+                self.rebuild()
+        except Exception as e:
+            from flask_chat_server import event_log
+
+            event_log.error("search_suggest.rebuild_failed", error=str(e))
+            self.built_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._rebuilding = False
@@ -0,0 +1,153 @@
+import json
+import threading
+
+"""
+    長い会話の要約（UserSession.important_info）。
+    プロンプトに含める会話履歴はCHAT_HISTORY_MAX_CHARS文字（直近の会話）までのため、
+    それより前の会話は要約してimportant_infoに保存し、直近の会話と一緒に送る。
+    important_infoには {"summary": 要約, "upto": 要約に含めた最後のmessage_id} をJSONで保存する。
+    要約の更新は回答を保存した後（save_answer）にバックグラウンドのスレッドで行い、
+    前回の要約と、その後に直近の範囲から外れたメッセージだけをOpenAIに送る。
+    そのため、会話が長くなってもプロンプトの大きさは 要約 + 直近の会話 で一定になる。
+
+    設定（app.config）
+        CHAT_SUMMARY_ENABLED    Falseの場合は要約しない（直近の会話だけを送る）
+        CHAT_HISTORY_MAX_CHARS  プロンプトに含める直近の会話の文字数
+        CHAT_SUMMARY_MAX_CHARS  要約の最大文字数
+"""
+
+SUMMARY_PROMPT = """
+    あなたは会話の要約を作成します。
+    これまでの要約と、その後の会話が与えられるので、両方の内容を含む新しい要約を作成してください。
+    質問者の状況・目的・既に回答した内容など、今後の回答に必要な情報を優先して残してください。
+    要約は{max_chars}文字以内の日本語で、要約の本文だけを出力してください。
+"""
+
+
+def load_summary(important_info):
+    # important_infoから (要約, 要約に含めた最後のmessage_id) を取り出す
+    try:
+        info = json.loads(important_info or "")
+        return info.get("summary", ""), info.get("upto", 0)
+    except (ValueError, AttributeError):
+        return "", 0
+
+
+def history_chars(role, content):
+    return len(role) + len(content) + 2  # ': ' and '\n' are included
+
+
+def split_recent(messages, max_chars):
+    # 直近max_chars文字に収まらない（要約する）メッセージと、直近のメッセージに分ける
+    current_chars = 0
+    for index in range(len(messages) - 1, -1, -1):
+        current_chars += history_chars(messages[index].role, messages[index].content)
+        if current_chars > max_chars:
+            # 一部だけ直近の会話に入るメッセージは直近の側に含める
+            return messages[:index], messages[index:]
+    return [], messages
+
+
+class ConversationSummarizer:
+    def __init__(self, app=None):
+        self.enabled = True
+        self.recent_chars = 2000
+        self.max_chars = 600
+        self._running = set()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("CHAT_SUMMARY_ENABLED", True)
+        app.config.setdefault("CHAT_HISTORY_MAX_CHARS", 2000)
+        app.config.setdefault("CHAT_SUMMARY_MAX_CHARS", 600)
+        self.enabled = app.config["CHAT_SUMMARY_ENABLED"]
+        self.recent_chars = app.config["CHAT_HISTORY_MAX_CHARS"]
+        self.max_chars = app.config["CHAT_SUMMARY_MAX_CHARS"]
+
+    def summary_for(self, session_id, messages):
+        # 直近の会話に収まらないメッセージがある場合だけ、保存済みの要約を返す
+        if not self.enabled:
+            return ""
+        older, _ = split_recent(messages, self.recent_chars)
+        if not older:
+            return ""
+        from flask_chat_server import db
+        from flask_chat_server.models import UserSession
+
+        important_info = (
+            db.session.query(UserSession.important_info)
+            .filter_by(session_id=session_id)
+            .scalar()
+        )
+        summary, _ = load_summary(important_info)
+        return summary
+
+    def schedule(self, app, session_id):
+        # 同じセッションの要約を同時に更新しない
+        if not self.enabled:
+            return
+        with self._lock:
+            if session_id in self._running:
+                return
+            self._running.add(session_id)
+        threading.Thread(
+            target=self._run, args=(app, session_id), daemon=True
+        ).start()
+
+    def _run(self, app, session_id):
+        from flask_chat_server import db, event_log
+
+        try:
+            with app.app_context():
+                try:
+                    self.update(session_id)
+                except Exception as e:
+                    db.session.rollback()
+                    event_log.error("summary.update_failed", session_id=session_id, error=str(e))
+                finally:
+                    db.session.remove()
+        finally:
+            with self._lock:
+                self._running.discard(session_id)
+
+    def update(self, session_id):
+        from flask_chat_server import db, chat_client
+        from flask_chat_server.models import Message, UserSession
+
+        session_obj = UserSession.query.get(session_id)
+        if session_obj is None:
+            return
+        summary, upto = load_summary(session_obj.important_info)
+        messages = (
+            Message.query.filter_by(session_id=session_id)
+            .order_by(Message.create_at)
+            .all()
+        )
+        older, _ = split_recent(messages, self.recent_chars)
+        new = [m for m in older if m.message_id > upto]
+        if not new:
+            return
+
+        conversation = "\n".join(f"{m.role}: {m.content}" for m in new)
+        response = chat_client.create_completion(
+            messages=[
+                {
+                    "role": "system",
+                    "content": SUMMARY_PROMPT.format(max_chars=self.max_chars),
+                },
+                {
+                    "role": "user",
+                    "content": f"■これまでの要約:\n{summary}\n\n■その後の会話:\n{conversation}",
+                },
+            ],
+            temperature=0,
+            max_tokens=self.max_chars,
+        )
+        summary = response["choices"][0]["message"]["content"].strip()[: self.max_chars]
+        session_obj.important_info = json.dumps(
+            {"summary": summary, "upto": max(m.message_id for m in new)},
+            ensure_ascii=False,
+        )
+        db.session.commit()
@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+"""
+    テンプレートのキャッシュ。
+    ・バイトコードキャッシュ
+        コンパイル済みのテンプレートをファイルに保存し、ワーカーの再起動後にコンパイルし直さない。
+    ・フラグメントキャッシュ
+        テンプレートの一部を {% cache "名前", post.id %} 〜 {% endcache %} で囲むと、
+        描画したHTMLを 名前・記事ID・記事のバージョン をキーに保存し、次回からは描画しない。
+        記事を編集したとき（views.refresh_post_indexes）と、投稿者のユーザー名を変更・削除したとき
+        （users.views.bump_user_posts）にバージョンを上げるため、
+        古いHTMLが使われることはない。記事以外の内容（ログイン中のユーザーなど）は囲まないこと。
+        バックエンドはプロセス内（memory://）かRedis（redis://）。複数のワーカーで動かす場合は
+        Redisを使うこと（プロセス内の場合、他のワーカーの編集はFRAGMENT_CACHE_TTL秒後に反映される）。
+
+    設定（app.config）
+        TEMPLATE_BYTECODE_CACHE_DIR  バイトコードを保存するディレクトリ。Noneの場合は保存しない
+        FRAGMENT_CACHE_URI           フラグメントキャッシュのバックエンド。Noneの場合はキャッシュしない
+        FRAGMENT_CACHE_TTL           保存したHTMLの有効期限（秒）
+        FRAGMENT_CACHE_MAX_ENTRIES   プロセス内に保存するHTMLの最大数
+"""
+
+
+class MemoryFragmentBackend:
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def version(self, name):
+        with self._lock:
+            return self._versions.get(name, 0)
+
+    def bump(self, name):
+        with self._lock:
+            self._versions[name] = self._versions.get(name, 0) + 1
+
+
+class RedisFragmentBackend:
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(f"fragment:{key}")
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(f"fragment:{key}", value, ex=int(ttl))
+
+    def version(self, name):
+        return int(self.client.get(f"fragment_version:{name}") or 0)
+
+    def bump(self, name):
+        self.client.incr(f"fragment_version:{name}")
+
+
+def make_fragment_backend(uri, max_entries=5000):
+    if not uri:
+        return None
+    if uri.startswith(("redis://", "rediss://", "unix://")):
+        return RedisFragmentBackend(uri)
+    return MemoryFragmentBackend(max_entries)
+
+
+class FragmentCacheExtension(Extension):
+    tags = {"cache"}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method("_render", [nodes.List(args)]), [], [], body
+        ).set_lineno(lineno)
+
+    def _render(self, args, caller):
+        cache = self.environment.fragment_cache
+        if cache is None:
+            return caller()
+        return cache.fetch(args, caller)
+
+
+class FragmentCache:
+    def __init__(self, app=None):
+        self.backend = None
+        self.ttl = 3600
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault(
+            "TEMPLATE_BYTECODE_CACHE_DIR", os.path.join(app.instance_path, "jinja_cache")
+        )
+        app.config.setdefault("FRAGMENT_CACHE_URI", "memory://")
+        app.config.setdefault("FRAGMENT_CACHE_TTL", 3600)
+        app.config.setdefault("FRAGMENT_CACHE_MAX_ENTRIES", 5000)
+        self.ttl = app.config["FRAGMENT_CACHE_TTL"]
+        self.backend = make_fragment_backend(
+            app.config["FRAGMENT_CACHE_URI"], app.config["FRAGMENT_CACHE_MAX_ENTRIES"]
+        )
+
+        directory = app.config["TEMPLATE_BYTECODE_CACHE_DIR"]
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.jinja_env.fragment_cache = self if self.backend is not None else None
+
+    def key(self, name, post_id, *extra):
+        version = self.backend.version(f"post:{post_id}")
+        parts = [name, post_id, f"v{version}", *extra]
+        return ":".join(str(part) for part in parts)
+
+    def fetch(self, args, caller):
+        key = self.key(*args)
+        html = self.backend.get(key)
+        if html is not None:
+            self.hits += 1
+            return Markup(html)
+        self.misses += 1
+        html = caller()
+        self.backend.set(key, str(html), self.ttl)
+        return html
+
+    def bump(self, post_id):
+        # 記事を編集・削除したときに呼び出し、その記事のHTMLを使わないようにする
+        if self.backend is not None:
+            self.backend.bump(f"post:{post_id}")
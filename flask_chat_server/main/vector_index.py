@@ -0,0 +1,342 @@
+import fcntl
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+import click
+from sqlalchemy.orm import undefer
+
+"""
+    ブログ記事（BlogPost）のベクトル検索。関連する質問（kind == "related"）の回答に、
+    質問と近い記事の内容を参考情報として含める（Pineconeの代わりにプロセス内で検索する）。
+    記事のタイトル・概要と、本文をCHAT_VECTOR_CHUNK_CHARS文字ずつに分けたものを埋め込みベクトルにし、
+        v{番号}/vectors.npy  正規化済みのベクトル（float32、行数×次元数）
+        v{番号}/meta.json    各行の記事IDと文章、埋め込みの種類
+        CURRENT             使用中のディレクトリ名
+    として保存する。vectors.npyはメモリマップで開くため、起動時に全体を読み込まない。
+    保存するたびに新しいディレクトリに書き込んでからCURRENTを置き換えるため、
+    読み込む側がvectors.npyとmeta.jsonの組み合わせを取り違えることはない。
+    変更（読み込み→変更→保存）はファイルロックを掛けて、プロセス間でも1つずつ行う。
+    検索は 行列×質問のベクトル の1回の積（コサイン類似度）で行い、上位k件を返す。
+    記事の作成・更新・削除時にその記事の行だけを入れ替える（views.refresh_post_indexes）。
+    他のプロセスが更新した場合は、CURRENTが変わったことを見て読み込み直す。
+    インデックスの作成（全記事の埋め込み）は flask build-vector-index で行う。
+    リクエストの中では作成しないため、作成前・埋め込みの種類を変えた後は参考情報を含めない。
+    numpyは起動を遅くしないよう、初めて使うときにimportする。
+
+    埋め込み（CHAT_VECTOR_EMBEDDER）
+        openai   OpenAIのEmbedding API
+        hashing  文字n-gramのハッシュによる埋め込み。外部APIを使わず常に同じ結果になるため、
+                 開発・テスト用に使う
+
+    設定（app.config）
+        CHAT_VECTOR_INDEX_ENABLED  Falseの場合は参考情報を含めない
+        CHAT_VECTOR_INDEX_DIR      インデックスを保存するディレクトリ
+        CHAT_VECTOR_EMBEDDER       埋め込みの種類（openai / hashing）
+        CHAT_VECTOR_CHUNK_CHARS    本文を分ける文字数
+        CHAT_VECTOR_TOP_K          参考情報に含める件数
+        CHAT_VECTOR_MIN_SCORE      これより類似度が低いものは含めない
+"""
+
+
+class HashingEmbedder:
+    name = "hashing"
+
+    def __init__(self, dim=512, ngram=(2, 3)):
+        self.dim = dim
+        self.ngram = ngram
+
+    def embed(self, texts):
+        import numpy as np
+
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            text = re.sub(r"\s+", " ", text.lower())
+            for n in range(self.ngram[0], self.ngram[1] + 1):
+                for i in range(len(text) - n + 1):
+                    h = zlib.crc32(text[i : i + n].encode("utf-8"))
+                    # 符号もハッシュで決め、衝突による偏りを打ち消す
+                    vectors[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return normalize(vectors)
+
+
+class OpenAIEmbedder:
+    name = "openai"
+
+    def __init__(self, chat_client, model="text-embedding-ada-002", dim=1536, batch_size=100):
+        self.chat_client = chat_client
+        self.model = model
+        self.dim = dim
+        self.batch_size = batch_size
+
+    def embed(self, texts):
+        import numpy as np
+
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start : start + self.batch_size]
+            response = self.chat_client.openai.Embedding.create(
+                model=self.model, input=batch, request_timeout=self.chat_client.timeout
+            )
+            data = sorted(response["data"], key=lambda d: d["index"])
+            vectors.extend(d["embedding"] for d in data)
+        if not vectors:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return normalize(np.asarray(vectors, dtype=np.float32))
+
+
+def make_embedder(name, chat_client=None):
+    if name == "openai":
+        return OpenAIEmbedder(chat_client)
+    if name == "hashing":
+        return HashingEmbedder()
+    raise ValueError(f"unknown embedder: {name}")
+
+
+def normalize(vectors):
+    import numpy as np
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def strip_tags(text):
+    return re.sub(r"\s+", " ", re.sub(r"<[^>]+>", " ", text or "")).strip()
+
+
+def chunk_post(post, chunk_chars=400):
+    # タイトル・概要を1つ、本文は前後を少し重ねてchunk_chars文字ずつに分ける
+    chunks = [f"{post.title or ''}\n{post.summary or ''}".strip()]
+    text = strip_tags(post.text)
+    overlap = chunk_chars // 8
+    for start in range(0, len(text), chunk_chars - overlap):
+        chunks.append(f"{post.title or ''}\n{text[start : start + chunk_chars]}")
+        if start + chunk_chars >= len(text):
+            break
+    return [chunk for chunk in chunks if chunk]
+
+
+class VectorIndex:
+    KEEP_VERSIONS = 2
+
+    def __init__(self, app=None, chat_client=None):
+        self.enabled = True
+        self.directory = None
+        self.embedder = None
+        self.chunk_chars = 400
+        self.top_k = 3
+        self.min_score = 0.2
+        self.vectors = None
+        self.post_ids = None
+        self.texts = []
+        self._version = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, chat_client)
+
+    def init_app(self, app, chat_client=None):
+        app.config.setdefault("CHAT_VECTOR_INDEX_ENABLED", True)
+        app.config.setdefault(
+            "CHAT_VECTOR_INDEX_DIR", os.path.join(app.instance_path, "vector_index")
+        )
+        app.config.setdefault("CHAT_VECTOR_EMBEDDER", "hashing")
+        app.config.setdefault("CHAT_VECTOR_CHUNK_CHARS", 400)
+        app.config.setdefault("CHAT_VECTOR_TOP_K", 3)
+        app.config.setdefault("CHAT_VECTOR_MIN_SCORE", 0.2)
+        self.enabled = app.config["CHAT_VECTOR_INDEX_ENABLED"]
+        self.directory = app.config["CHAT_VECTOR_INDEX_DIR"]
+        self.embedder = make_embedder(app.config["CHAT_VECTOR_EMBEDDER"], chat_client)
+        self.chunk_chars = app.config["CHAT_VECTOR_CHUNK_CHARS"]
+        self.top_k = app.config["CHAT_VECTOR_TOP_K"]
+        self.min_score = app.config["CHAT_VECTOR_MIN_SCORE"]
+        self.vectors = None
+        self._version = None
+
+        @app.cli.command("build-vector-index")
+        def build_vector_index_command():
+            """ブログ記事のベクトル検索用のインデックスを作り直す。"""
+            from flask_chat_server.models import BlogPost
+
+            count = self.rebuild(BlogPost.query.options(undefer(BlogPost.text)).yield_per(100))
+            click.echo(f"{count}件の文章をインデックスに追加しました。")
+
+    @property
+    def current_path(self):
+        return os.path.join(self.directory, "CURRENT")
+
+    @contextmanager
+    def _file_lock(self):
+        # 複数のプロセスが同時に読み込み・変更・保存しないよう、ファイルロックを掛ける
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _empty(self):
+        import numpy as np
+
+        self.vectors = np.zeros((0, self.embedder.dim), dtype=np.float32)
+        self.post_ids = np.zeros(0, dtype=np.int64)
+        self.texts = []
+
+    def _current_version(self):
+        try:
+            with open(self.current_path, encoding="utf-8") as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def _load(self):
+        # 保存済みのインデックスを開く。作り直し（埋め込みのAPI呼び出し）はリクエストの中では行わず、
+        # ない場合・埋め込みの種類が違う場合は空のまま flask build-vector-index を待つ。
+        # 読み込めた場合はTrueを返す
+        import numpy as np
+
+        from flask_chat_server import event_log
+
+        version = self._current_version()
+        if self.vectors is not None and version == self._version:
+            return self._version is not None
+        if version is not None:
+            directory = os.path.join(self.directory, version)
+            with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("embedder") == self.embedder.name and meta.get("dim") == self.embedder.dim:
+                self.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+                self.post_ids = np.asarray(meta["post_ids"], dtype=np.int64)
+                self.texts = meta["texts"]
+                self._version = version
+                return True
+            event_log.warning(
+                "vector_index.embedder_mismatch",
+                embedder=meta.get("embedder"),
+                expected=self.embedder.name,
+            )
+        elif self._version is None and self.vectors is None:
+            event_log.warning("vector_index.missing", directory=self.directory)
+        self._empty()
+        self._version = None
+        return False
+
+    def _save(self):
+        import numpy as np
+
+        # 保存するたびに新しいディレクトリに書き込み、最後にCURRENTを置き換える。
+        # 読み込み中のプロセスは古いディレクトリのvectors.npyとmeta.jsonを組で使い続けられる
+        version = f"v{time.time_ns()}"
+        directory = os.path.join(self.directory, version)
+        os.makedirs(directory)
+        np.save(
+            os.path.join(directory, "vectors.npy"),
+            np.ascontiguousarray(self.vectors, dtype=np.float32),
+        )
+        meta = {
+            "embedder": self.embedder.name,
+            "dim": self.embedder.dim,
+            "post_ids": self.post_ids.tolist(),
+            "texts": self.texts,
+        }
+        with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        tmp = self.current_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(version)
+        os.replace(tmp, self.current_path)
+        self._version = version
+        self._remove_old_versions()
+
+    def _remove_old_versions(self):
+        # 直前のものは読み込み中のプロセスのために残す（削除してもメモリマップ済みの分は読める）
+        versions = sorted(
+            name for name in os.listdir(self.directory) if re.fullmatch(r"v\d+", name)
+        )
+        for name in versions[: -self.KEEP_VERSIONS]:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def _rebuild(self, posts):
+        import numpy as np
+
+        self._empty()
+        post_ids, texts = [], []
+        for post in posts:
+            for chunk in chunk_post(post, self.chunk_chars):
+                post_ids.append(post.id)
+                texts.append(chunk)
+        if texts:
+            self.vectors = self.embedder.embed(texts)
+            self.post_ids = np.asarray(post_ids, dtype=np.int64)
+            self.texts = texts
+        self._save()
+        return len(texts)
+
+    def rebuild(self, posts):
+        with self._lock, self._file_lock():
+            return self._rebuild(posts)
+
+    def _remove_rows(self, post_id):
+        import numpy as np
+
+        keep = self.post_ids != post_id
+        self.vectors = np.asarray(self.vectors)[keep]
+        self.post_ids = self.post_ids[keep]
+        self.texts = [text for text, k in zip(self.texts, keep) if k]
+
+    def update_post(self, post):
+        import numpy as np
+
+        if not self.enabled:
+            return
+        chunks = chunk_post(post, self.chunk_chars)
+        vectors = self.embedder.embed(chunks)
+        with self._lock, self._file_lock():
+            if not self._load():
+                # 作成前のインデックスに1件だけ入れて保存すると、作成済みに見えてしまう
+                return
+            self._remove_rows(post.id)
+            self.vectors = np.concatenate([self.vectors, vectors])
+            self.post_ids = np.concatenate(
+                [self.post_ids, np.full(len(chunks), post.id, dtype=np.int64)]
+            )
+            self.texts = self.texts + chunks
+            self._save()
+
+    def remove_post(self, post_id):
+        if not self.enabled:
+            return
+        with self._lock, self._file_lock():
+            if not self._load():
+                return
+            self._remove_rows(post_id)
+            self._save()
+
+    def search(self, query, k=None):
+        import numpy as np
+
+        # 質問と近い文章を [(類似度, 記事ID, 文章)] で返す
+        k = k or self.top_k
+        if not self.enabled or not query:
+            return []
+        with self._lock:
+            self._load()
+            vectors, post_ids, texts = self.vectors, self.post_ids, self.texts
+        if len(texts) == 0:
+            return []
+        q = self.embedder.embed([query])[0]
+        scores = vectors @ q
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (float(scores[i]), int(post_ids[i]), texts[i])
+            for i in top
+            if scores[i] >= self.min_score
+        ]
@@ -9,7 +9,10 @@ from flask import (
     abort,
     session,
     jsonify,
+    current_app,
+    stream_with_context,
 )
+from datetime import datetime
 from flask_login import login_required, current_user
 from flask_chat_server.models import (
     BlogCategory,
@@ -26,11 +29,37 @@ from flask_chat_server.main.forms import (
     BlogSearchForm,
     InquiryForm,
 )
-from flask_chat_server import db
+from flask_chat_server import (
+    db,
+    governor,
+    answer_cache,
+    chat_client,
+    resumable_streams,
+    known_sessions,
+    summarizer,
+    vector_index,
+    fragment_cache,
+    search_suggestions,
+    related_posts,
+    feed_cache,
+    question_classifier,
+    profiler,
+    event_log,
+    text_codec,
+)
+from sqlalchemy.exc import IntegrityError
+from werkzeug.http import is_resource_modified
 
 from flask_chat_server.main.image_handler import add_featured_image
-
-# from flask_chat_server import limiter
+from flask_chat_server.main.streaming import Chunk, STOP, coalesce, gzip_stream
+from flask_chat_server.main.resumable import (
+    parse_event_id,
+    replay_saved_answer,
+    to_sse_events,
+)
+from flask_chat_server.main.coalesce import single_flight, make_key
+from flask_chat_server.main.resilience import CircuitOpenError
+from flask_chat_server.main import exports
 
 main = Blueprint("main", __name__)
 
@@ -47,6 +76,8 @@ def category_maintenance():
         blog_category = BlogCategory(category=form.category.data)
         db.session.add(blog_category)
         db.session.commit()
+        search_suggestions.update("category", blog_category.id, blog_category.category)
+        feed_cache.update_category(blog_category)
         flash("ブログカテゴリが追加されました。")
         return redirect(url_for("main.category_maintenance"))
     elif form.errors:
@@ -67,6 +98,8 @@ def blog_category(blog_category_id):
     if form.validate_on_submit():
         blog_category.category = form.category.data
         db.session.commit()
+        search_suggestions.update("category", blog_category.id, blog_category.category)
+        feed_cache.update_category(blog_category)
         flash("ブログカテゴリが更新されました。")
         return redirect(url_for("main.category_maintenance"))
     elif request.method == "GET":
@@ -82,6 +115,8 @@ def delete_category(blog_category_id):
     blog_category = BlogCategory.query.get_or_404(blog_category_id)
     db.session.delete(blog_category)
     db.session.commit()
+    search_suggestions.remove("category", blog_category_id)
+    feed_cache.remove_category(blog_category_id)
     flash("ブログカテゴリが削除されました。")
     return redirect(url_for("main.category_maintenance"))
 
@@ -104,6 +139,7 @@ def create_post():
         )
         db.session.add(blog_post)
         db.session.commit()
+        refresh_post_indexes(blog_post)
         flash("ブログ投稿が作成されました。")
         return redirect("blog_maintenance")
     return render_template("create_post.html", form=form)
@@ -127,6 +163,20 @@ def blog_post(blog_post_id):
     # 最新記事の取得
     recent_blog_post = BlogPost.query.order_by(BlogPost.id.desc()).limit(5).all()
 
+    # 関連記事の取得（計算済みの結果を引くだけ。main/related_posts.py）
+    related_blog_posts = []
+    try:
+        related_ids = related_posts.related(blog_post_id)
+    except Exception as e:
+        event_log.error("related_posts.lookup_failed", post_id=blog_post_id, error=str(e))
+        related_ids = []
+    if related_ids:
+        found = {
+            post.id: post
+            for post in BlogPost.query.filter(BlogPost.id.in_(related_ids)).all()
+        }
+        related_blog_posts = [found[i] for i in related_ids if i in found]
+
     # カテゴリの取得
     blog_categories = BlogCategory.query.order_by(BlogCategory.id.asc()).all()
 
@@ -134,6 +184,7 @@ def blog_post(blog_post_id):
         "blog_post.html",
         post=blog_post,
         recent_blog_posts=recent_blog_post,
+        related_blog_posts=related_blog_posts,
         blog_categories=blog_categories,
         form=form,
     )
@@ -147,6 +198,7 @@ def delete_post(blog_post_id):
         abort(403)
     db.session.delete(blog_post)
     db.session.commit()
+    remove_post_indexes(blog_post_id)
     flash("ブログ投稿が削除されました。")
     return redirect(url_for("main.blog_maintenance"))
 
@@ -166,6 +218,7 @@ def update_post(blog_post_id):
         blog_post.summary = form.summary.data
         blog_post.category_id = form.category.data
         db.session.commit()
+        refresh_post_indexes(blog_post)
         flash("ブログ投稿が更新されました。")
         return redirect(url_for("main.blog_post", blog_post_id=blog_post.id))
     elif request.method == "GET":
@@ -177,6 +230,50 @@ def update_post(blog_post_id):
     return render_template("create_post.html", form=form)
 
 
+"""
+    記事の作成・更新・削除時に、記事から作成するインデックス・キャッシュを更新する。
+    インデックスの更新に失敗しても記事の保存は取り消さない（次回の作り直しで反映される）。
+"""
+
+
+def refresh_post_indexes(blog_post):
+    fragment_cache.bump(blog_post.id)
+    search_suggestions.update("post", blog_post.id, blog_post.title)
+    feed_cache.update_post(blog_post)
+    try:
+        text_codec.update_search_text(blog_post)
+    except Exception as e:
+        db.session.rollback()
+        event_log.error("search_text.update_failed", post_id=blog_post.id, error=str(e))
+    try:
+        vector_index.update_post(blog_post)
+    except Exception as e:
+        event_log.error("vector_index.update_failed", post_id=blog_post.id, error=str(e))
+    try:
+        related_posts.update_post(blog_post)
+    except Exception as e:
+        event_log.error("related_posts.update_failed", post_id=blog_post.id, error=str(e))
+
+
+def remove_post_indexes(blog_post_id):
+    fragment_cache.bump(blog_post_id)
+    search_suggestions.remove("post", blog_post_id)
+    feed_cache.remove_post(blog_post_id)
+    try:
+        text_codec.remove_search_text(blog_post_id)
+    except Exception as e:
+        db.session.rollback()
+        event_log.error("search_text.update_failed", post_id=blog_post_id, error=str(e))
+    try:
+        vector_index.remove_post(blog_post_id)
+    except Exception as e:
+        event_log.error("vector_index.update_failed", post_id=blog_post_id, error=str(e))
+    try:
+        related_posts.remove_post(blog_post_id)
+    except Exception as e:
+        event_log.error("related_posts.update_failed", post_id=blog_post_id, error=str(e))
+
+
 @main.route("/")
 def index():
     form = BlogSearchForm()
@@ -213,15 +310,20 @@ def search():
 
     # ブログ記事の取得
     page = request.args.get("page", 1, type=int)
+    # 圧縮した本文はLIKEで探せないため、検索用の本文を探す（main/compressed_text.py）
+    body_match = text_codec.search_condition(searchtext)
     blog_posts = (
         BlogPost.query.filter(
-            (BlogPost.text.contains(searchtext))
+            body_match
             | (BlogPost.title.contains(searchtext))
             | (BlogPost.summary.contains(searchtext))
         )
         .order_by(BlogPost.id.desc())
         .paginate(page=page, per_page=10)
     )
+    # 結果があった検索語句を入力候補に使う
+    if searchtext and blog_posts.total:
+        search_suggestions.record_query(searchtext, request.remote_addr)
     # 最新記事の取得
     recent_blog_post = BlogPost.query.order_by(BlogPost.id.desc()).limit(5).all()
 
@@ -238,6 +340,22 @@ def search():
     )
 
 
+@main.route("/search/suggest")
+def search_suggest():
+    # 検索欄の入力候補。DBは検索せず、プロセス内の索引から返す（main/suggest.py）
+    q = request.args.get("q", "")
+    limit = request.args.get("limit", None, type=int)
+    suggestions = []
+    for entry in search_suggestions.suggest(q, limit):
+        item = {"text": entry.text, "kind": entry.kind}
+        if entry.kind == "post":
+            item["url"] = url_for("main.blog_post", blog_post_id=entry.id)
+        elif entry.kind == "category":
+            item["url"] = url_for("main.category_posts", blog_category_id=entry.id)
+        suggestions.append(item)
+    return jsonify({"query": q, "suggestions": suggestions})
+
+
 @main.route("/<int:blog_category_id>/category_posts")
 def category_posts(blog_category_id):
     form = BlogSearchForm()
@@ -267,6 +385,40 @@ def category_posts(blog_category_id):
     )
 
 
+@main.route("/feed.xml")
+def feed():
+    return feed_response("feed", "application/rss+xml")
+
+
+@main.route("/<int:blog_category_id>/feed.xml")
+def category_feed(blog_category_id):
+    return feed_response(f"category:{blog_category_id}", "application/rss+xml")
+
+
+@main.route("/sitemap.xml")
+def sitemap():
+    return feed_response("sitemap", "application/xml")
+
+
+def feed_response(key, content_type):
+    # 保存済みの本文をチャンクごとに返す。変更がない場合は304（main/feeds.py）
+    body = feed_cache.body(key)
+    if body is None:
+        abort(404)
+    if not is_resource_modified(
+        request.environ, etag=body.etag, last_modified=body.last_modified
+    ):
+        response = Response(status=304)
+    else:
+        response = Response(iter(body.chunks), content_type=f"{content_type}; charset=utf-8")
+        response.content_length = body.length
+    response.set_etag(body.etag)
+    response.last_modified = body.last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response
+
+
 @main.route("/inquiry", methods=["GET", "POST"])
 def inquiry():
     form = InquiryForm()
@@ -317,6 +469,163 @@ def delete_inquiry(inquiry_id):
     return redirect(url_for("main.inquiry_maintenance"))
 
 
+@main.route("/answer_cache")
+@login_required
+def answer_cache_stats():
+    if not current_user.is_administrator():
+        abort(403)
+    return jsonify(answer_cache.stats())
+
+
+@main.route("/answer_cache/purge", methods=["POST"])
+@login_required
+def purge_answer_cache():
+    if not current_user.is_administrator():
+        abort(403)
+    return jsonify({"purged": answer_cache.purge()})
+
+
+@main.route("/export/<kind>.<fmt>")
+@login_required
+def export_data(kind, fmt):
+    # お問い合わせ・チャット履歴をストリーミングでダウンロードする（main/exports.py）
+    if not current_user.is_administrator():
+        abort(403)
+    if kind not in exports.EXPORTS or fmt not in exports.FORMATS:
+        abort(404)
+    try:
+        start = exports.parse_date(request.args.get("start"))
+        end = exports.parse_date(request.args.get("end"))
+    except ValueError:
+        abort(400)
+    body = exports.export(kind, fmt, start, end, request.args.get("session_id"))
+    filename = f"{kind}_{datetime.now().strftime('%Y%m%d%H%M%S')}.{fmt}"
+    return Response(
+        stream_with_context(body),
+        content_type=f"{exports.FORMATS[fmt]}; charset=utf-8",
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+
+@main.route("/chat_streams")
+@login_required
+def chat_stream_stats():
+    if not current_user.is_administrator():
+        abort(403)
+    return jsonify(single_flight.stats())
+
+
+@main.route("/question_classifier")
+@login_required
+def question_classifier_stats():
+    if not current_user.is_administrator():
+        abort(403)
+    return jsonify(question_classifier.stats())
+
+
+@main.route("/event_log")
+@login_required
+def event_log_stats():
+    if not current_user.is_administrator():
+        abort(403)
+    return jsonify(event_log.stats())
+
+
+# 動いているワーカーのプロファイリング（main/profiling.py）。結果はリクエストを受けたワーカーのもの
+@main.route("/profiling")
+@login_required
+def profiling_status():
+    if not current_user.is_administrator():
+        abort(403)
+    return jsonify(profiler.status())
+
+
+@main.route("/profiling/cpu/start", methods=["POST"])
+@login_required
+def profiling_cpu_start():
+    if not current_user.is_administrator():
+        abort(403)
+    started = profiler.start_cpu(
+        request.args.get("interval", type=float), request.args.get("seconds", type=float)
+    )
+    return jsonify({"started": started, **profiler.status()})
+
+
+@main.route("/profiling/cpu/stop", methods=["POST"])
+@login_required
+def profiling_cpu_stop():
+    if not current_user.is_administrator():
+        abort(403)
+    stopped = profiler.cpu.stop()
+    return jsonify({"stopped": stopped, **profiler.status()})
+
+
+@main.route("/profiling/cpu.collapsed")
+@login_required
+def profiling_cpu_collapsed():
+    if not current_user.is_administrator():
+        abort(403)
+    filename = f"cpu_{profiler.status()['pid']}_{datetime.now().strftime('%Y%m%d%H%M%S')}.collapsed"
+    return Response(
+        profiler.cpu.collapsed(),
+        content_type="text/plain; charset=utf-8",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+
+@main.route("/profiling/memory/start", methods=["POST"])
+@login_required
+def profiling_memory_start():
+    if not current_user.is_administrator():
+        abort(403)
+    started = profiler.start_memory(request.args.get("frames", type=int))
+    return jsonify({"started": started, **profiler.status()})
+
+
+@main.route("/profiling/memory/snapshot", methods=["POST"])
+@login_required
+def profiling_memory_snapshot():
+    if not current_user.is_administrator():
+        abort(403)
+    index = profiler.memory.snapshot()
+    if index is None:
+        # 記録を開始していない
+        abort(400)
+    return jsonify({"snapshot": index, **profiler.status()})
+
+
+@main.route("/profiling/memory/stop", methods=["POST"])
+@login_required
+def profiling_memory_stop():
+    if not current_user.is_administrator():
+        abort(403)
+    stopped = profiler.memory.stop()
+    return jsonify({"stopped": stopped, **profiler.status()})
+
+
+@main.route("/profiling/memory/<any(top, diff):kind>.txt")
+@login_required
+def profiling_memory_report(kind):
+    if not current_user.is_administrator():
+        abort(403)
+    limit = min(request.args.get("limit", 30, type=int), 500)
+    group = request.args.get("group", "lineno")
+    if group not in ("lineno", "filename", "traceback"):
+        abort(400)
+    index = request.args.get("snapshot", -1, type=int)
+    try:
+        if kind == "top":
+            body = profiler.memory.top(index, limit, group)
+        else:
+            body = profiler.memory.diff(request.args.get("base", 0, type=int), index, limit, group)
+    except IndexError:
+        abort(404)
+    return Response(body, content_type="text/plain; charset=utf-8")
+
+
 # 静的ページの配信
 # @main.route("/info")
 # def info():
@@ -324,27 +633,28 @@ def delete_inquiry(inquiry_id):
 
 
 @main.route("/chat_session", methods=["GET"])
-# @limiter.limit("6 per minute")
+@governor.limit(lambda: session.get("session_id"))
 def chat_session():
     import uuid
 
     try:
-        print("chat_session")
         # ページがリロードされるごとにセッションをリセットする。つまりセッションではない。セッションを利用したい場合はreset_session()をコメントアウトすること
         # ログインがないため基本的には毎回セッションが作成される。
         # reset_session()
-        if "session_id" not in session:
+        # ?lazy=1の場合（Cookieを送り返すブラウザ）、UserSessionは最初の質問を保存するとき
+        # （save_chat）に作成し、ここではCookieに保存するだけにする。
+        # Cookieを使わないAPI・Socket.IOのクライアントは、返したsession_idだけを送ってくるため、
+        # 指定がない場合は従来どおりここで作成する。
+        created = "session_id" not in session
+        if created:
             session_id = str(uuid.uuid4())
             session["session_id"] = session_id
         else:
             session_id = session["session_id"]
-        chat_session = UserSession.query.get(session_id)
-        if chat_session is None:
-            chat_session = UserSession(session_id=session_id)
-            db.session.add(chat_session)
-            db.session.commit()
+        if request.args.get("lazy") != "1":
+            materialize_session(session_id)
 
-        print(f"session_id is {session_id}")
+        event_log.info("chat_session", session_id=session_id, created=created)
         return jsonify({"session_id": session_id})
 
     except Exception as e:
@@ -353,53 +663,215 @@ def chat_session():
 
 def reset_session():
     session.pop("session_id", None)  # Remove session_id from the session
-    print("セッションリセットされました！！")
+    event_log.info("reset_session")
 
 
 @main.route("/save_chat", methods=["POST"])
-# @limiter.limit("6 per minute")
+@governor.limit(lambda: (request.get_json(silent=True) or {}).get("session_id"))
 def save_chat():
     data = request.json
     message = data.get("message")
     client_session_id = data.get("session_id")
-    chat_history_id = data.get("chat_history_id")
-    print("save_chat")
-    session_obj = UserSession.query.get(client_session_id)
+    chat_history_id = parse_chat_history_id(data.get("chat_history_id"))
+    event_log.info(
+        "save_chat",
+        session_id=client_session_id,
+        chat_history_id=chat_history_id,
+        chars=len(message or ""),
+    )
 
-    if session_obj:
-        print(
-            {
-                f"Session ID:{session_obj.session_id},user_id:{session_obj.user_id},created_at:{session_obj.created_at},title:{session_obj.title}"
-            }
-        )
-    else:
-        print("エラー：ストリームの際のチャット履歴の保存プログラム。セッションオブジェクトを見つけられませんでした。")
-        return jsonify({"error": f"セッションオブジェクトが見つかりません。session_obj:{session_obj}"}), 404
+    if chat_history_id is None:
+        return jsonify({"error": "chat_history_idには0以上の整数を指定してください。"}), 400
+    if not materialize_session(client_session_id):
+        event_log.warning("save_chat.session_not_found", session_id=client_session_id)
+        return jsonify({"error": "セッションオブジェクトが見つかりません。"}), 404
 
     # 会話履歴の保存
+    save_user_message(message, client_session_id, chat_history_id)
+    return jsonify({"success": "Chat history saved successfully"}), 200
+
+
+def parse_chat_history_id(value):
+    # 0以上の整数でない場合はNone（boolはintのサブクラスのため除く）
+    if isinstance(value, bool):
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value >= 0 else None
+
+
+def session_exists(session_id):
+    # まずプロセス内のキャッシュで確認し、見つからない場合だけDBを検索する（main/known_sessions.py）
+    if not session_id:
+        return False
+    if session_id in known_sessions:
+        return True
+    if UserSession.query.get(session_id) is None:
+        return False
+    known_sessions.add(session_id)
+    return True
+
+
+def is_own_session(session_id):
+    # chat_sessionで発行し、署名付きCookieに保存したセッションか
+    return bool(session_id) and session.get("session_id") == session_id
+
+
+def materialize_session(session_id):
+    # 最初の質問のときに、Cookieにだけあるセッションを作成する
+    if session_exists(session_id):
+        return True
+    if not is_own_session(session_id):
+        return False
+    try:
+        db.session.add(UserSession(session_id=session_id))
+        db.session.commit()
+    except IntegrityError:
+        # 同時に作成された場合
+        db.session.rollback()
+    known_sessions.add(session_id)
+    return True
+
+
+def save_user_message(message, session_id, chat_history_id):
     new_message = Message(
-        chat_history_id=chat_history_id, session_id=client_session_id, content=message
+        chat_history_id=chat_history_id, session_id=session_id, content=message
     )
     db.session.add(new_message)
     db.session.commit()
-    return jsonify({"success": "Chat history saved successfully"}), 200
 
 
 @main.route("/chat_sse", methods=["GET"])
-# @limiter.limit("6 per minute")
 def chat_sse():
-    MAX_HISTORY_CHARS = 2000  # 会話を記憶する最大量
+    # 再接続の場合は生成中・生成済みの回答の続きを返す（main/resumable.py）。
+    # 同じ回答を生成中の場合は、回答のストリームを作らずにそちらに接続する。
+    # どちらも新しい回答は生成しないため、リクエスト数・同時ストリーム数の制限には数えない
+    # （切断した前の接続の枠は、サーバーが切断に気付くまで解放されないため）
     client_session_id = request.args.get("data")
+    resumed = resume_answer_stream(
+        client_session_id, request.headers.get("Last-Event-ID")
+    )
+    if resumed is not None:
+        return resumed
+    stream = answer_in_progress(client_session_id)
+    if stream is not None:
+        return event_stream_response(
+            stream.subscribe(heartbeat=resumable_streams.heartbeat), stream.key[1]
+        )
+    return answer_sse()
+
+
+@governor.limit(lambda: request.args.get("data"), scope="chat_sse")
+@governor.stream(lambda: request.args.get("data"))
+def answer_sse():
+    client_session_id = request.args.get("data")
+    chunks, chat_history_id = build_answer_stream(client_session_id)
+    if chunks is None:
+        return jsonify({"error": "チャット履歴が見つかりません。"}), 404
+    return sse_response(chunks, client_session_id, chat_history_id)
+
+
+def answer_in_progress(session_id):
+    # 次に回答するchat_history_id（最後のメッセージ+1）のストリームが生成中なら返す
+    last = (
+        Message.query.with_entities(Message.chat_history_id)
+        .filter_by(session_id=session_id)
+        .order_by(Message.create_at.desc())
+        .first()
+    )
+    if last is None:
+        return None
+    stream = resumable_streams.get((session_id, last.chat_history_id + 1))
+    if stream is not None and not stream.done:
+        return stream
+    return None
+
+
+def sse_response(chunks, session_id, chat_history_id):
+    config = current_app.config
+    app = current_app._get_current_object()
+    key = (session_id, chat_history_id)
+
+    stream = resumable_streams.get(key)
+    if stream is not None and not stream.done:
+        # answer_in_progressの確認の後に同時に開始された場合。回答のストリームは
+        # まだ読み出していないため、閉じてもOpenAIへのリクエスト・受信者の登録は行われていない
+        chunks.close()
+    else:
+        # 細かい差分をまとめてから送る（main/streaming.py）
+        chunks = coalesce(
+            chunks,
+            max_chars=config.get("CHAT_SSE_COALESCE_CHARS", 24),
+            max_delay=config.get("CHAT_SSE_COALESCE_DELAY", 0.05),
+            app=app,
+        )
+        stream = resumable_streams.start(key, chunks, app)
+    return event_stream_response(
+        stream.subscribe(heartbeat=resumable_streams.heartbeat), chat_history_id
+    )
+
+
+def resume_answer_stream(session_id, last_event_id):
+    parsed = parse_event_id(last_event_id)
+    if parsed is None:
+        return None
+    chat_history_id, seq, offset = parsed
+
+    stream = resumable_streams.get((session_id, chat_history_id))
+    if stream is not None:
+        return event_stream_response(
+            stream.subscribe(seq, heartbeat=resumable_streams.heartbeat),
+            chat_history_id,
+        )
+
+    # 別のワーカーで生成された場合やバッファが破棄された後は、DBに保存済みの回答から再生する
+    saved = Message.query.filter_by(
+        session_id=session_id, chat_history_id=chat_history_id, role="assistant"
+    ).first()
+    if saved is not None:
+        return event_stream_response(
+            replay_saved_answer(saved.content, chat_history_id, seq, offset),
+            chat_history_id,
+        )
+    return None
+
 
-    session_obj = UserSession.query.get(client_session_id)
+def event_stream_response(events, chat_history_id):
+    config = current_app.config
+    frames = to_sse_events(events, chat_history_id)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    # CHAT_SSE_GZIPが有効で、クライアントがgzipを受け付ける場合は圧縮して送る
+    if config.get("CHAT_SSE_GZIP", False) and "gzip" in request.accept_encodings:
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+        frames = gzip_stream(frames)
+    return Response(frames, content_type="text/event-stream", headers=headers)
+
+
+"""
+    会話履歴から回答のストリーム（Chunkのジェネレーター）を作成する。
+    /chat_sse と Socket.IO（socket_events.py）の両方から使用する。
+    回答のストリームと、回答を保存するchat_history_idを返す。
+    セッションまたはメッセージが見つからない場合は (None, None) を返す。
+"""
+
+
+def build_answer_stream(client_session_id):
+    MAX_HISTORY_CHARS = current_app.config["CHAT_HISTORY_MAX_CHARS"]  # 会話を記憶する最大量
+
+    if not session_exists(client_session_id):
+        event_log.warning("chat_sse.session_not_found", session_id=client_session_id)
+        return None, None
     messages = (
-        Message.query.filter_by(session_id=session_obj.session_id)
+        Message.query.filter_by(session_id=client_session_id)
         .order_by(Message.create_at)
         .all()
     )
     if not messages:
-        print("chat_sseエラー：メッセージが保存されていません。")
-        return
+        event_log.warning("chat_sse.no_messages", session_id=client_session_id)
+        return None, None
 
     # ユーザーからの質問内容を判断する。
     last_chat_message = messages[-1]
@@ -414,26 +886,62 @@ def chat_sse():
         data, max_history_chars=MAX_HISTORY_CHARS
     )  # max_iistory_charsは会話履歴の切り詰め
 
+    # 切り詰めた分の会話は要約を送る（main/summary.py）
+    summary = summarizer.summary_for(client_session_id, messages)
+    if summary:
+        chat_history.insert(
+            0,
+            {
+                "role": "system",
+                "action": "summary",
+                "content": f"これまでの会話の要約: {summary}",
+            },
+        )
+
     # ここで会話履歴をGPTに判断させて条件分岐を行う
     message = chat_history
     next_chat_history = messages[-1].chat_history_id + 1
-    kind = judge_question.get("kind")
-    if kind == "general":
+    # 回答はバックグラウンドで生成するため、ログのrequest_id・session_idを渡しておく（main/event_log.py）
+    ids = event_log.ids(client_session_id)
+    kind = judge_question.get("kind") if judge_question is not None else None
+    if judge_question is None:
+        # OpenAIが利用できない場合は定型の回答を返す
+        chunks = busy_answer()
+    elif kind == "general":
         # 特にサイトと関係のない一般的な質問の場合
-        return Response(
-            ask_langchain(message, session_obj.session_id, next_chat_history),
-            content_type="text/event-stream",
-        )
+        chunks = answer_stream(kind, message, messages, lambda: ask_langchain(message, ids))
     elif kind == "related":
-        return Response(
-            ask_gpt(message, session_obj.session_id, next_chat_history),
-            content_type="text/event-stream",
+        # サイトの記事から質問と近い内容を探し、参考情報として送る（main/vector_index.py）
+        context = related_context(last_chat_message.content)
+        chunks = answer_stream(
+            kind,
+            message,
+            messages,
+            lambda: ask_gpt(message, context, ids),
+            budget=ANSWER_MAX_TOKENS,
         )
     else:
-        return Response(
-            generate_text("私は福祉の仕事についてお話をするAIチャットボットです。このメッセージにはお答えすることができません。"),
-            content_type="text/event-stream",
+        chunks = generate_text(
+            "私は福祉の仕事についてお話をするAIチャットボットです。このメッセージにはお答えすることができません。"
         )
+    # キャッシュの再生を含め、どの回答もsave_answerで保存する
+    return save_answer(chunks, client_session_id, next_chat_history), next_chat_history
+
+
+def answer_stream(kind, message, messages, factory, budget=None):
+    # 最初の質問はキャッシュ済みの回答があれば再生する（main/answer_cache.py）
+    cache_key = None
+    if len(messages) == 1:
+        cache_key = answer_cache.make_key(kind, messages[0].content)
+        cached = answer_cache.get(cache_key)
+        if cached is not None:
+            return answer_cache.replay(cached)
+
+    # 同じ会話履歴・種別の回答を生成中の場合は、そのストリームを共有する（main/coalesce.py）
+    chunks = single_flight.stream(make_key(kind, message), factory, budget)
+    if cache_key is not None:
+        chunks = answer_cache.record(cache_key, chunks)
+    return chunks
 
 
 def generate_text(text):
@@ -441,7 +949,7 @@ def generate_text(text):
 
     for s in text.replace("\n", "<br>"):
         time.sleep(0.05)
-        yield f"data:{s}\n\n"
+        yield Chunk(s, s)
 
 
 def get_chat_history(data, max_history_chars=500):
@@ -490,14 +998,19 @@ def get_chat_history(data, max_history_chars=500):
 """
 
 
-def ask_gpt(message, session_id, chat_history_id):
-    import openai
-    import os
-    from openai.error import RateLimitError, ServiceUnavailableError
+ANSWER_MAX_TOKENS = 500  # 回答の最大トークン数
 
-    openai.api_key = os.environ.get("OPENAI_API_KEY")
 
-    output_content = ""  # この変数に出力内容を保持します。
+def related_context(question):
+    try:
+        results = vector_index.search(question)
+    except Exception as e:
+        event_log.warning("related_context.failed", error=str(e))
+        return ""
+    return "\n---\n".join(text for _, _, text in results)
+
+
+def ask_gpt(message, context="", ids=None):
     system_prompt = ""  # システムプロンプト
 
     system_prompt = """
@@ -511,63 +1024,60 @@ def ask_gpt(message, session_id, chat_history_id):
     user_prompt = f"""
     ■お客様のご要望(会話履歴):\n{message}\n\n ,
     """
+    if context:
+        user_prompt += f"""
+    ■参考情報(当サイトの記事):\n{context}\n\n
+    参考情報に関係する内容がある場合は、参考情報をもとに回答してください。
+    """
 
+    # リトライ・ヘッジ・サーキットブレーカーはchat_clientで行う（main/resilience.py）
     try:
-        response = openai.ChatCompletion.create(
+        response = chat_client.stream_completion(
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt},
             ],
-            model="gpt-3.5-turbo",
             temperature=0.5,
-            stream=True,
-            max_tokens=500,
-        )
-    except RateLimitError as e:
-        error_message = "現在サーバーが過不可です。しばらく時間をおいてからお試しください。"
-        output_content = error_message
-        # logging.debug(f"RateLimitError: \ne:{e} \nerror_message:{error_message}")
-        print(f"RateLimitError: \ne:{e} \nerror_message:{error_message}")
-        save_to_db_message(
-            output_content, session_id, chat_history_id, action="エラーメッセージ"
+            max_tokens=ANSWER_MAX_TOKENS,
         )
-        yield f"data: {error_message}\n{e}\n\n"
-    except ServiceUnavailableError as e:
-        error_message = "現在サーバーが過不可です。しばらく時間をおいてからお試しください。"
-        output_content = error_message
-        # logging.debug(f"ServiceUnavailableError: \ne:{e} \nerror_message:{error_message}")
-        print(f"ServiceUnavailableError: \ne:{e} \nerror_message:{error_message}")
-        save_to_db_message(
-            output_content, session_id, chat_history_id, action="エラーメッセージ"
-        )
-        yield f"data: {error_message}\n{e}\n\n"
-
-    for res in response:
-        try:
-            if res["choices"][0]["finish_reason"] != "stop":
-                content = res["choices"][0]["delta"]["content"]
-                output_content += content  # 保持用変数に出力内容を追加
-                # content = content.replace("\n", "<br>")
-                yield f"data: {content}\n\n"
-            else:
-                yield f"data: stop\n\n"
-                break
-            pass
-        except KeyError:
-            print(res["choices"][0]["finish_reason"])
-            if (
-                res["choices"][0]["finish_reason"] is not None
-                and res["choices"][0]["finish_reason"] != "stop"
-            ):
-                yield f"data: stop_質問文が長すぎるため、短くしてお試しください。\n\n"
-                break
-            elif res["choices"][0]["finish_reason"] == "stop":
-                yield f"data: stop\n\n"
-                break
-            pass
-    save_to_db_message(
-        output_content, session_id, chat_history_id, action=""
-    )  # ストリーム完了後にDBに保存
+        for res in response:
+            try:
+                if res["choices"][0]["finish_reason"] != "stop":
+                    content = res["choices"][0]["delta"]["content"]
+                    # content = content.replace("\n", "<br>")
+                    yield Chunk(content, content)  # 保存用の出力内容にも追加される
+                else:
+                    yield Chunk(STOP)
+                    break
+                pass
+            except KeyError:
+                event_log.info(
+                    "ask_gpt.finish_reason",
+                    ids=ids,
+                    finish_reason=res["choices"][0]["finish_reason"],
+                )
+                if (
+                    res["choices"][0]["finish_reason"] is not None
+                    and res["choices"][0]["finish_reason"] != "stop"
+                ):
+                    yield Chunk(f"{STOP}_質問文が長すぎるため、短くしてお試しください。")
+                    break
+                elif res["choices"][0]["finish_reason"] == "stop":
+                    yield Chunk(STOP)
+                    break
+                pass
+    except chat_client.retryable_errors + (CircuitOpenError,) as e:
+        event_log.warning("ask_gpt.busy", ids=ids, error=type(e).__name__, detail=str(e))
+        yield from busy_answer(e)
+
+
+BUSY_MESSAGE = "現在サーバーが過不可です。しばらく時間をおいてからお試しください。"
+
+
+def busy_answer(e=None):
+    # OpenAIが利用できない場合の定型の回答
+    data = f"{BUSY_MESSAGE}\n{e}" if e is not None else BUSY_MESSAGE
+    yield Chunk(data, BUSY_MESSAGE, action="エラーメッセージ")
 
 
 """
@@ -576,18 +1086,8 @@ def ask_gpt(message, session_id, chat_history_id):
 
 
 # 一旦エージェントはおいておいて、langchainを使って回答をストリーミングで返すことを考える。
-def ask_langchain(message, session_id, chat_history_id):
+def ask_langchain(message, ids=None):
     import time
-    from langchain.chat_models import ChatOpenAI
-    from langchain.prompts.chat import (
-        ChatPromptTemplate,
-        SystemMessagePromptTemplate,
-        MessagesPlaceholder,
-        HumanMessagePromptTemplate,
-    )
-
-    from langchain.chains import ConversationChain
-    from langchain.memory import ConversationBufferMemory
 
     # from langchain.agents import load_tools
     # from langchain.agents import initialize_agent
@@ -600,35 +1100,55 @@ def ask_langchain(message, session_id, chat_history_id):
     #     tools=tools, llm=llm, agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION, verbose=True
     # )
 
-    chat = ChatOpenAI(
-        temperature="0.5",
-        streaming=True,
-        model="gpt-3.5-turbo",
-        request_timeout=10000,
-    )
-    memory = ConversationBufferMemory(return_messages=True)
+    # プロンプトとチェーンはchat_clientで作成済みのものを使い回す（main/chat_client.py）
+    try:
+        response = chat_client.predict(message)
+    except chat_client.retryable_errors + (CircuitOpenError,) as e:
+        event_log.warning(
+            "ask_langchain.busy", ids=ids, error=type(e).__name__, detail=str(e)
+        )
+        yield from busy_answer(e)
+        return
+    for char in response:
+        time.sleep(0.1)
+        yield Chunk(char, char)
 
-    template = """
-    以下は、人間とAIのフレンドリーな会話です。
-    AIはその文脈から具体的な内容をたくさん教えてくれます。
-    AIは質問の答えを知らない場合、正直に「知らない」と答えます。
-    """
 
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            SystemMessagePromptTemplate.from_template(template),
-            MessagesPlaceholder(variable_name="history"),
-            HumanMessagePromptTemplate.from_template("{input}"),
-        ]
-    )
+CANCELLED_ACTION = "中断"
 
-    conversation = ConversationChain(llm=chat, memory=memory, prompt=prompt)
-    response = conversation.predict(input=str(message))
-    for char in response:
-        time.sleep(0.1)
-        yield f"data: {char}\n\n"
-    history = memory.chat_memory
-    print(history)
+
+def save_answer(chunks, session_id, chat_history_id):
+    output_content = ""  # この変数に出力内容を保持します。
+    action = ""
+    try:
+        for chunk in chunks:
+            output_content += chunk.text
+            if chunk.action is not None:
+                action = chunk.action
+            yield chunk
+    except GeneratorExit:
+        # クライアントの切断で生成を中止した場合は、途中までの回答を保存する
+        if output_content:
+            try:
+                save_to_db_message(
+                    output_content, session_id, chat_history_id, action=CANCELLED_ACTION
+                )
+            except Exception as e:
+                db.session.rollback()
+                event_log.error(
+                    "save_answer.cancel_failed", session_id=session_id, error=str(e)
+                )
+        raise
+    finally:
+        # 元のストリームも閉じ、OpenAIへのストリームを止める
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+    save_to_db_message(
+        output_content, session_id, chat_history_id, action=action
+    )  # ストリーム完了後にDBに保存
+    # 直近の会話から外れたメッセージを要約に追加する
+    summarizer.schedule(current_app._get_current_object(), session_id)
 
 
 def save_to_db_message(content, session_id, chat_history_id, action=""):
@@ -644,12 +1164,33 @@ def save_to_db_message(content, session_id, chat_history_id, action=""):
 
 
 def judge_user_question(message):
-    import json
-    import openai
-    import os
-    from openai.error import RateLimitError, ServiceUnavailableError
+    # 確信度の高い場合はローカルの分類器で判断し、OpenAIを呼び出さない（main/question_classifier.py）
+    prediction = question_classifier.predict(message.content)
+    if question_classifier.use_local(prediction):
+        event_log.info(
+            "question_kind",
+            session_id=message.session_id,
+            source="local",
+            kind=prediction.kind,
+            confidence=round(prediction.confidence, 3),
+        )
+        return {"question": message.content, "kind": prediction.kind}
+    function_args = ask_question_kind(message)
+    if function_args is not None:
+        question_classifier.record(message.content, function_args.get("kind"), prediction)
+        event_log.info(
+            "question_kind",
+            session_id=message.session_id,
+            source="upstream",
+            kind=function_args.get("kind"),
+            local_kind=prediction.kind,
+            confidence=round(prediction.confidence, 3),
+        )
+    return function_args
+
 
-    openai.api_key = os.environ.get("OPENAI_API_KEY")
+def ask_question_kind(message):
+    import json
 
     system_prompt = """
         あなたは福祉についてのHPを運営しています。
@@ -686,27 +1227,26 @@ def judge_user_question(message):
         {"role": "user", "content": f"{message.content}"},
     ]
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        response = chat_client.create_completion(
             messages=messages,
             functions=functions,
             function_call={"name": "user_question_to_answer"},
         )
-    except RateLimitError as e:
-        error_message = "現在サーバーが過不可です。しばらく時間をおいてからお試しください。"
-        print(f"RateLimitError: \ne:{e} \nerror_message:{error_message}")
-        return f"Error at judge_user_question: {error_message}\n{e}\n\n"
-    except ServiceUnavailableError as e:
-        error_message = "現在サーバーが過不可です。しばらく時間をおいてからお試しください。"
-        print(f"ServiceUnavailableError: \ne:{e} \nerror_message:{error_message}")
-        return f"Error at judge_user_question: {error_message}\n{e}\n\n"
+    except chat_client.retryable_errors + (CircuitOpenError,) as e:
+        # 呼び出し元では定型の回答を返す
+        event_log.warning(
+            "question_kind.busy",
+            session_id=message.session_id,
+            error=type(e).__name__,
+            detail=str(e),
+        )
+        return None
     response_message = response["choices"][0]["message"]
     # 設定したファンクションコーリングがAI側で使うと判断された場合。
     if response_message.get("function_call"):
         function_args = json.loads(response_message["function_call"]["arguments"])
-        print(function_args)
         return function_args
     else:
-        error_msg = "エラー：judge_user_questionの強制ファンクションコールが発火しませんでした。"
-        print(error_msg)
+        # judge_user_questionの強制ファンクションコールが発火しなかった
+        event_log.warning("question_kind.no_function_call", session_id=message.session_id)
         return None
@@ -4,7 +4,8 @@ from werkzeug.security import check_password_hash, generate_password_hash
 from flask_login import (
     UserMixin,
 )
-from flask_chat_server import db, login_manager
+from flask_chat_server import db, login_manager, text_codec
+from flask_chat_server.main.compressed_text import CompressedText
 
 
 @login_manager.user_loader
@@ -60,7 +61,8 @@ class BlogPost(db.Model):
     category_id = db.Column(db.Integer, db.ForeignKey("blog_category.id"))
     date = db.Column(db.DateTime, default=datetime.now(timezone("Asia/Tokyo")))
     title = db.Column(db.String(140))
-    text = db.Column(db.Text)
+    # 一覧のページでは使わないため、表示するときだけ読み込む（main/compressed_text.py参照）
+    text = db.deferred(db.Column(CompressedText("blog_post.text", text_codec)))
     summary = db.Column(db.String(140))
     featured_image = db.Column(db.String(140))
 
@@ -76,6 +78,17 @@ class BlogPost(db.Model):
         return f"PostID: {self.id}, Title: {self.title}, Author: {self.author}\n"
 
 
+# blog_post.textを圧縮する場合の、検索用の本文（タグを除き、圧縮しない。main/compressed_text.py参照）
+class BlogPostSearchText(db.Model):
+    __tablename__ = "blog_post_search_text"
+
+    post_id = db.Column(db.Integer, primary_key=True)
+    text = db.Column(db.Text, nullable=False)
+
+    def __repr__(self):
+        return f"BlogPostSearchText: {self.post_id}"
+
+
 class BlogCategory(db.Model):
     __tablename__ = "blog_category"
     id = db.Column(db.Integer, primary_key=True)
@@ -116,7 +129,10 @@ class UserSession(db.Model):
 
     session_id = db.Column(db.String(100), primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.now(timezone("Asia/Tokyo")))
+    # 関数を渡さないとimport時の日時が全ての行に入るため、lambdaで行ごとに日時を取得する
+    created_at = db.Column(
+        db.DateTime, default=lambda: datetime.now(timezone("Asia/Tokyo"))
+    )
     title = db.Column(db.String(100), nullable=True)
     important_info = db.Column(db.Text, nullable=True)
 
@@ -135,10 +151,51 @@ class Message(db.Model):
     )
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=True)
     chat_id = db.Column(db.String(100), nullable=True)
-    content = db.Column(db.Text, nullable=False)
+    # COMPRESSED_TEXT_COLUMNSに含めた場合は圧縮して保存する（main/compressed_text.py参照）
+    content = db.Column(CompressedText("messages.content", text_codec), nullable=False)
     role = db.Column(db.Text, nullable=False, default="user")
-    create_at = db.Column(db.DateTime, default=datetime.now(timezone("Asia/Tokyo")))
+    create_at = db.Column(
+        db.DateTime, default=lambda: datetime.now(timezone("Asia/Tokyo"))
+    )
     action = db.Column(db.String(100), nullable=True)
 
     def __repr__(self):
         return f"Message: {self.content}"
+
+
+# 一定期間使われていないセッションを、メッセージと一緒にまとめて保存するテーブル（main/compaction.py参照）
+class ArchivedSession(db.Model):
+    __tablename__ = "archived_sessions"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    session_id = db.Column(db.String(100), index=True, nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)
+    title = db.Column(db.String(100), nullable=True)
+    important_info = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=True)
+    last_active_at = db.Column(db.DateTime, nullable=True)
+    archived_at = db.Column(
+        db.DateTime, default=lambda: datetime.now(timezone("Asia/Tokyo"))
+    )
+    message_count = db.Column(db.Integer, nullable=False, default=0)
+    # メッセージのリストをJSONにしてzlibで圧縮したもの
+    messages = db.Column(db.LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return f"ArchivedSession: {self.session_id}"
+
+
+# 圧縮保存する列（CompressedText）の辞書。圧縮したデータは辞書のIDで参照するため、削除しない
+class TextDictionary(db.Model):
+    __tablename__ = "text_dictionaries"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    column = db.Column(db.String(100), nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    sample_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(
+        db.DateTime, default=lambda: datetime.now(timezone("Asia/Tokyo"))
+    )
+
+    def __repr__(self):
+        return f"TextDictionary: {self.id} ({self.column})"
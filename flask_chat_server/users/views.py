@@ -15,7 +15,7 @@ from flask_login import (
     current_user,
 )
 
-from flask_chat_server import db
+from flask_chat_server import db, fragment_cache
 from flask_chat_server.models import User, BlogPost, BlogCategory
 from flask_chat_server.users.forms import RegistrationForm, LoginForm, UpdateUserForm
 from flask_chat_server.main.forms import BlogSearchForm
@@ -93,11 +93,15 @@ def account(user_id):
 
     form = UpdateUserForm(user_id)
     if form.validate_on_submit():
+        renamed = user.username != form.username.data
         user.username = form.username.data
         user.email = form.email.data
         if form.password.data:
             user.password = form.password.data
         db.session.commit()
+        if renamed:
+            # 記事のカード・本文のキャッシュには投稿者名が含まれるため、作り直させる
+            bump_user_posts(user.id)
         flash("ユーザーアカウントが更新されました。")
         return redirect(url_for("users.user_maintenance"))
     elif request.method == "GET":
@@ -106,6 +110,12 @@ def account(user_id):
     return render_template("users/account.html", form=form)
 
 
+def bump_user_posts(user_id):
+    # ユーザーの全記事のフラグメントキャッシュを使わないようにする（main/template_cache.py）
+    for (post_id,) in BlogPost.query.with_entities(BlogPost.id).filter_by(user_id=user_id):
+        fragment_cache.bump(post_id)
+
+
 @users.route("/<int:user_id>/delete", methods=["GET", "POST"])
 @login_required
 def delete_user(user_id):
@@ -122,6 +132,7 @@ def delete_user(user_id):
 
     db.session.delete(user)
     db.session.commit()
+    bump_user_posts(user_id)
     flash("ユーザーアカウントが削除されました。")
     return redirect(url_for("users.user_maintenance"))
 
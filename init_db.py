@@ -1,16 +1,18 @@
-from flask_chat_server import db
+from flask_chat_server import create_app, db
 from flask_chat_server.models import User
 
-db.drop_all()
+app = create_app()
 
-db.create_all()
+with app.app_context():
+    db.drop_all()
 
+    db.create_all()
 
-admin = User(
-    email="admin_user@test.com",
-    username="Admin User",
-    password="adminuser9182",
-    administrator="1",
-)
-db.session.add(admin)
-db.session.commit()
+    admin = User(
+        email="admin_user@test.com",
+        username="Admin User",
+        password="adminuser9182",
+        administrator="1",
+    )
+    db.session.add(admin)
+    db.session.commit()
@@ -0,0 +1,157 @@
+import eventlet
+
+# 他のモジュール（socket・threading・requests・SQLAlchemyのドライバーなど）をimportする前に
+# パッチを当てる。これより前にimportしたモジュールは通常のスレッド・ソケットのまま動いてしまう。
+eventlet.monkey_patch()
+
+import os
+import resource
+import signal
+
+import eventlet.wsgi
+import greenlet
+
+"""
+    本番用の起動スクリプト（python serve.py）。
+    eventletのグリーンスレッドで動かすため、開いたままの/chat_sseのストリームが
+    1本ごとにOSのスレッドを占有せず、1プロセスで数千本のストリームを保持できる。
+    親プロセスでアプリケーションを作成（プリロード）してから、ワーカーをforkする。
+    DB・OpenAIへの接続はfork後に各ワーカーで作り直される（flask_chat_server.after_fork）。
+    スレッドはforkで引き継がれないため、セッションの整理（SESSION_COMPACTION_INTERVAL）の
+    スレッドは親プロセスでは開始せず、最初のワーカーだけで開始する。
+    開いたままのストリームのメモリ・ファイルディスクリプター・ハートビートの遅れは
+    sse_load_test.py で計測できる。
+
+    設定（環境変数）
+        SERVE_HOST              待ち受けるアドレス
+        SERVE_PORT              待ち受けるポート
+        SERVE_WORKERS           ワーカープロセス数
+        SERVE_MAX_CONNECTIONS   1ワーカーあたりの同時接続数の上限
+        SERVE_BACKLOG           listenのバックログ
+        SERVE_SEPARATE_PORTS    1の場合、ワーカーごとに SERVE_PORT + 番号 で待ち受ける。
+                                Socket.IOのlong-pollingで複数ワーカーを使う場合は、
+                                ロードバランサーでスティッキーセッションにするためこちらを使う
+        SERVE_ACCESS_LOG        1の場合、アクセスログを出力する
+        SERVE_GRACEFUL_TIMEOUT  SIGTERMを受けてから、開いているストリームを待つ秒数
+    FLASK_CONFIGを省略した場合はproductionの設定で起動する。
+"""
+
+os.environ.setdefault("FLASK_CONFIG", "production")
+os.environ.setdefault("SOCKETIO_ASYNC_MODE", "eventlet")
+
+from flask_chat_server import create_app  # noqa: E402
+from flask_chat_server.main import compaction  # noqa: E402
+
+HOST = os.environ.get("SERVE_HOST", "0.0.0.0")
+PORT = int(os.environ.get("SERVE_PORT", "8000"))
+WORKERS = int(os.environ.get("SERVE_WORKERS", str(os.cpu_count() or 1)))
+MAX_CONNECTIONS = int(os.environ.get("SERVE_MAX_CONNECTIONS", "10000"))
+BACKLOG = int(os.environ.get("SERVE_BACKLOG", "2048"))
+SEPARATE_PORTS = os.environ.get("SERVE_SEPARATE_PORTS", "0") == "1"
+ACCESS_LOG = os.environ.get("SERVE_ACCESS_LOG", "0") == "1"
+GRACEFUL_TIMEOUT = float(os.environ.get("SERVE_GRACEFUL_TIMEOUT", "10"))
+
+
+def raise_file_limit(connections):
+    # 接続ごとにファイルディスクリプターを使うため、上限をできるだけ引き上げる
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = connections + 256
+    if soft < wanted:
+        target = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+def run_worker(app, sock, index=0):
+    if index == 0 and app.config["SESSION_COMPACTION_INTERVAL"]:
+        compaction.start_compaction_thread(app)
+    main_greenlet = greenlet.getcurrent()
+    # シグナルハンドラーはハブがepollで待っている間に呼ばれ、そこで登録したタイマーは
+    # 他のイベントが起きるまで動かない。set_wakeup_fdでシグナルをパイプに書き込ませ、
+    # 別のグリーンスレッドで読んで終了処理をする。
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGTERM, lambda *_: None)
+
+    def watch_signals():
+        while signal.SIGTERM not in os.read(wakeup_r, 64):
+            pass
+        # acceptしているグリーンスレッドにSystemExitを送って受け付けを止め、
+        # 開いたままのストリームはGRACEFUL_TIMEOUT秒後に打ち切る
+        eventlet.spawn_after(GRACEFUL_TIMEOUT, os._exit, 0)
+        main_greenlet.throw(SystemExit)
+
+    eventlet.spawn_n(watch_signals)
+    eventlet.wsgi.server(
+        sock,
+        app,
+        max_size=MAX_CONNECTIONS,
+        log_output=ACCESS_LOG,
+        keepalive=True,
+        # 既定では4KBたまるまで書き込まないため、SSEのフレームが届かない。
+        # Flask-SocketIOがenvironをコピーするので、リクエストごと
+        # （environ["eventlet.minimum_write_chunk_size"]）ではなくサーバー全体で設定する
+        minimum_chunk_size=1,
+    )
+
+
+def main():
+    raise_file_limit(MAX_CONNECTIONS)
+    app = create_app({"SESSION_COMPACTION_AUTOSTART": False})
+
+    if SEPARATE_PORTS:
+        sockets = [
+            eventlet.listen((HOST, PORT + i), backlog=BACKLOG) for i in range(WORKERS)
+        ]
+    else:
+        # 全ワーカーで同じソケットからacceptする
+        sockets = [eventlet.listen((HOST, PORT), backlog=BACKLOG)] * WORKERS
+
+    if WORKERS <= 1:
+        run_worker(app, sockets[0])
+        return
+
+    children = {}
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            # epollのハブは親プロセスと共有されたままのため、子プロセスで作り直す
+            eventlet.hubs.use_hub()
+            run_worker(app, sockets[index], index)
+            os._exit(0)
+        children[pid] = index
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(WORKERS):
+        spawn(index)
+    print(f"{WORKERS}個のワーカーで起動しました（{HOST}:{PORT}）。")
+
+    # 異常終了したワーカーは起動し直す
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            print(f"ワーカー（pid {pid}）が終了したため、起動し直します。")
+            spawn(index)
+
+
+if __name__ == "__main__":
+    main()
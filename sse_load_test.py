@@ -0,0 +1,273 @@
+import argparse
+import os
+import resource
+import selectors
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+    serve.pyで起動したサーバー（プリフォークのeventlet）に、開いたままの/chat_sseのストリームを
+    N本つなぎ、ワーカーのメモリ（RSS）・ファイルディスクリプター数と、ハートビートの遅れを計測する。
+    回答の生成は何も返さないストリームに置き換えるため、OpenAIは使わず、各ストリームには
+    CHAT_SSE_HEARTBEAT秒ごとのハートビート（": ping"）だけが届く。
+
+        python sse_load_test.py --streams 2000 --workers 2 --duration 30
+
+    サーバーはこのスクリプトを --serve で別プロセスとして起動する（設定はbenchmark、DBは一時ファイル）。
+    ハートビートの遅れは、同じストリームで続けて届いたハートビートの間隔からCHAT_SSE_HEARTBEATを引いたもの。
+    接続を開く側（このプロセス）も1本ごとにファイルディスクリプターを使うため、上限を引き上げてから開く。
+"""
+
+
+def raise_file_limit(count):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = count + 256
+    if soft < wanted:
+        target = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+# ---- サーバー（--serve） ----
+
+
+def serve(heartbeat):
+    # serveのimportでeventletのパッチが当たるため、他のモジュールより先にimportする
+    import serve as server
+
+    from flask_chat_server import db
+    from flask_chat_server.main import views
+
+    def idle_answer(session_id):
+        def chunks():
+            while True:
+                time.sleep(3600)
+                yield
+
+        return chunks(), 1
+
+    def create_app(config=None):
+        app = server_create_app(
+            {
+                **(config or {}),
+                "CHAT_RATE_LIMIT": "1000000 per minute",
+                "CHAT_MAX_STREAMS_PER_IP": 1000000,
+                "CHAT_SSE_HEARTBEAT": heartbeat,
+                "EVENT_LOG_LEVEL": "WARNING",
+                "SEARCH_SUGGEST_PRELOAD": False,
+                "QUESTION_CLASSIFIER_LOG": None,
+            }
+        )
+        with app.app_context():
+            db.create_all()
+        return app
+
+    server_create_app = server.create_app
+    server.create_app = create_app
+    views.build_answer_stream = idle_answer
+    server.main()
+
+
+# ---- 計測 ----
+
+
+def worker_pids(parent):
+    pids = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent:
+            pids.append(int(name))
+    return pids or [parent]
+
+
+def usage(pids):
+    rss = fds = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+            fds += len(os.listdir(f"/proc/{pid}/fd"))
+        except OSError:
+            pass
+    return rss, fds
+
+
+def wait_for_port(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("サーバーが起動しませんでした。")
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Stream:
+    def __init__(self, sock):
+        self.sock = sock
+        self.header = b""
+        self.status = None
+        self.buffer = b""
+        self.pings = []
+
+
+def open_streams(host, port, count, selector, ramp):
+    streams = []
+    for i in range(count):
+        sock = socket.create_connection((host, port))
+        sock.sendall(
+            f"GET /chat_sse?data=load-{i} HTTP/1.1\r\nHost: {host}:{port}\r\n"
+            "Accept: text/event-stream\r\n\r\n".encode()
+        )
+        sock.setblocking(False)
+        stream = Stream(sock)
+        selector.register(sock, selectors.EVENT_READ, stream)
+        streams.append(stream)
+        if ramp:
+            time.sleep(ramp)
+    return streams
+
+
+def read(stream):
+    try:
+        data = stream.sock.recv(65536)
+    except BlockingIOError:
+        return True
+    if not data:
+        return False
+    now = time.monotonic()
+    if stream.status is None:
+        stream.header += data
+        if b"\r\n\r\n" not in stream.header:
+            return True
+        head, data = stream.header.split(b"\r\n\r\n", 1)
+        stream.status = int(head.split(b" ", 2)[1])
+    # ": ping" が受信の境目で分かれた場合に備え、前回の末尾とつなげて数える
+    buffer = stream.buffer + data
+    count = buffer.count(b": ping")
+    stream.pings.extend([now] * count)
+    if count:
+        buffer = buffer[buffer.rfind(b": ping") + len(b": ping") :]
+    stream.buffer = buffer[-8:]
+    return True
+
+
+def run(args):
+    limit = raise_file_limit(args.streams)
+    if limit < args.streams + 64:
+        sys.exit(f"ファイルディスクリプターの上限（{limit}）が足りません。")
+
+    workdir = tempfile.mkdtemp(prefix="sse-load-")
+    env = dict(
+        os.environ,
+        FLASK_CONFIG="benchmark",
+        BENCH_DATABASE_URL="sqlite:///" + os.path.join(workdir, "bench.sqlite"),
+        SECRET_KEY=os.environ.get("SECRET_KEY", "sse-load-test"),
+        CHAT_CLIENT_WARMUP="0",
+        CHAT_VECTOR_EMBEDDER="hashing",
+        SERVE_HOST=args.host,
+        SERVE_PORT=str(args.port),
+        SERVE_WORKERS=str(args.workers),
+        SERVE_MAX_CONNECTIONS=str(args.streams + 100),
+    )
+    command = [sys.executable, os.path.abspath(__file__), "--serve", "--heartbeat", str(args.heartbeat)]
+    server = subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    selector = selectors.DefaultSelector()
+    streams = []
+    try:
+        wait_for_port(args.host, args.port)
+        time.sleep(1)
+        pids = worker_pids(server.pid)
+        rss_before, fds_before = usage(pids)
+
+        started = time.monotonic()
+        streams = open_streams(args.host, args.port, args.streams, selector, args.ramp)
+        opened_in = time.monotonic() - started
+
+        closed = 0
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            for key, _ in selector.select(timeout=0.5):
+                if not read(key.data):
+                    selector.unregister(key.fileobj)
+                    closed += 1
+        rss_after, fds_after = usage(pids)
+    finally:
+        for stream in streams:
+            stream.sock.close()
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    ok = sum(1 for s in streams if s.status == 200)
+    late = [
+        (b - a) - args.heartbeat
+        for s in streams
+        for a, b in zip(s.pings, s.pings[1:])
+    ]
+    per_stream = max(ok, 1)
+    print(f"ワーカー: {len(pids)}  ストリーム: {ok}/{args.streams}（{opened_in:.1f}秒で接続、途中で切断 {closed}）")
+    print(
+        f"メモリ(RSS): {rss_before / 2**20:.1f}MB → {rss_after / 2**20:.1f}MB"
+        f"（1本あたり {(rss_after - rss_before) / per_stream / 1024:.1f}KB）"
+    )
+    print(
+        f"ファイルディスクリプター: {fds_before} → {fds_after}"
+        f"（1本あたり {(fds_after - fds_before) / per_stream:.2f}）"
+    )
+    if late:
+        print(
+            f"ハートビートの遅れ（間隔 {args.heartbeat}秒、{len(late)}回）: "
+            f"中央値 {statistics.median(late) * 1000:.0f}ms  "
+            f"p95 {percentile(late, 95) * 1000:.0f}ms  "
+            f"p99 {percentile(late, 99) * 1000:.0f}ms  "
+            f"最大 {max(late) * 1000:.0f}ms"
+        )
+    else:
+        print("ハートビートを受信できませんでした（--durationを間隔の2倍以上にしてください）。")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="開いたままの/chat_sseのストリームの負荷試験")
+    parser.add_argument("--streams", type=int, default=1000, help="開くストリームの数")
+    parser.add_argument("--workers", type=int, default=2, help="サーバーのワーカー数")
+    parser.add_argument("--duration", type=float, default=20, help="全て開いてから計測する秒数")
+    parser.add_argument("--heartbeat", type=float, default=2, help="CHAT_SSE_HEARTBEAT（秒）")
+    parser.add_argument("--ramp", type=float, default=0.001, help="接続を開く間隔（秒）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.heartbeat)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
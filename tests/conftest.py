@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+os.environ.setdefault("FLASK_CONFIG", "testing")
+os.environ.setdefault("CHAT_CLIENT_WARMUP", "0")
+
+from flask_chat_server import create_app, db as _db  # noqa: E402
+
+"""
+    テスト用のアプリケーション。DBとファイルの保存先はテストごとの一時ディレクトリにする
+    （バックグラウンドのスレッドからも同じDBが見えるよう、メモリ上ではなくファイルのSQLiteを使う）。
+"""
+
+
+@pytest.fixture
+def app_config():
+    # テストのモジュールで上書きすると、appの設定に加える
+    return {}
+
+
+@pytest.fixture
+def app(tmp_path, app_config):
+    app = create_app(
+        {
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "test.sqlite"),
+            "RELATED_POSTS_DIR": str(tmp_path / "related_posts"),
+            "CHAT_VECTOR_INDEX_DIR": str(tmp_path / "vector_index"),
+            "QUESTION_CLASSIFIER_MODEL": str(tmp_path / "question_classifier.npz"),
+            **app_config,
+        }
+    )
+    with app.app_context():
+        _db.create_all()
+        yield app
+        _db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def db(app):
+    return _db
@@ -0,0 +1,51 @@
+import pytest
+
+from flask_chat_server import answer_cache
+from flask_chat_server.main import views
+from flask_chat_server.main.streaming import Chunk
+from flask_chat_server.models import Message, UserSession
+
+
+@pytest.fixture
+def ask(app, db, monkeypatch):
+    # 質問の種類の判断とOpenAIへの問い合わせを置き換え、呼び出し回数を数える
+    calls = []
+
+    def fake_langchain(message, ids=None):
+        calls.append(message)
+        for text in ["一般的な", "回答です。"]:
+            yield Chunk(text, text)
+
+    monkeypatch.setattr(
+        views, "judge_user_question", lambda m: {"question": m.content, "kind": "general"}
+    )
+    monkeypatch.setattr(views, "ask_langchain", fake_langchain)
+    answer_cache.purge()
+
+    def ask(session_id, question):
+        db.session.add(UserSession(session_id=session_id))
+        db.session.flush()
+        views.save_user_message(question, session_id, 1)
+        chunks, chat_history_id = views.build_answer_stream(session_id)
+        text = "".join(chunk.text for chunk in chunks)
+        saved = Message.query.filter_by(
+            session_id=session_id, chat_history_id=chat_history_id, role="assistant"
+        ).all()
+        return text, [m.content for m in saved]
+
+    ask.calls = calls
+    return ask
+
+
+def test_general_answer_is_saved(ask):
+    text, saved = ask("s1", "今日の天気は？")
+    assert text == "一般的な回答です。"
+    assert saved == [text]
+
+
+def test_cached_answer_replay_is_saved(ask):
+    first, _ = ask("s1", "今日の天気は？")
+    text, saved = ask("s2", "今日の天気は？")
+    assert len(ask.calls) == 1  # 2回目はキャッシュから再生する
+    assert text == first
+    assert saved == [text]
@@ -0,0 +1,55 @@
+import threading
+import time
+
+from flask_chat_server.main import views
+from flask_chat_server.main.coalesce import SingleFlight
+from flask_chat_server.main.streaming import Chunk
+from flask_chat_server.models import Message, UserSession
+
+
+def test_partial_answer_is_saved_and_upstream_closed_on_disconnect(app, db):
+    db.session.add(UserSession(session_id="s1"))
+    db.session.commit()
+    closed = []
+
+    def upstream():
+        try:
+            for text in ["途中", "までの", "回答"]:
+                yield Chunk(text, text)
+        finally:
+            closed.append(True)
+
+    answer = views.save_answer(upstream(), "s1", 2)
+    assert next(answer).text == "途中"
+    assert next(answer).text == "までの"
+    answer.close()
+
+    assert closed == [True]
+    [message] = Message.query.filter_by(session_id="s1").all()
+    assert (message.content, message.action) == ("途中までの", views.CANCELLED_ACTION)
+
+
+def test_generation_stops_when_last_subscriber_leaves():
+    flights = SingleFlight()
+    sent, closed = [], threading.Event()
+
+    def upstream():
+        try:
+            for i in range(1000):
+                sent.append(i)
+                yield Chunk(str(i), str(i))
+                time.sleep(0.001)
+        finally:
+            closed.set()
+
+    stream = flights.stream("k", upstream, budget=1000)
+    next(stream)
+    stream.close()
+    assert closed.wait(5)
+    deadline = time.monotonic() + 5
+    while flights.in_flight() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stats = flights.stats()
+    assert stats["cancelled"] == 1
+    assert len(sent) < 1000
+    assert stats["tokens_saved"] == 1000 - stats["tokens_before_cancel"] > 0
@@ -0,0 +1,42 @@
+import threading
+
+import openai
+from flask import Flask
+
+from flask_chat_server.main.chat_client import ChatClient
+
+
+def make_client(**config):
+    app = Flask(__name__)
+    app.config.update({"CHAT_CLIENT_WARMUP": False, **config})
+    return ChatClient(app)
+
+
+def test_openai_is_configured_once_with_shared_pool():
+    client = make_client(CHAT_CLIENT_POOL_SIZE=7)
+    modules = []
+    threads = [threading.Thread(target=lambda: modules.append(client.openai)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(module is openai for module in modules)
+    assert openai.requestssession is client.http_session
+    assert client.http_session.get_adapter("https://api.openai.com")._pool_maxsize == 7
+
+
+def test_after_fork_replaces_pool_without_closing_parent_session(monkeypatch):
+    client = make_client()
+    client.openai
+    parent = client.http_session
+    monkeypatch.setattr(parent, "close", lambda: (_ for _ in ()).throw(AssertionError))
+    client.after_fork()
+    assert client.http_session is not parent
+    assert openai.requestssession is client.http_session
+
+
+def test_warm_up_builds_prompt_once():
+    client = make_client(CHAT_CLIENT_WARMUP=True)
+    assert client._openai is not None
+    prompt = client.prompt
+    assert prompt is not None and client.prompt is prompt
@@ -0,0 +1,56 @@
+import threading
+
+from flask_chat_server.main.coalesce import SingleFlight
+from flask_chat_server.main.streaming import Chunk
+
+
+def gated_answer(gate, calls, count=3):
+    # 最初のChunkはすぐに返し、残りはgateが開くまで待つ
+    calls.append(1)
+    for i in range(count):
+        if i:
+            gate.wait(5)
+        yield Chunk(str(i), str(i))
+
+
+def test_closing_unstarted_stream_does_not_join():
+    flights = SingleFlight()
+    calls = []
+    chunks = flights.stream("k", lambda: gated_answer(threading.Event(), calls))
+    chunks.close()
+    assert calls == []
+    assert flights.in_flight() == 0
+
+
+def test_subscribers_share_one_generation():
+    flights = SingleFlight()
+    gate = threading.Event()
+    calls = []
+    first = flights.stream("k", lambda: gated_answer(gate, calls))
+    second = flights.stream("k", lambda: gated_answer(gate, calls))
+    assert next(first).text == "0"
+    assert next(second).text == "0"
+    gate.set()
+    assert [c.text for c in first] == ["1", "2"]
+    assert [c.text for c in second] == ["1", "2"]
+    assert calls == [1]
+
+
+def test_generation_continues_until_last_subscriber_leaves():
+    flights = SingleFlight()
+    gate = threading.Event()
+    calls = []
+    first = flights.stream("k", lambda: gated_answer(gate, calls, count=1000))
+    second = flights.stream("k", lambda: gated_answer(gate, calls, count=1000))
+    next(first)
+    next(second)
+    flight = flights._flights["k"]
+
+    first.close()
+    assert flight.subscribers == 1
+    assert not flight.cancelled
+
+    second.close()
+    assert flight.subscribers == 0
+    assert flight.cancelled
+    gate.set()
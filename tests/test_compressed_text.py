@@ -0,0 +1,103 @@
+import pytest
+
+from flask_chat_server import text_codec
+from flask_chat_server.main.compressed_text import TEXT_PREFIX, UNDECODABLE, TextCodec
+from flask_chat_server.models import BlogCategory, BlogPost
+
+LONG = "介護福祉士の資格の取り方について説明します。" * 10
+
+
+@pytest.fixture
+def codec():
+    codec = TextCodec()
+    codec.columns = {"messages.content"}
+    return codec
+
+
+@pytest.mark.parametrize("dialect_name", ["sqlite", "mysql", "postgresql"])
+@pytest.mark.parametrize(
+    "value", [LONG, "短い", TEXT_PREFIX, TEXT_PREFIX + "hi", TEXT_PREFIX * 2 + LONG, ""]
+)
+def test_round_trip(codec, dialect_name, value):
+    for column in ("messages.content", "blog_post.text"):
+        stored = codec.encode(column, value, dialect_name)
+        assert codec.decode(stored, dialect_name) == value
+
+
+def test_long_values_are_compressed(codec):
+    assert codec.encode("messages.content", LONG, "sqlite")[:1] == b"\xff"
+    assert codec.encode("messages.content", LONG, "mysql").startswith(TEXT_PREFIX)
+
+
+def test_undecodable_values_are_replaced(codec):
+    assert codec.decode(TEXT_PREFIX + "hi", "mysql") == UNDECODABLE
+    assert codec.decode(TEXT_PREFIX + "hi", "sqlite") == TEXT_PREFIX + "hi"
+    assert codec.decode(b"\xff\x00broken", "sqlite") == UNDECODABLE
+
+
+def test_unknown_dictionary_is_loaded_once_before_giving_up(codec, monkeypatch):
+    loads = []
+    monkeypatch.setattr(codec, "load_dictionaries", lambda: loads.append(True))
+    payload = codec.encode("messages.content", LONG, "sqlite")
+    assert codec.decode(payload[:1] + b"\x07" + payload[2:], "sqlite") == UNDECODABLE
+    assert loads == [True]
+
+    def load_trained_elsewhere():
+        codec.dictionaries[7] = b"dictionary"
+
+    codec.dictionaries[7] = b"dictionary"
+    stored = codec.compress(LONG.encode("utf-8"), 7)
+    del codec.dictionaries[7]
+    monkeypatch.setattr(codec, "load_dictionaries", load_trained_elsewhere)
+    assert codec.decode(stored, "sqlite") == LONG
+
+
+@pytest.fixture
+def app_config():
+    return {"COMPRESSED_TEXT_COLUMNS": ["blog_post.text"], "COMPRESSED_TEXT_MIN_BYTES": 0}
+
+
+def found(searchtext):
+    return [post.title for post in BlogPost.query.filter(text_codec.search_condition(searchtext))]
+
+
+def test_search_uses_search_text_for_compressed_body(app, db):
+    category = BlogCategory("介護")
+    db.session.add(category)
+    db.session.flush()
+    posts = [
+        BlogPost(title, f"<p>{text}</p>", None, None, category.id, "")
+        for title, text in [("資格", LONG), ("仕事", "保育士の一日の仕事の流れ" * 10)]
+    ]
+    db.session.add_all(posts)
+    db.session.commit()
+    assert text_codec.rebuild_search_text() == 2
+
+    raw = db.session.execute("SELECT text FROM blog_post WHERE id = :id", {"id": posts[0].id})
+    assert raw.scalar()[:1] == b"\xff"
+    assert found("保育士の一日") == ["仕事"]
+    assert found("<p>") == []
+
+    from flask_chat_server.main.views import refresh_post_indexes, remove_post_indexes
+
+    posts[0].text = "<p>保育士の資格</p>"
+    db.session.commit()
+    refresh_post_indexes(posts[0])
+    assert found("保育士の") == ["資格", "仕事"]
+    remove_post_indexes(posts[1].id)
+    assert found("保育士の") == ["資格"]
+
+
+def test_migrate_keeps_undecodable_rows(app, db):
+    post = BlogPost("資格", LONG, None, None, None, "")
+    db.session.add(post)
+    db.session.commit()
+    db.session.execute(
+        "UPDATE blog_post SET text = :text WHERE id = :id",
+        {"text": b"\xff\x00broken", "id": post.id},
+    )
+    db.session.commit()
+    result = text_codec.migrate("blog_post.text", pause=0, decompress=True)
+    assert result["skipped"] == 1 and result["changed"] == 0
+    raw = db.session.execute("SELECT text FROM blog_post WHERE id = :id", {"id": post.id})
+    assert raw.scalar() == b"\xff\x00broken"
@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+from flask_chat_server import event_log
+
+
+@pytest.fixture
+def app_config(tmp_path):
+    return {
+        "EVENT_LOG_LEVEL": "INFO",
+        "EVENT_LOG_FILE": str(tmp_path / "events.jsonl"),
+        "EVENT_LOG_SAMPLING": {},
+        "EVENT_LOG_RATE_LIMIT": 2,
+    }
+
+
+def records(app):
+    event_log.stop()  # 出力待ちの記録を書き出す
+    with open(app.config["EVENT_LOG_FILE"], encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_request_id_is_logged_and_returned(app, client):
+    response = client.get("/chat_session", headers={"X-Request-ID": "req-1"})
+    assert response.headers["X-Request-ID"] == "req-1"
+    [record] = [r for r in records(app) if r["event"] == "chat_session"]
+    assert record["request_id"] == "req-1"
+    assert record["session_id"] == response.get_json()["session_id"]
+    assert record["level"] == "info"
+
+
+def test_rate_limit_drops_info_but_keeps_warnings(app, monkeypatch):
+    monkeypatch.setattr("flask_chat_server.main.event_log.time.monotonic", lambda: 1000.0)
+    for i in range(5):
+        event_log.info("burst", n=i)
+    event_log.warning("burst.warning")
+    logged = records(app)
+    assert [r["n"] for r in logged if r["event"] == "burst"] == [0, 1]
+    assert [r["event"] for r in logged if r["level"] == "warning"] == ["burst.warning"]
@@ -0,0 +1,55 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+from flask_chat_server.main import exports
+from flask_chat_server.models import Inquiry
+
+
+def add_inquiries(db, dates):
+    for i, date in enumerate(dates):
+        inquiry = Inquiry(f"名前{i}", f"user{i}@example.com", "件名", f"本文{i}\n改行")
+        inquiry.date = date
+        db.session.add(inquiry)
+    db.session.commit()
+
+
+def test_csv_is_written_in_chunks_without_reading_all_rows():
+    read = []
+
+    def rows():
+        for i in range(5):
+            read.append(i)
+            yield (i, "a")
+
+    parts = exports.to_csv(rows(), ["id", "text"], flush_rows=2)
+    first = next(parts)
+    assert read == [0, 1]
+    assert first == "\ufeffid,text\r\n0,a\r\n1,a\r\n"
+    assert "".join(parts) == "2,a\r\n3,a\r\n4,a\r\n"
+
+
+def test_export_filters_by_date_range(app, db):
+    add_inquiries(db, [datetime(2024, 1, d, 12) for d in (1, 2, 3)])
+    day = datetime(2024, 1, 2)
+    text = "".join(exports.export("inquiries", "csv", day, day))
+    rows = list(csv.reader(io.StringIO(text.lstrip("\ufeff"))))
+    assert rows[0] == exports.INQUIRY_FIELDS
+    assert [row[2] for row in rows[1:]] == ["名前1"]
+    assert rows[1][5] == "本文1\n改行"
+
+
+def test_cli_writes_jsonl(app, db, tmp_path):
+    add_inquiries(db, [datetime(2024, 1, 1), datetime(2024, 1, 2)])
+    output = tmp_path / "inquiries.jsonl"
+    result = app.test_cli_runner().invoke(
+        args=["export", "inquiries", "--format", "jsonl", "-o", str(output)]
+    )
+    assert result.exit_code == 0
+    records = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+    assert [r["name"] for r in records] == ["名前0", "名前1"]
+    assert records[0]["date"] == "2024-01-01T00:00:00"
+
+    result = app.test_cli_runner().invoke(args=["export", "inquiries", "--start", "2024/01/01"])
+    assert result.exit_code != 0
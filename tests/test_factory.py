@@ -0,0 +1,59 @@
+import gc
+import os
+import weakref
+
+import flask_chat_server
+from flask_chat_server import chat_client, create_app, db
+from flask_chat_server.config import TestingConfig
+
+
+def test_profile_and_overrides():
+    app = create_app({"FEED_TITLE": "上書き"})
+    assert app.config["TESTING"]  # FLASK_CONFIG=testing
+    assert app.config["FEED_TITLE"] == "上書き"
+    assert app.config["SQLALCHEMY_ENGINE_OPTIONS"] == {}  # SQLiteにはプールの設定を渡さない
+
+    app = create_app(TestingConfig)
+    assert app.config["SECRET_KEY"] == "testing"
+
+
+def test_pool_options_for_server_databases():
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "mysql+pymysql://u:p@db/app"})
+    options = app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+    assert options["pool_pre_ping"] and options["pool_recycle"] == 1800
+
+
+def test_after_fork_drops_inherited_connections(app, monkeypatch):
+    disposed, forked = [], []
+    with app.app_context():
+        monkeypatch.setattr(db.engine, "dispose", lambda close=True: disposed.append(close))
+    monkeypatch.setattr(chat_client, "after_fork", lambda: forked.append(True))
+    monkeypatch.setattr(flask_chat_server, "created_apps", weakref.WeakSet([app]))
+    flask_chat_server._after_fork_in_child()
+    assert disposed == [False] and forked == [True]
+
+
+def test_finished_apps_are_not_kept_for_fork_hooks(app):
+    gc.collect()
+    before = len(flask_chat_server.created_apps)
+    for _ in range(5):
+        create_app()
+    gc.collect()
+    assert app in flask_chat_server.created_apps
+    # 拡張機能が最後のアプリケーションを参照しているため、1つは増えることがある
+    assert len(flask_chat_server.created_apps) <= before + 1
+
+
+def test_child_process_can_use_database(app, db):
+    db.session.execute("SELECT 1")
+    pid = os.fork()
+    if pid == 0:
+        try:
+            with app.app_context():
+                db.session.execute("SELECT 1")
+            os._exit(0)
+        except BaseException:
+            os._exit(1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    db.session.execute("SELECT 1")
@@ -0,0 +1,45 @@
+import time
+
+import pytest
+
+from flask_chat_server import feed_cache
+from flask_chat_server.models import BlogCategory, BlogPost
+
+
+@pytest.fixture
+def app_config():
+    return {"FEED_BASE_URL": "https://blog.example.com", "FEED_TTL": 0}
+
+
+def add_post(db, title):
+    category = BlogCategory.query.first()
+    if category is None:
+        category = BlogCategory("介護")
+        db.session.add(category)
+        db.session.flush()
+    post = BlogPost(title, "本文", None, None, category.id, "概要")
+    db.session.add(post)
+    db.session.commit()
+    return post
+
+
+def test_links_use_configured_base_url_not_host_header(client, db):
+    post = add_post(db, "介護の資格")
+    feed = client.get("/feed.xml", headers={"Host": "evil.example"}).get_data(as_text=True)
+    sitemap = client.get("/sitemap.xml", headers={"Host": "evil.example"}).get_data(as_text=True)
+    assert f"https://blog.example.com/{post.id}" in feed
+    assert "https://blog.example.com/" in sitemap
+    assert "evil.example" not in feed + sitemap
+
+
+def test_periodic_reload_runs_in_background(client, db):
+    add_post(db, "介護の資格")
+    assert "介護の資格" in client.get("/feed.xml").get_data(as_text=True)
+
+    # 他のワーカーで追加された記事（このプロセスのupdate_postは呼ばれない）
+    add_post(db, "保育の仕事")
+    client.get("/feed.xml")  # 作り直しを始め、待たずに返す
+    deadline = time.monotonic() + 5
+    while feed_cache._reloading and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert "保育の仕事" in client.get("/feed.xml").get_data(as_text=True)
@@ -0,0 +1,43 @@
+from flask_chat_server import fragment_cache
+from flask_chat_server.models import BlogPost, User
+
+
+def versions(posts):
+    return [fragment_cache.backend.version(f"post:{post.id}") for post in posts]
+
+
+def test_renaming_author_invalidates_their_post_fragments(client, db):
+    author = User("author@example.com", "author", "password", "0")
+    other = User("other@example.com", "other", "password", "0")
+    db.session.add_all([author, other])
+    db.session.flush()
+    mine = [BlogPost(f"記事{i}", "本文", None, author.id, None, "") for i in range(2)]
+    theirs = BlogPost("他の記事", "本文", None, other.id, None, "")
+    db.session.add_all(mine + [theirs])
+    db.session.commit()
+
+    client.post("/login", data={"email": "author@example.com", "password": "password"})
+    before = versions(mine + [theirs])
+
+    def update(username):
+        return client.post(
+            f"/{author.id}/account",
+            data={"email": "author@example.com", "username": username},
+        )
+
+    # ユーザー名を変えない更新ではキャッシュを残す
+    assert update("author").status_code == 302
+    assert versions(mine + [theirs]) == before
+
+    assert update("renamed").status_code == 302
+    assert versions(mine) == [v + 1 for v in before[:2]]
+    assert versions([theirs]) == before[2:]
+
+
+def test_fragment_is_rendered_again_after_bump(app):
+    template = app.jinja_env.from_string('{% cache "card", post_id %}{{ title }}{% endcache %}')
+    assert template.render(post_id=1, title="古いタイトル") == "古いタイトル"
+    assert template.render(post_id=1, title="新しいタイトル") == "古いタイトル"
+
+    fragment_cache.bump(1)
+    assert template.render(post_id=1, title="新しいタイトル") == "新しいタイトル"
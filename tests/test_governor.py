@@ -0,0 +1,120 @@
+from flask import Flask, Response
+
+from flask_chat_server import governor as app_governor
+from flask_chat_server.main import views
+from flask_chat_server.main.governor import Governor
+from flask_chat_server.models import Message, UserSession
+
+
+def make_app(**config):
+    app = Flask(__name__)
+    app.config.update({"CHAT_RATE_LIMIT": "100 per minute", **config})
+    governor = Governor(app)
+
+    @app.route("/stream")
+    @governor.stream(lambda: "s1")
+    def stream():
+        return Response(iter(["a", "b"]))
+
+    return app, governor
+
+
+def test_stream_slot_is_released_when_response_closes():
+    app, governor = make_app(CHAT_MAX_STREAMS_PER_SESSION=1)
+    client = app.test_client()
+
+    first = client.get("/stream", buffered=False)
+    assert first.status_code == 200
+    assert client.get("/stream").status_code == 429
+
+    first.close()
+    with client.get("/stream") as second:
+        assert second.status_code == 200
+    assert governor.backend._streams == {}
+
+
+def test_rate_limit_uses_scope():
+    governor = Governor()
+    governor.burst = 1
+    assert governor.check("chat_sse", "127.0.0.1", "s1")
+    assert not governor.check("chat_sse", "127.0.0.1", "s1")
+    assert governor.check("chat_session", "127.0.0.1", "s1")
+
+
+def test_limited_session_does_not_use_up_ip_tokens(monkeypatch):
+    monkeypatch.setattr("flask_chat_server.main.governor.time.monotonic", lambda: 1000.0)
+    governor = Governor()
+    governor.burst = 3
+    # 別のIPアドレスからs1のバケットを空にする
+    for _ in range(3):
+        assert governor.check("chat_sse", "203.0.113.1", "s1")
+    for _ in range(5):
+        assert not governor.check("chat_sse", "127.0.0.1", "s1")
+    for session_id in ("s2", "s3", "s4"):
+        assert governor.check("chat_sse", "127.0.0.1", session_id)
+    assert not governor.check("chat_sse", "127.0.0.1", "s5")
+
+
+def test_resume_is_not_limited_while_old_stream_holds_slot(app, client, db):
+    db.session.add(UserSession(session_id="s1"))
+    db.session.flush()
+    views.save_user_message("質問", "s1", 1)
+    views.save_to_db_message("保存済みの回答", "s1", 2)
+
+    # 切断に気付く前の、前の接続の枠
+    release = app_governor.acquire_stream("127.0.0.1", "s1")
+    try:
+        assert client.get("/chat_sse?data=s1").status_code == 429
+        for _ in range(app_governor.burst + 1):
+            with client.get(
+                "/chat_sse?data=s1", headers={"Last-Event-ID": "2-0-0"}
+            ) as response:
+                assert response.status_code == 200
+                assert "保存済みの回答" in response.get_data(as_text=True)
+    finally:
+        release()
+    assert Message.query.filter_by(session_id="s1").count() == 2
+
+
+def test_token_bucket_refills_at_configured_rate(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("flask_chat_server.main.governor.time.monotonic", lambda: now[0])
+    app, governor = make_app(CHAT_RATE_LIMIT="2 per minute")
+    for _ in range(2):
+        assert governor.check("chat_sse", "127.0.0.1")
+    assert not governor.check("chat_sse", "127.0.0.1")
+    # 別のIPアドレスは別のバケット
+    assert governor.check("chat_sse", "127.0.0.2")
+
+    now[0] += 30
+    assert governor.check("chat_sse", "127.0.0.1")
+    assert not governor.check("chat_sse", "127.0.0.1")
+
+
+def test_rate_limited_request_gets_429_with_retry_after():
+    app, governor = make_app(CHAT_RATE_LIMIT="1 per minute")
+
+    @app.route("/limited")
+    @governor.limit()
+    def limited():
+        return "ok"
+
+    client = app.test_client()
+    assert client.get("/limited").status_code == 200
+    response = client.get("/limited")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "60"
+
+
+def test_streams_are_limited_per_ip_across_sessions():
+    governor = Governor()
+    governor.max_streams_per_ip = 2
+    releases = [governor.acquire_stream("127.0.0.1", f"s{i}") for i in range(2)]
+    assert all(releases)
+    assert governor.acquire_stream("127.0.0.1", "s3") is None
+    assert governor.acquire_stream("127.0.0.2", "s4") is not None
+
+    releases[0]()
+    releases[0]()  # 2回呼んでも1つ分だけ解放する
+    assert governor.acquire_stream("127.0.0.1", "s3") is not None
+    assert governor.acquire_stream("127.0.0.1", "s5") is None
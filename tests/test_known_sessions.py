@@ -0,0 +1,27 @@
+from flask_chat_server.main import known_sessions
+from flask_chat_server.main.known_sessions import KnownSessions
+
+
+def test_hits_do_not_extend_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(known_sessions.time, "monotonic", lambda: now[0])
+    sessions = KnownSessions()
+    sessions.ttl = 60
+    sessions.add("a")
+    for _ in range(5):
+        now[0] += 50
+        if "a" not in sessions:
+            break
+    assert now[0] == 1100.0
+    assert sessions.stats() == {"entries": 0, "hits": 1, "misses": 1}
+
+
+def test_hits_keep_recently_used_sessions():
+    sessions = KnownSessions()
+    sessions.max_entries = 2
+    sessions.add("a")
+    sessions.add("b")
+    assert "a" in sessions
+    sessions.add("c")
+    assert "a" in sessions and "c" in sessions
+    assert "b" not in sessions
@@ -0,0 +1,55 @@
+import threading
+import time
+
+from flask_chat_server.main.profiling import Profiler
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_cpu_sampler_records_collapsed_stacks_of_other_threads():
+    profiler = Profiler()
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_loop, args=(stop,), name="busy", daemon=True)
+    worker.start()
+    try:
+        assert profiler.start_cpu(interval=0.001)
+        assert not profiler.start_cpu()  # 実行中は開始しない
+        time.sleep(0.1)
+        assert profiler.cpu.stop()
+    finally:
+        stop.set()
+    assert not profiler.cpu.running
+    lines = profiler.cpu.collapsed().splitlines()
+    assert any(line.startswith("busy;") and "busy_loop (test_profiling.py:" in line for line in lines)
+    assert not any("cpu-sampler" in line for line in lines)
+    assert profiler.status()["cpu"]["samples"] > 0
+
+
+def test_cpu_sampler_stops_after_max_seconds():
+    profiler = Profiler()
+    profiler.max_seconds = 0.05
+    profiler.start_cpu(interval=0.001, seconds=60)
+    profiler.cpu._thread.join(5)
+    assert not profiler.cpu.running
+
+
+def test_memory_diff_shows_growth():
+    profiler = Profiler()
+    assert profiler.start_memory(frames=1)
+    try:
+        profiler.memory.snapshot()
+        kept = [bytearray(1024) for _ in range(1000)]  # noqa: F841
+        profiler.memory.snapshot()
+        report = profiler.memory.diff(0, -1, limit=5)
+    finally:
+        profiler.memory.stop()
+    assert "test_profiling.py" in report.splitlines()[2]
+    assert profiler.memory.snapshot() is None  # 止めた後は取らない
+
+
+def test_profiling_endpoints_require_login(client):
+    assert client.get("/profiling").status_code == 302
+    assert client.post("/profiling/cpu/start").status_code == 302
@@ -0,0 +1,71 @@
+import json
+import threading
+import time
+
+from flask import Flask
+
+from flask_chat_server.main.question_classifier import Prediction, QuestionClassifier
+
+
+def make_classifier(tmp_path, **config):
+    app = Flask(__name__, instance_path=str(tmp_path))
+    app.config.update(config)
+    return QuestionClassifier(app)
+
+
+def test_counts_are_not_lost_across_threads(tmp_path):
+    classifier = make_classifier(tmp_path)
+    prediction = Prediction("general", 0.99, True)
+
+    def record():
+        for _ in range(1000):
+            classifier.record("質問", "general", prediction)
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = classifier.stats()
+    assert stats["upstream"] == stats["compared"] == stats["audit_agreed"] == 8000
+    assert stats["agreement"] == 1.0
+
+
+def test_log_is_opt_in(tmp_path):
+    classifier = make_classifier(tmp_path)
+    classifier.record("介護の資格について", "related")
+    assert classifier.log_path is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_logged_questions_are_truncated_and_pruned(tmp_path):
+    path = tmp_path / "labels.jsonl"
+    classifier = make_classifier(
+        tmp_path, QUESTION_CLASSIFIER_LOG=str(path), QUESTION_CLASSIFIER_LOG_MAX_CHARS=5
+    )
+    path.write_text(
+        json.dumps({"text": "古い質問", "kind": "general", "at": int(time.time()) - 40 * 86400})
+        + "\n",
+        encoding="utf-8",
+    )
+    classifier.record("介護の資格について", "related")
+    classifier.prune_log()
+    records = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert [(r["text"], r["kind"]) for r in records] == [("介護の資格", "related")]
+
+
+def test_relative_log_and_model_paths(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    classifier = make_classifier(
+        tmp_path,
+        QUESTION_CLASSIFIER_LOG="labels.jsonl",
+        QUESTION_CLASSIFIER_MODEL="model.npz",
+    )
+    for i in range(10):
+        classifier.record(f"介護の資格{i}", "related")
+        classifier.record(f"今日の天気{i}", "general")
+    assert len((tmp_path / "labels.jsonl").read_text(encoding="utf-8").splitlines()) == 20
+
+    classifier.train_from_log(epochs=5, holdout=0.2)
+    assert (tmp_path / "model.npz").exists()
+    assert classifier.predict("介護の資格") is not None
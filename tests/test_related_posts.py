@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+from flask import Flask
+
+from flask_chat_server.main.related_posts import RelatedPosts
+
+
+def make_related(directory):
+    app = Flask(__name__)
+    app.config["RELATED_POSTS_DIR"] = str(directory)
+    return RelatedPosts(app)
+
+
+def post(post_id, title, text):
+    return SimpleNamespace(id=post_id, title=title, summary="", text=text)
+
+
+POSTS = [
+    post(1, "介護の資格", "介護福祉士の資格の取り方と試験の内容"),
+    post(2, "介護福祉士の試験", "介護福祉士の試験の対策と資格の取り方"),
+    post(3, "保育の仕事", "保育士の一日の仕事の流れ"),
+    post(4, "保育士の一日", "保育士の仕事の流れと一日の予定"),
+]
+
+
+def wait_reloaded(related):
+    deadline = time.monotonic() + 5
+    while related._reloading and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not related._reloading
+
+
+def test_related_posts_are_computed(tmp_path):
+    related = make_related(tmp_path)
+    related.rebuild(POSTS)
+    assert related.related(1)[0] == 2
+    assert related.related(3)[0] == 4
+
+
+def test_update_by_another_process_is_reloaded_in_background(tmp_path, monkeypatch):
+    writer = make_related(tmp_path)
+    reader = make_related(tmp_path)
+    writer.rebuild(POSTS)
+    reader.related(1)
+    wait_reloaded(reader)
+    assert reader.related(1)[0] == 2
+
+    # 他のプロセスが更新した後も、読み込みが終わるまでは読み込み済みの結果を返す
+    gate = threading.Event()
+    read = RelatedPosts._read
+
+    def slow_read(self):
+        gate.wait(5)
+        return read(self)
+
+    monkeypatch.setattr(RelatedPosts, "_read", slow_read)
+    writer.update_post(post(5, "介護の資格の試験", "介護福祉士の資格の試験の内容"))
+    os.utime(writer.path, (time.time() + 10, time.time() + 10))
+    assert 5 not in reader.related(1)
+    gate.set()
+    wait_reloaded(reader)
+    assert 5 in reader.related(1)
+
+
+def test_edits_do_not_build_missing_file(tmp_path):
+    related = make_related(tmp_path)
+    related.update_post(POSTS[0])
+    related.remove_post(1)
+    assert not os.path.exists(related.path)
+    assert related.related(1) == []
+
+
+def test_concurrent_edits_from_processes_are_all_kept(tmp_path):
+    make_related(tmp_path).rebuild(POSTS)
+    pids = []
+    for i in range(4):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                writer = make_related(tmp_path)
+                for j in range(3):
+                    post_id = 10 + i * 3 + j
+                    writer.update_post(post(post_id, f"介護の記事{post_id}", "介護福祉士の資格"))
+                os._exit(0)
+            except BaseException:
+                os._exit(1)
+        pids.append(pid)
+    for pid in pids:
+        assert os.WEXITSTATUS(os.waitpid(pid, 0)[1]) == 0
+
+    reader = make_related(tmp_path)
+    with reader._lock:
+        assert reader._load()
+    assert sorted(reader.post_ids.tolist()) == [1, 2, 3, 4] + list(range(10, 22))
+    assert [name for name in os.listdir(tmp_path) if name.startswith(".related-")] == []
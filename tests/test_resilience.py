@@ -0,0 +1,117 @@
+import openai
+import pytest
+
+from flask_chat_server.main.chat_client import ChatClient
+from flask_chat_server.main.resilience import CircuitBreaker, CircuitOpenError
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # CircuitBreakerが使う時刻を進められるようにする
+    now = [1000.0]
+    monkeypatch.setattr(
+        "flask_chat_server.main.resilience.time.monotonic", lambda: now[0]
+    )
+    return now
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.check()
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_breaker_opens_after_threshold_and_half_opens_after_reset(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    open_breaker(breaker)
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    clock[0] += 30
+    breaker.check()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # 半開状態では1件だけ試す
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+
+def test_half_open_trial_success_closes_and_failure_reopens(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    open_breaker(breaker)
+    clock[0] += 30
+    breaker.check()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    clock[0] += 30
+    breaker.check()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+
+
+def test_release_frees_half_open_trial(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    open_breaker(breaker)
+    clock[0] += 30
+    breaker.check()
+    breaker.release()
+    breaker.check()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+@pytest.fixture
+def client(clock):
+    client = ChatClient()
+    client.hedge_delay = None
+    client.retries = 0
+    client.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    return client
+
+
+def half_open(client, clock):
+    client.breaker.check()
+    client.breaker.record_failure()
+    clock[0] += 30
+
+
+def test_stream_closed_before_reading_keeps_trial_free(client, clock):
+    half_open(client, clock)
+    client.chat_completion = lambda **kwargs: iter([{"choices": []}])
+
+    # 読み出さずに閉じても試行枠は残らない
+    client.stream_completion(messages=[]).close()
+    client.stream_completion(messages=[]).close()
+
+    stream = client.stream_completion(messages=[])
+    assert next(stream) == {"choices": []}
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_empty_stream_counts_as_success(client, clock):
+    half_open(client, clock)
+    client.chat_completion = lambda **kwargs: iter([])
+    assert list(client.stream_completion(messages=[])) == []
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_only_upstream_errors_count_as_failures(client, clock):
+    def fail(error):
+        def chat_completion(**kwargs):
+            raise error
+
+        return chat_completion
+
+    client.chat_completion = fail(openai.error.InvalidRequestError("bad", None))
+    with pytest.raises(openai.error.InvalidRequestError):
+        list(client.stream_completion(messages=[]))
+    client.chat_completion = fail(openai.error.AuthenticationError("no key"))
+    with pytest.raises(openai.error.AuthenticationError):
+        client.create_completion(messages=[])
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+    client.chat_completion = fail(openai.error.APIError("down", http_status=502))
+    with pytest.raises(openai.error.APIError):
+        list(client.stream_completion(messages=[]))
+    assert client.breaker.state == CircuitBreaker.OPEN
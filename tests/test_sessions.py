@@ -0,0 +1,38 @@
+from flask_chat_server import socketio
+from flask_chat_server.models import Message, UserSession
+
+
+def save_chat(client, session_id, chat_history_id=1):
+    return client.post(
+        "/save_chat",
+        json={"session_id": session_id, "message": "質問", "chat_history_id": chat_history_id},
+    )
+
+
+def test_cookieless_client_can_use_returned_session_id(app):
+    session_id = app.test_client().get("/chat_session").get_json()["session_id"]
+    assert UserSession.query.get(session_id) is not None
+
+    # Cookieを送り返さない別のクライアント
+    assert save_chat(app.test_client(), session_id).status_code == 200
+
+
+def test_lazy_session_is_created_on_first_message(app, client):
+    session_id = client.get("/chat_session?lazy=1").get_json()["session_id"]
+    assert UserSession.query.get(session_id) is None
+
+    assert save_chat(app.test_client(), session_id).status_code == 404
+    assert save_chat(client, session_id).status_code == 200
+    assert UserSession.query.get(session_id) is not None
+
+
+def test_invalid_chat_history_id_is_rejected(app, client):
+    session_id = client.get("/chat_session").get_json()["session_id"]
+    for value in [None, "abc", -1, True]:
+        assert save_chat(client, session_id, value).status_code == 400
+
+    socket = socketio.test_client(app, flask_test_client=client)
+    socket.emit("chat_message", {"session_id": session_id, "message": "質問"})
+    [error] = [e for e in socket.get_received() if e["name"] == "chat_error"]
+    assert "chat_history_id" in error["args"][0]["error"]
+    assert Message.query.count() == 0
@@ -0,0 +1,19 @@
+import click
+import pytest
+
+from flask_chat_server.main.compaction import compact_sessions
+from flask_chat_server.models import ArchivedSession
+
+
+def test_features_require_tables_instead_of_creating_them(app, db):
+    ArchivedSession.__table__.drop(db.engine)
+    with pytest.raises(click.ClickException, match="flask create-tables"):
+        compact_sessions(30)
+
+    result = app.test_cli_runner().invoke(args=["create-tables"])
+    assert result.exit_code == 0
+    assert "archived_sessions" in result.output
+    assert compact_sessions(30)["sessions"] == 0
+
+    result = app.test_cli_runner().invoke(args=["create-tables"])
+    assert "なし" in result.output
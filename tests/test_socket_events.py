@@ -0,0 +1,52 @@
+import time
+
+import pytest
+
+from flask_chat_server import answer_cache, socketio
+from flask_chat_server.main import views
+from flask_chat_server.main.streaming import Chunk
+from flask_chat_server.models import Message
+
+
+@pytest.fixture
+def socket(app, client, monkeypatch):
+    def fake_langchain(message, ids=None):
+        for text in ["Socket.IOの", "回答です。"]:
+            yield Chunk(text, text)
+
+    monkeypatch.setattr(
+        views, "judge_user_question", lambda m: {"question": m.content, "kind": "general"}
+    )
+    monkeypatch.setattr(views, "ask_langchain", fake_langchain)
+    answer_cache.purge()
+    return socketio.test_client(app, flask_test_client=client)
+
+
+def received_until(socket, name, timeout=5):
+    events, deadline = [], time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        events += socket.get_received()
+        if any(event["name"] == name for event in events):
+            return events
+        time.sleep(0.01)
+    raise AssertionError(f"{name}を受信できませんでした: {events}")
+
+
+def test_answer_tokens_are_streamed_to_session_room(client, socket):
+    session_id = client.get("/chat_session").get_json()["session_id"]
+    socket.emit("join_chat", {"session_id": session_id})
+    socket.emit(
+        "chat_message", {"session_id": session_id, "message": "質問", "chat_history_id": 1}
+    )
+    events = received_until(socket, "chat_done")
+    tokens = "".join(e["args"][0]["data"] for e in events if e["name"] == "chat_token")
+    assert "Socket.IOの回答です。" in tokens
+    assert [m.role for m in Message.query.filter_by(session_id=session_id)] == [
+        "user",
+        "assistant",
+    ]
+
+
+def test_unknown_session_cannot_join(socket):
+    socket.emit("join_chat", {"session_id": "unknown"})
+    assert [e["name"] for e in socket.get_received()] == ["connect_completed", "chat_error"]
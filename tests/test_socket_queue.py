@@ -0,0 +1,89 @@
+import multiprocessing
+import pickle
+import socket
+import time
+
+from flask_chat_server.main.socket_queue import InProcessManager, LocalSocketManager
+
+MESSAGES = 2000
+
+
+def listen(url, channel, expected, ready, results):
+    manager = LocalSocketManager(url, channel=channel)
+    manager.sock.settimeout(10)
+    ready.set()
+    received = []
+    try:
+        for payload in manager._listen():
+            received.append(pickle.loads(payload)["data"])
+            if len(received) == expected:
+                break
+    except socket.timeout:
+        pass
+    results.put((manager.host_id, received))
+
+
+def start_listeners(ctx, url, channel, count, expected):
+    results = ctx.Queue()
+    processes = []
+    for _ in range(count):
+        ready = ctx.Event()
+        process = ctx.Process(target=listen, args=(url, channel, expected, ready, results))
+        process.start()
+        assert ready.wait(10)
+        processes.append(process)
+    return processes, results
+
+
+def collect(processes, results):
+    received = [results.get(timeout=30) for _ in processes]
+    for process in processes:
+        process.join(10)
+    return received
+
+
+def test_local_queue_delivers_every_emit_to_every_process(tmp_path):
+    ctx = multiprocessing.get_context("fork")
+    url = f"local://{tmp_path}"
+    processes, results = start_listeners(ctx, url, "chat", 3, MESSAGES)
+
+    # 2つのワーカーから交互に送信する
+    writers = [LocalSocketManager(url, channel="chat", write_only=True) for _ in range(2)]
+    start = time.perf_counter()
+    for i in range(MESSAGES):
+        writers[i % 2]._publish({"method": "emit", "data": i})
+    received = collect(processes, results)
+    elapsed = time.perf_counter() - start
+
+    assert len({host_id for host_id, _ in received}) == 3
+    for _, messages in received:
+        assert messages == list(range(MESSAGES))
+    print(f"local://: {MESSAGES * 3 / elapsed:.0f} deliveries/s")
+
+
+def test_local_queue_finds_new_and_removes_stopped_listeners(tmp_path):
+    ctx = multiprocessing.get_context("fork")
+    url = f"local://{tmp_path}"
+    writer = LocalSocketManager(url, channel="chat", write_only=True)
+
+    processes, results = start_listeners(ctx, url, "chat", 1, 1)
+    writer._publish({"method": "emit", "data": "first"})
+    [(stopped, messages)] = collect(processes, results)
+    assert messages == ["first"]
+
+    # 終了したプロセスのソケットは送信に失敗した時点で削除し、新しいプロセスには送る
+    processes, results = start_listeners(ctx, url, "chat", 1, 1)
+    writer._publish({"method": "emit", "data": "second"})
+    assert [messages for _, messages in collect(processes, results)] == [["second"]]
+    assert not any(stopped in path for path in writer._refresh_peers(force=True))
+
+
+def test_memory_queue_delivers_to_every_server_in_process():
+    subscribers = [InProcessManager(channel="test-memory") for _ in range(3)]
+    writer = InProcessManager(channel="test-memory", write_only=True)
+    for i in range(100):
+        writer._publish({"method": "emit", "data": i})
+    for subscriber in subscribers:
+        listener = subscriber._listen()
+        assert [pickle.loads(next(listener))["data"] for _ in range(100)] == list(range(100))
+        assert subscriber.queue.empty()
@@ -0,0 +1,54 @@
+import threading
+import zlib
+
+import pytest
+
+from flask_chat_server.main.streaming import STOP, Chunk, coalesce, gzip_stream, to_sse
+
+
+def tokens(*texts):
+    return [Chunk(text, text) for text in texts]
+
+
+def test_tokens_are_merged_up_to_max_chars():
+    merged = list(coalesce(iter(tokens(*"あいうえおかきくけこ")), max_chars=4, max_delay=5))
+    assert [c.data for c in merged] == ["あいうえ", "おかきく", "けこ"]
+
+
+def test_control_chunks_are_sent_alone():
+    chunks = tokens("a", "b") + [Chunk(STOP, "")] + tokens("c")
+    merged = list(coalesce(iter(chunks), max_chars=100, max_delay=5))
+    assert [c.data for c in merged] == ["ab", STOP, "c"]
+
+
+def test_buffer_is_flushed_after_max_delay_while_upstream_stalls():
+    gate = threading.Event()
+
+    def stalled():
+        yield Chunk("a", "a")
+        gate.wait(5)
+        yield Chunk("b", "b")
+
+    merged = coalesce(stalled(), max_chars=100, max_delay=0.05)
+    assert next(merged).data == "a"  # "b"を待たずに送る
+    gate.set()
+    assert [c.data for c in merged] == ["b"]
+
+
+def test_upstream_errors_are_raised_after_flushing():
+    def failing():
+        yield Chunk("a", "a")
+        raise RuntimeError("upstream")
+
+    merged = coalesce(failing(), max_chars=100, max_delay=5)
+    assert next(merged).data == "a"
+    with pytest.raises(RuntimeError):
+        next(merged)
+
+
+def test_gzip_frames_can_be_decoded_as_they_arrive():
+    frames = list(to_sse(tokens("こんにちは", "世界")))
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    parts = [decompressor.decompress(data).decode("utf-8") for data in gzip_stream(iter(frames))]
+    assert parts[:2] == frames
+    assert "".join(parts) == "".join(frames)
@@ -0,0 +1,67 @@
+from flask_chat_server.main.suggest import SuggestIndex
+
+
+def texts(index, query):
+    return [s.text for s in index.suggest(query)]
+
+
+def test_query_needs_several_searchers_before_it_is_suggested(app):
+    index = SuggestIndex()
+    index.rebuild()
+    for _ in range(10):
+        index.record_query("介護 求人", "203.0.113.1")
+    assert texts(index, "介護") == []
+
+    index.record_query("介護 求人", "203.0.113.2")
+    index.record_query("介護 求人", "203.0.113.3")
+    assert texts(index, "介護") == ["介護 求人"]
+    assert index.suggest("介護")[0].weight == 3
+
+
+def test_titles_are_suggested_without_searches(app, db):
+    from flask_chat_server.models import BlogPost
+
+    db.session.add(BlogPost("介護福祉士の資格", "本文", None, None, None, ""))
+    db.session.commit()
+    index = SuggestIndex()
+    index.rebuild()
+    assert texts(index, "介護") == ["介護福祉士の資格"]
+
+
+def test_edits_during_rebuild_are_kept(app, db):
+    from flask_chat_server.models import BlogPost
+
+    db.session.add(BlogPost("介護の基本", "本文", None, None, None, ""))
+    db.session.commit()
+    index = SuggestIndex()
+    index.rebuild()
+    post_id = index.suggest("介護")[0].id
+
+    snapshot = index._snapshot
+
+    def edit_while_reading():
+        # DBを読み終えてから索引を入れ替えるまでの間に、他のリクエストが編集する
+        entries = snapshot()
+        index.update("post", 999, "介護 新着")
+        index.remove("post", post_id)
+        return entries
+
+    index._snapshot = edit_while_reading
+    index.rebuild()
+    assert texts(index, "介護") == ["介護 新着"]
+
+
+def test_only_one_background_rebuild_starts(app, monkeypatch):
+    import threading
+
+    index = SuggestIndex(app)
+    index.refresh_interval = 1
+    index.built_at = -100.0
+    started = []
+    monkeypatch.setattr(index, "_rebuild_in_background", lambda: started.append(True))
+    threads = [threading.Thread(target=index._refresh_if_stale) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert started == [True]
@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+from flask_chat_server import chat_client, summarizer
+from flask_chat_server.main.summary import load_summary, split_recent
+from flask_chat_server.models import Message, UserSession
+
+
+@pytest.fixture
+def app_config():
+    return {"CHAT_HISTORY_MAX_CHARS": 30, "CHAT_SUMMARY_MAX_CHARS": 50}
+
+
+@pytest.fixture
+def completions(monkeypatch):
+    calls = []
+
+    def create_completion(messages, **kwargs):
+        calls.append(messages[-1]["content"])
+        return {"choices": [{"message": {"content": f"要約{len(calls)}"}}]}
+
+    monkeypatch.setattr(chat_client, "create_completion", create_completion)
+    return calls
+
+
+def add_messages(db, session_id, texts, start=1):
+    for i, text in enumerate(texts, start):
+        db.session.add(
+            Message(chat_history_id=i, session_id=session_id, content=text * 2, role="user")
+        )
+    db.session.commit()
+
+
+def test_split_recent_keeps_partially_fitting_message_in_recent():
+    messages = [Message(role="user", content="a" * 10) for _ in range(3)]
+    older, recent = split_recent(messages, 25)
+    assert (len(older), len(recent)) == (1, 2)
+
+
+def test_only_messages_after_previous_summary_are_sent(app, db, completions):
+    db.session.add(UserSession(session_id="s1"))
+    db.session.flush()
+    add_messages(db, "s1", ["一つ目の質問です。", "二つ目の質問です。", "三つ目の質問です。"])
+    summarizer.update("s1")
+    assert load_summary(UserSession.query.get("s1").important_info)[0] == "要約1"
+    assert "一つ目" in completions[0]
+
+    add_messages(db, "s1", ["四つ目の質問です。", "五つ目の質問です。"], start=4)
+    summarizer.update("s1")
+    info = json.loads(UserSession.query.get("s1").important_info)
+    assert info["summary"] == "要約2"
+    assert "■これまでの要約:\n要約1" in completions[1]
+    assert "一つ目" not in completions[1] and "三つ目" in completions[1]
+
+    messages = Message.query.filter_by(session_id="s1").order_by(Message.create_at).all()
+    assert summarizer.summary_for("s1", messages) == "要約2"
+
+
+def test_short_conversation_is_not_summarized(app, db, completions):
+    db.session.add(UserSession(session_id="s1"))
+    db.session.flush()
+    add_messages(db, "s1", ["短い"])
+    summarizer.update("s1")
+    assert completions == []
+    assert summarizer.summary_for("s1", Message.query.all()) == ""
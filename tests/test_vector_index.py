@@ -0,0 +1,43 @@
+import os
+from types import SimpleNamespace
+
+from flask import Flask
+
+from flask_chat_server.main.vector_index import VectorIndex
+
+
+def make_index(directory):
+    app = Flask(__name__)
+    app.config["CHAT_VECTOR_INDEX_DIR"] = str(directory)
+    app.config["CHAT_VECTOR_EMBEDDER"] = "hashing"
+    return VectorIndex(app)
+
+
+def post(post_id, title, text):
+    return SimpleNamespace(id=post_id, title=title, summary="", text=text)
+
+
+def found(index, query):
+    return {post_id for _, post_id, _ in index.search(query)}
+
+
+def test_missing_index_is_not_built_in_requests(app, tmp_path):
+    index = make_index(tmp_path / "index")
+    assert index.search("介護の資格") == []
+    index.update_post(post(1, "介護の資格", "介護福祉士の資格の取り方"))
+    assert not os.path.exists(index.current_path)
+
+
+def test_update_in_one_process_is_seen_by_another(app, tmp_path):
+    writer = make_index(tmp_path / "index")
+    reader = make_index(tmp_path / "index")
+    writer.rebuild([post(1, "介護の資格", "介護福祉士の資格の取り方")])
+    assert found(reader, "介護福祉士の資格") == {1}
+
+    writer.update_post(post(2, "保育の仕事", "保育士の一日の仕事の流れ"))
+    writer.remove_post(1)
+    assert found(reader, "保育士の仕事") == {2}
+    assert found(reader, "介護福祉士の資格") <= {2}
+
+    versions = [name for name in os.listdir(tmp_path / "index") if name.startswith("v")]
+    assert len(versions) == VectorIndex.KEEP_VERSIONS